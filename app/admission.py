@@ -0,0 +1,235 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ADMISSION_CONFIG = {
+    # LLM calls sent to Ollama at once; match OLLAMA_NUM_PARALLEL of the server
+    "max_concurrent": int(os.environ.get("LLM_MAX_CONCURRENT", 2)),
+    # Requests allowed to wait for a slot; beyond this new ones get 429 straight away
+    "max_queue": int(os.environ.get("LLM_MAX_QUEUE", 32)),
+    # Longest a request waits for a slot before it gives up with 503
+    "max_wait_s": float(os.environ.get("LLM_MAX_WAIT_S", 30)),
+}
+
+# Lower is served first: interactive streams ahead of blocking /chat calls
+PRIORITY_STREAM = 0
+PRIORITY_CHAT = 1
+
+# Assumed slot hold time until real LLM calls have been measured
+DEFAULT_HOLD_S = 5.0
+# How often a waiting stream re-reads its queue position
+POSITION_POLL_S = 0.5
+
+
+class AdmissionRejected(Exception):
+    """The LLM can't take the request in time; the API answers status_code with Retry-After."""
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in the LLM queue. Always release() it, admitted or not."""
+
+    def __init__(self, scheduler, priority: int, seq: int):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+        self._granted = threading.Event()
+        self._waiters = []  # (loop, asyncio.Event) of async waiters
+
+    @property
+    def admitted(self) -> bool:
+        return self._granted.is_set()
+
+    @property
+    def wait_s(self) -> float:
+        return (self.admitted_at or time.monotonic()) - self.enqueued_at
+
+    def _grant(self):
+        # Called with the scheduler lock held, possibly from another thread
+        self.admitted_at = time.monotonic()
+        self._granted.set()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def wait(self, timeout: float = None):
+        """Blocks until admitted; raises AdmissionRejected(503) after max_wait_s."""
+        timeout = self.scheduler.max_wait_s if timeout is None else timeout
+        if not self._granted.wait(timeout) and self.scheduler._withdraw(self):
+            raise self.scheduler._timed_out()
+
+    async def positions(self, timeout: float = None):
+        """
+        Async variant of wait(): yields the 1-based queue position whenever it changes
+        while waiting (nothing if admitted at once) and returns when admitted.
+        """
+        timeout = self.scheduler.max_wait_s if timeout is None else timeout
+        event = asyncio.Event()
+        self._waiters.append((asyncio.get_running_loop(), event))
+        if self.admitted:
+            return
+        deadline = time.monotonic() + timeout
+        last = None
+        while not self.admitted:
+            position = self.scheduler.position(self)
+            if position != last and position:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if self.scheduler._withdraw(self):
+                    raise self.scheduler._timed_out()
+                return
+            try:
+                await asyncio.wait_for(event.wait(), min(POSITION_POLL_S, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        """Frees the slot, or leaves the queue if still waiting. Idempotent."""
+        self.scheduler._release(self)
+
+
+class LLMScheduler:
+    """
+    Admission control in front of the single local Ollama. At most max_concurrent LLM
+    calls run at once; further requests wait in a bounded priority queue (FIFO within
+    a priority). A full queue rejects at once with 429, a request that waits longer
+    than max_wait_s gets 503, both with a Retry-After estimated from how long slots
+    have recently been held. Thread-safe: the sync /chat path blocks in a worker
+    thread, the streaming path waits on the event loop.
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 32, max_wait_s: float = 30):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.max_wait_s = max_wait_s
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.hold_s = DEFAULT_HOLD_S  # moving average of how long a slot is held
+        self._waiting = []  # heap of (priority, seq, ticket)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> int:
+        """Seconds until a new request could expect a slot."""
+        return max(1, math.ceil(self.hold_s * (len(self._waiting) + 1) / self.max_concurrent))
+
+    def _full(self) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(429, self.retry_after(), "LLM queue is full")
+
+    def _timed_out(self) -> AdmissionRejected:
+        with self._lock:
+            self.timed_out += 1
+            return AdmissionRejected(503, self.retry_after(), "Timed out waiting for the LLM")
+
+    def check(self):
+        """Raises AdmissionRejected(429) if a new request would be turned away right now."""
+        with self._lock:
+            if self.active >= self.max_concurrent and len(self._waiting) >= self.max_queue:
+                raise self._full()
+
+    def enqueue(self, priority: int = PRIORITY_CHAT) -> Ticket:
+        """Admits at once if a slot is free, else queues; raises AdmissionRejected(429) if full."""
+        with self._lock:
+            ticket = Ticket(self, priority, next(self._seq))
+            if self.active < self.max_concurrent and not self._waiting:
+                self._admit(ticket)
+            elif len(self._waiting) >= self.max_queue:
+                raise self._full()
+            else:
+                heapq.heappush(self._waiting, (priority, ticket.seq, ticket))
+        return ticket
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_CHAT):
+        """Blocking enqueue + wait + release, for sync callers."""
+        ticket = self.enqueue(priority)
+        try:
+            ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based place in the queue; 0 once admitted (or released)."""
+        with self._lock:
+            if ticket.admitted or ticket.released:
+                return 0
+            key = (ticket.priority, ticket.seq)
+            return 1 + sum(1 for priority, seq, _ in self._waiting if (priority, seq) < key)
+
+    def _admit(self, ticket: Ticket):
+        self.active += 1
+        self.admitted += 1
+        ticket._grant()
+
+    def _withdraw(self, ticket: Ticket) -> bool:
+        """Takes a waiting ticket out of the queue; False if it was admitted meanwhile."""
+        with self._lock:
+            if ticket.admitted:
+                return False
+            if not ticket.released:
+                ticket.released = True
+                self._waiting = [entry for entry in self._waiting if entry[2] is not ticket]
+                heapq.heapify(self._waiting)
+            return True
+
+    def _release(self, ticket: Ticket):
+        if self._withdraw(ticket):
+            return
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self.active -= 1
+            self.hold_s = 0.8 * self.hold_s + 0.2 * (time.monotonic() - ticket.admitted_at)
+            if self._waiting and self.active < self.max_concurrent:
+                self._admit(heapq.heappop(self._waiting)[2])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "waiting": len(self._waiting),
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "hold_s": round(self.hold_s, 2),
+            }
+
+    def prometheus(self) -> str:
+        stats = self.stats()
+        return "\n".join([
+            "# HELP rag_llm_active LLM calls currently running.",
+            "# TYPE rag_llm_active gauge",
+            f"rag_llm_active {stats['active']}",
+            "# HELP rag_llm_waiting Requests waiting for an LLM slot.",
+            "# TYPE rag_llm_waiting gauge",
+            f"rag_llm_waiting {stats['waiting']}",
+            "# HELP rag_llm_rejected_total Requests turned away with 429 (queue full).",
+            "# TYPE rag_llm_rejected_total counter",
+            f"rag_llm_rejected_total {stats['rejected']}",
+            "# HELP rag_llm_timed_out_total Requests that gave up waiting for a slot (503).",
+            "# TYPE rag_llm_timed_out_total counter",
+            f"rag_llm_timed_out_total {stats['timed_out']}",
+        ]) + "\n"
+
+
+llm_scheduler = LLMScheduler(**ADMISSION_CONFIG)
@@ -0,0 +1,91 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from app.embeddings import normalize_text
+
+ANSWER_CACHE_CONFIG = {
+    "max_entries": int(os.environ.get("ANSWER_CACHE_SIZE", 256)),
+    # Minimum cosine similarity between query embeddings for a hit
+    "threshold": float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+}
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class AnswerCache:
+    """
+    Semantic cache for LLM answers.
+
+    An entry is keyed on the retrieved chunks plus the normalized chat history, and
+    matched on query-embedding similarity >= threshold. Changed chunk content is
+    re-inserted under a new id, but re-indexing updates a chunk's title, position and
+    page title in place, so each chunk is keyed on those along with its id. Answers
+    built from an older version of a page stop matching and age out of the LRU.
+    """
+
+    def __init__(self, max_entries: int = 256, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (chunk versions, history) -> [(embedding, answer, sources), ...]
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(chunks: list, chat_history: str):
+        versions = frozenset(
+            (c["id"], c.get("title"), c.get("page_title"), c.get("chunk_index")) for c in chunks
+        )
+        return versions, normalize_text(chat_history or "")
+
+    def get(self, embedding: list[float], chunks: list, chat_history: str = ""):
+        """
+        Returns (answer, sources) for a semantically equivalent cached question over the
+        same retrieved chunks (rows with id, title, page_title, chunk_index), or None.
+        """
+        key = self._key(chunks, chat_history)
+        with self._lock:
+            best, best_score = None, self.threshold
+            for entry in self._entries.get(key, []):
+                score = cosine_similarity(embedding, entry[0])
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return best[1], best[2]
+
+    def put(self, embedding: list[float], chunks: list, chat_history: str, answer: str, sources: list):
+        key = self._key(chunks, chat_history)
+        with self._lock:
+            self._entries.setdefault(key, []).append((embedding, answer, sources))
+            self._entries.move_to_end(key)
+            self._size += 1
+            while self._size > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+answer_cache = AnswerCache(**ANSWER_CACHE_CONFIG)
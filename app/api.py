@@ -1,11 +1,22 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
-from supabase import create_client, Client
-from app.rag import generate_answer, stream_answer
+from contextlib import asynccontextmanager
+from postgrest import AsyncPostgrestClient
+from supabase import acreate_client, create_client, AsyncClient, Client
+from app.admission import AdmissionRejected, llm_scheduler
+from app.auth import AUTH_CONFIG, TokenVerifier
+from app.database import close_async_pool
+from app.memory import HISTORY_CONFIG, assemble_history, conversation_memory
+from app.rag import admission_check, generate_answer, stream_answer
+from app.reranker import rerank_score_cache
+from app.logger import query_logs, get_log, MAX_LOGS
+from app.metrics import metrics
+from app.tracing import Trace
 from dotenv import load_dotenv
+import asyncio
 import json
 import os
 
@@ -14,6 +25,8 @@ load_dotenv()
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY")
+# Legacy HS256 projects only; asymmetric signing keys come from the project's JWKS
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET", "")
 
 if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     raise ValueError("SUPABASE_URL and SUPABASE_ANON_KEY must be set in .env")
@@ -21,7 +34,55 @@ if not SUPABASE_URL or not SUPABASE_ANON_KEY:
 # Initialize Supabase Admin/Client (for token verification)
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 
-app = FastAPI()
+# Async client for the event-loop path (auth, /chat/stream history); created on first use
+_async_supabase: AsyncClient | None = None
+
+
+async def get_async_supabase() -> AsyncClient:
+    global _async_supabase
+    if _async_supabase is None:
+        _async_supabase = await acreate_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+    return _async_supabase
+
+
+def user_postgrest(client: AsyncClient, token: str) -> AsyncPostgrestClient:
+    """
+    PostgREST client that sends the user's JWT (for RLS). Calling client.postgrest.auth(token)
+    would change headers shared by every in-flight request; this reuses the shared
+    HTTP connection pool with per-request headers instead.
+    """
+    return AsyncPostgrestClient(
+        str(client.rest_url),
+        headers={"apikey": SUPABASE_ANON_KEY, "Authorization": f"Bearer {token}"},
+        http_client=client.postgrest.session,
+    )
+
+
+async def remote_get_user(token: str):
+    # Round trip to Supabase Auth; only used when a token can't be verified locally
+    client = await get_async_supabase()
+    response = await client.auth.get_user(token)
+    return response.user
+
+
+token_verifier = TokenVerifier(
+    SUPABASE_URL,
+    remote=remote_get_user,
+    jwt_secret=SUPABASE_JWT_SECRET,
+    jwks_url=os.environ.get("SUPABASE_JWKS_URL") or None,
+    **AUTH_CONFIG
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    token_verifier.start()
+    yield
+    await token_verifier.stop()
+    await close_async_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,22 +94,25 @@ app.add_middleware(
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    # 429: LLM queue full, 503: waited too long for a slot
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": str(exc), "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # --- Security Dependency ---
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     """
     Verifies the Supabase JWT token.
-    Supabase's auth.get_user(token) will return the user object if the token is valid.
+    Signature and claims are checked locally against cached signing keys; only tokens
+    that can't be checked locally cost a Supabase Auth round trip (see app/auth.py).
     """
     try:
-        # This call validates the JWT with Supabase Auth service
-        response = supabase.auth.get_user(token)
-        if response.user is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid or expired session",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return response.user
+        return await token_verifier.verify(token)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -68,23 +132,23 @@ class HistoryRequest(BaseModel):
 # --- Endpoints ---
 @app.post("/chat")
 def chat(request: QuestionRequest, token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
-    # 1. Fetch recent history for Contextual Memory
-    chat_history_str = ""
+    trace = Trace("chat")
+    # 1. Recent history for Contextual Memory (memory cache, else Supabase)
+    chat_history_str, history_stats = "", None
     try:
-        supabase.postgrest.auth(token)
-        history_res = supabase.table("chat_history") \
-            .select("role", "content") \
-            .eq("user_id", str(user.id)) \
-            .order("created_at", desc=True) \
-            .limit(10) \
-            .execute()
-        
-        # Format history: Assistant: ..., User: ... (reversed to get chronological)
-        history_parts = []
-        for msg in reversed(history_res.data):
-            role = "AI" if msg['role'] == "assistant" else "User"
-            history_parts.append(f"{role}: {msg['content']}")
-        chat_history_str = "\n".join(history_parts)
+        messages, source = conversation_memory.get(user.id), "cache"
+        if messages is None:
+            source = "supabase"
+            supabase.postgrest.auth(token)
+            with trace.span("history_fetch"):
+                history_res = supabase.table("chat_history") \
+                    .select("role", "content", "created_at") \
+                    .eq("user_id", str(user.id)) \
+                    .order("created_at", desc=True) \
+                    .limit(conversation_memory.max_messages) \
+                    .execute()
+            messages = conversation_memory.load(user.id, history_res.data)
+        chat_history_str, history_stats = history_block(messages, source)
     except Exception as e:
         print(f"Memory Fetch Warning: {e}")
 
@@ -96,41 +160,61 @@ def chat(request: QuestionRequest, token: str = Depends(oauth2_scheme), user=Dep
         request.question,
         user_email=user_email,
         user_name=user_name,
-        chat_history=chat_history_str
+        chat_history=chat_history_str,
+        history_stats=history_stats,
+        trace=trace
     )
     return {"answer": answer, "sources": sources}
 
-@app.post("/chat/stream")
-def chat_stream(request: QuestionRequest, token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
-    chat_history_str = ""
+def history_block(messages: list, source: str) -> tuple[str, dict]:
+    """Token-budgeted "AI: ...\nUser: ..." history plus stats for the interaction log."""
+    chat_history, stats = assemble_history(messages, **HISTORY_CONFIG)
+    stats["source"] = source
+    return chat_history, stats
+
+async def fetch_chat_history(token: str, user_id: str, session_start: str = None, trace: Trace = None) -> tuple[str, dict]:
+    """
+    Recent messages (of this session, if given) as a token-budgeted history block.
+    Served from the conversation memory cache; Supabase is only read on a miss.
+    """
     try:
-        supabase.postgrest.auth(token)
-        query = supabase.table("chat_history") \
-            .select("role", "content") \
-            .eq("user_id", str(user.id)) \
-            .order("created_at", desc=True) \
-            .limit(10)
+        messages = conversation_memory.get(user_id, session_start)
+        if messages is not None:
+            return history_block(messages, "cache")
 
-        if request.session_start:
-            query = query.gte("created_at", request.session_start)
+        client = await get_async_supabase()
+        query = user_postgrest(client, token).table("chat_history") \
+            .select("role", "content", "created_at") \
+            .eq("user_id", str(user_id)) \
+            .order("created_at", desc=True) \
+            .limit(conversation_memory.max_messages)
 
-        history_res = query.execute()
+        with trace.span("history_fetch"):
+            history_res = await query.execute()
 
-        history_parts = []
-        for msg in reversed(history_res.data):
-            role = "AI" if msg['role'] == "assistant" else "User"
-            history_parts.append(f"{role}: {msg['content']}")
-        chat_history_str = "\n".join(history_parts)
+        messages = conversation_memory.load(user_id, history_res.data, session_start)
+        return history_block(messages, "supabase")
     except Exception as e:
         print(f"Memory Fetch Warning: {e}")
+        return "", None
+
+@app.post("/chat/stream")
+async def chat_stream(request: QuestionRequest, token: str = Depends(oauth2_scheme), user=Depends(get_current_user)):
+    admission_check(request.question)
+    trace = Trace("chat_stream")
+    # Started now and awaited inside stream_answer, concurrently with embedding + retrieval
+    chat_history = asyncio.create_task(
+        fetch_chat_history(token, user.id, request.session_start, trace)
+    )
 
     return StreamingResponse(
         stream_answer(  #generator postaje html body
             request.question,
             user_email=user.email,
             user_name=user.user_metadata.get("full_name", "User"),
-            chat_history=chat_history_str,
-            session_start=request.session_start
+            chat_history=chat_history,
+            session_start=request.session_start,
+            trace=trace
         ),
         media_type="text/event-stream", #SSE contnet-type
         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
@@ -152,6 +236,8 @@ def get_history(token: str = Depends(oauth2_scheme), user=Depends(get_current_us
             .eq("user_id", str(user.id)) \
             .order("created_at", desc=False) \
             .execute()
+        # Warm the conversation memory so the first question skips the history read
+        conversation_memory.load(user.id, response.data)
         return response.data
     except Exception as e:
         print(f"DEBUG: get_history error: {str(e)}")
@@ -171,27 +257,110 @@ def save_history(request: HistoryRequest, token: str = Depends(oauth2_scheme), u
             "content": request.content
         }
         response = supabase.table("chat_history").insert(data).execute()
+        # Write-through: the next question's history comes from memory
+        for row in response.data:
+            conversation_memory.append(user.id, row)
         return response.data
     except Exception as e:
         print(f"DEBUG: save_history error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"History Save Error: {str(e)}")
 
+def _parse_fields(fields: str | None) -> list | None:
+    return [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
+
 @app.get("/logs")
-def get_logs(user=Depends(get_current_user)):
-    log_file = "chat_logs.jsonl"
-    if not os.path.exists(log_file):
-        return []
-    
-    logs = []
-    with open(log_file, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():
-                try:
-                    logs.append(json.loads(line))
-                except:
-                    continue
-    
-    return logs[::-1][:500]
+def get_logs(
+    since: int | None = Query(None, description="Only entries with id > since (incremental refresh)"),
+    before: int | None = Query(None, description="Only entries with id < before (next page)"),
+    limit: int = Query(100, ge=1, le=500),
+    fields: str | None = Query(None, description="Comma-separated fields to return, e.g. query,latency_ms"),
+    user_email: str | None = None,
+    session_start: str | None = None,
+    min_latency_ms: float | None = None,
+    max_latency_ms: float | None = None,
+    user=Depends(get_current_user)
+):
+    """
+    Paginated interaction logs, newest first. Returns {entries, next_cursor, has_more, latest_id}.
+    Dashboards poll with since=<latest_id> so each refresh only transfers new entries.
+    """
+    return query_logs(
+        since_id=since,
+        before_id=before,
+        limit=limit,
+        fields=_parse_fields(fields),
+        user_email=user_email,
+        session_start=session_start,
+        min_latency_ms=min_latency_ms,
+        max_latency_ms=max_latency_ms
+    )
+
+@app.get("/logs/stream")
+async def stream_logs(
+    request: Request,
+    since: int | None = None,
+    fields: str | None = None,
+    user=Depends(get_current_user)
+):
+    """
+    SSE tail of the interaction log: pushes each new entry as `data: {json}`.
+    Without `since`, starts from the newest entry at connect time.
+    """
+    field_list = _parse_fields(fields)
+
+    async def tail():
+        last_id = since
+        if last_id is None:
+            last_id = (await asyncio.to_thread(query_logs, limit=1))["latest_id"] or 0
+        idle_polls = 0
+        while not await request.is_disconnected():
+            page = await asyncio.to_thread(query_logs, since_id=last_id, limit=100, fields=field_list)
+            # Entries come newest first; send them in chronological order
+            for entry in reversed(page["entries"]):
+                last_id = max(last_id, entry["id"])
+                yield f"data: {json.dumps(entry, ensure_ascii=False)}\n\n"
+            if page["entries"]:
+                idle_polls = 0
+            else:
+                idle_polls += 1
+                if idle_polls % 15 == 0:
+                    yield ": keep-alive\n\n"
+            if not page["has_more"]:
+                await asyncio.sleep(1)
+
+    return StreamingResponse(
+        tail(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/logs/{log_id}")
+def get_log_entry(log_id: int, user=Depends(get_current_user)):
+    entry = get_log(log_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Log entry not found")
+    return entry
+
+def _seeded_metrics():
+    # Include entries logged before this process started (once per process)
+    if not metrics.seeded:
+        metrics.seed(query_logs(limit=MAX_LOGS)["entries"])
+    return metrics
+
+@app.get("/metrics")
+def get_metrics(top: int = Query(10, ge=0, le=100), user=Depends(get_current_user)):
+    """Rolling latency percentiles, rates, no-answer rate, top queries/URLs/chunks, LLM queue and rerank cache state."""
+    return {**_seeded_metrics().snapshot(top_n=top), "llm_admission": llm_scheduler.stats(),
+            "rerank_cache": rerank_score_cache.stats()}
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+def get_prometheus_metrics():
+    """Prometheus scrape endpoint. Aggregate numbers only, so no auth (like /health)."""
+    return PlainTextResponse(
+        _seeded_metrics().prometheus() + llm_scheduler.prometheus(),
+        media_type="text/plain; version=0.0.4"
+    )
 
 @app.get("/health")
 def health():
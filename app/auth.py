@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+import httpx
+import jwt
+
+AUTH_CONFIG = {
+    # Expected "aud" claim of Supabase access tokens
+    "audience": os.environ.get("SUPABASE_JWT_AUDIENCE", "authenticated"),
+    # How often signing keys are re-fetched in the background
+    "jwks_refresh_s": float(os.environ.get("JWKS_REFRESH_S", 600)),
+    # Minimum gap between on-demand refreshes triggered by an unknown key id
+    "jwks_min_refresh_s": float(os.environ.get("JWKS_MIN_REFRESH_S", 30)),
+    # Verified tokens are trusted for this long (never past their exp)
+    "token_cache_ttl_s": float(os.environ.get("AUTH_TOKEN_CACHE_TTL", 60)),
+    "token_cache_size": int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", 10000)),
+}
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256", "EdDSA")
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class AuthenticatedUser:
+    """The fields of a Supabase User that the API reads, built from verified JWT claims."""
+
+    def __init__(self, claims: dict):
+        self.id = claims["sub"]
+        self.email = claims.get("email")
+        self.role = claims.get("role")
+        self.user_metadata = claims.get("user_metadata") or {}
+        self.app_metadata = claims.get("app_metadata") or {}
+
+
+class TokenVerifier:
+    """
+    Verifies Supabase access tokens locally instead of calling the auth service per request.
+
+    Asymmetric tokens are checked against the project's JWKS, which is cached and
+    refreshed in the background (and on demand when a token names an unknown key id).
+    Legacy HS256 tokens are checked with jwt_secret when it is configured. Signature,
+    exp, aud and iss are all enforced; a bad signature or expired token is rejected
+    without a network call.
+
+    Tokens that can't be checked locally (unknown key after a refresh, HS256 without
+    a secret) go to `remote`, the old auth.get_user round trip. Successful results are
+    cached for token_cache_ttl_s, so a revoked session stays usable until then or until
+    the token's own exp, whichever comes first.
+    """
+
+    def __init__(self, supabase_url: str, remote=None, jwt_secret: str = "", jwks_url: str = None,
+                 audience: str = "authenticated", jwks_refresh_s: float = 600, jwks_min_refresh_s: float = 30,
+                 token_cache_ttl_s: float = 60, token_cache_size: int = 10000):
+        self.issuer = f"{supabase_url.rstrip('/')}/auth/v1"
+        self.jwks_url = jwks_url or f"{self.issuer}/.well-known/jwks.json"
+        self.remote = remote
+        self.jwt_secret = jwt_secret
+        self.audience = audience
+        self.jwks_refresh_s = jwks_refresh_s
+        self.jwks_min_refresh_s = jwks_min_refresh_s
+        self.token_cache_ttl_s = token_cache_ttl_s
+        self.token_cache_size = token_cache_size
+        self.keys = {}
+        self.cache_hits = 0
+        self.local = 0
+        self.remote_calls = 0
+        self.rejected = 0
+        self._tokens = OrderedDict()  # sha256(token) -> (user, expires_at)
+        self._last_refresh = 0.0
+        self._refresh_lock = None
+        self._refresher = None
+        self._http = None
+
+    # -------------------------
+    # Signing keys
+    # -------------------------
+    async def refresh(self, force: bool = False):
+        """Re-fetches the JWKS. Without force, skips if the last fetch was under jwks_min_refresh_s ago."""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            if not force and time.monotonic() - self._last_refresh < self.jwks_min_refresh_s:
+                return
+            self._last_refresh = time.monotonic()
+            if self._http is None:
+                self._http = httpx.AsyncClient(timeout=5)
+            try:
+                response = await self._http.get(self.jwks_url)
+                response.raise_for_status()
+                key_set = jwt.PyJWKSet.from_dict(response.json())
+            except Exception as e:
+                # Keep serving with the keys we have; unknown kids fall back to the remote check
+                print(f"JWKS refresh failed: {e}")
+                return
+            self.keys = {key.key_id: key for key in key_set.keys if key.key_id}
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh(force=True)
+            await asyncio.sleep(self.jwks_refresh_s)
+
+    def start(self):
+        """Starts background key refresh on the running event loop (idempotent)."""
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _key_for(self, header: dict):
+        algorithm = header.get("alg")
+        if algorithm == "HS256":
+            return (self.jwt_secret, "HS256") if self.jwt_secret else (None, None)
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise InvalidToken(f"Unsupported token algorithm: {algorithm}")
+        kid = header.get("kid")
+        if kid not in self.keys:
+            await self.refresh()
+        key = self.keys.get(kid)
+        if key is None:
+            return None, None
+        return key.key, key.algorithm_name or algorithm
+
+    # -------------------------
+    # Verified-token cache
+    # -------------------------
+    def _cached(self, digest: str):
+        entry = self._tokens.get(digest)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._tokens[digest]
+            return None
+        self._tokens.move_to_end(digest)
+        return entry[0]
+
+    def _remember(self, digest: str, user, exp: float = None):
+        expires_at = time.time() + self.token_cache_ttl_s
+        if exp is not None:
+            expires_at = min(expires_at, exp)
+        self._tokens[digest] = (user, expires_at)
+        self._tokens.move_to_end(digest)
+        while len(self._tokens) > self.token_cache_size:
+            self._tokens.popitem(last=False)
+
+    # -------------------------
+    # Verification
+    # -------------------------
+    async def verify(self, token: str):
+        """Returns the user for a valid token or raises InvalidToken."""
+        digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        user = self._cached(digest)
+        if user is not None:
+            self.cache_hits += 1
+            return user
+
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError as e:
+            self.rejected += 1
+            raise InvalidToken(str(e))
+
+        try:
+            key, algorithm = await self._key_for(header)
+        except InvalidToken:
+            self.rejected += 1
+            raise
+
+        if key is None:
+            return await self._verify_remote(digest, token)
+
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=[algorithm],
+                audience=self.audience,
+                issuer=self.issuer,
+                options={"require": ["exp", "sub"]},
+            )
+        except jwt.PyJWTError as e:
+            self.rejected += 1
+            raise InvalidToken(str(e))
+
+        self.local += 1
+        user = AuthenticatedUser(claims)
+        self._remember(digest, user, claims["exp"])
+        return user
+
+    async def _verify_remote(self, digest: str, token: str):
+        if self.remote is None:
+            self.rejected += 1
+            raise InvalidToken("No signing key for this token")
+        self.remote_calls += 1
+        user = await self.remote(token)
+        if user is None:
+            self.rejected += 1
+            raise InvalidToken("Invalid or expired session")
+        self._remember(digest, user)
+        return user
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.keys),
+            "cached_tokens": len(self._tokens),
+            "cache_hits": self.cache_hits,
+            "local": self.local,
+            "remote": self.remote_calls,
+            "rejected": self.rejected,
+        }
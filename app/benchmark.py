@@ -0,0 +1,1322 @@
+"""
+Performance benchmarks for the backend.
+
+Run against the local pgvector container, e.g.:
+    python -m app.benchmark pool --requests 500 --concurrency 8
+    python -m app.benchmark crawl --pages 200 --delay-ms 50
+    python -m app.benchmark ann --queries 200 --k 10 --values 10,20,40,80,160
+    python -m app.benchmark fusion --requests 300 --concurrency 8
+    python -m app.benchmark rerank --users 1,8,32 --requests 200
+    python -m app.benchmark stream --users 10,100,300
+    python -m app.benchmark auth --requests 2000 --remote-ms 80
+    python -m app.benchmark ttft --queries 20
+    python -m app.benchmark pages --queries 20 --pages 8
+    python -m app.benchmark eval --mode answer --llm stub --output eval.json
+    python -m app.benchmark eval --adaptive on --baseline eval_results.json
+    python -m app.benchmark backends --requests 500 --concurrency 8
+    python -m app.benchmark quant --queries 100 --rescore 50,100,200,400
+    python -m app.benchmark admission --streams 20 --chats 10 --max-concurrent 2
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(label: str, latencies_ms: list, wall_s: float):
+    print(
+        f"{label:<24} n={len(latencies_ms):<5} "
+        f"p50={percentile(latencies_ms, 50):8.2f}ms  "
+        f"p99={percentile(latencies_ms, 99):8.2f}ms  "
+        f"throughput={len(latencies_ms) / wall_s:8.1f}/s"
+    )
+
+
+def run_concurrent(fn, requests: int, concurrency: int):
+    """Calls fn() `requests` times across `concurrency` threads; returns (latencies_ms, wall_s)."""
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(requests)))
+    return latencies, time.perf_counter() - start
+
+
+def random_vector_str(dim: int = 768) -> str:
+    return "[" + ",".join(f"{random.uniform(-1, 1):.6f}" for _ in range(dim)) + "]"
+
+
+# -------------------------
+# Connection pool benchmark
+# -------------------------
+def bench_pool(args):
+    """
+    Compares the SQL part of search_similar_documents with a fresh connection per
+    query and plain statements (the old behaviour) against the shared pool with
+    prepared statements. A random query vector is used so Ollama and FlashRank are not involved.
+    """
+    from app.database import (PREPARED_STATEMENTS, get_connection, pooled_connection, fetch_candidates,
+                              set_vector_search_params, close_pool)
+
+    query = "What AI platform does AlphaWave build?"
+    limit = 40
+
+    def execute_plain(cursor, name: str, params: tuple):
+        # Same SQL as the prepared statement, sent as a one-off query ($n -> named params)
+        sql = re.sub(r"\$(\d+)", r"%(p\1)s", PREPARED_STATEMENTS[name])
+        cursor.execute(sql, {f"p{i}": value for i, value in enumerate(params, 1)})
+        return cursor.fetchall()
+
+    def unpooled():
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            set_vector_search_params(cursor)
+            execute_plain(cursor, "vector_search", (random_vector_str(), limit))
+            execute_plain(cursor, "keyword_search", (query, limit))
+            cursor.close()
+        finally:
+            conn.close()
+
+    def pooled():
+        with pooled_connection() as conn:
+            fetch_candidates(conn, random_vector_str(), query, limit)
+
+    # Warm up the pool so first-connect cost is not counted
+    for _ in range(args.concurrency):
+        pooled()
+
+    summarize("search (no pool)", *run_concurrent(unpooled, args.requests, args.concurrency))
+    summarize("search (pool)", *run_concurrent(pooled, args.requests, args.concurrency))
+    close_pool()
+
+
+# -------------------------
+# Crawler benchmark (local fixture site)
+# -------------------------
+def start_fixture_site(pages: int, delay_ms: float, links_per_page: int = 5):
+    """
+    Serves a synthetic site on 127.0.0.1 in a background thread. Page i links to the
+    nav pages plus a few pseudo-random others, and every response is delayed by
+    delay_ms to mimic network latency. Returns (server, base_url).
+    """
+    def render(i: int) -> bytes:
+        rng = random.Random(i)
+        targets = {rng.randrange(pages) for _ in range(links_per_page)}
+        links = "".join(f'<a href="/page/{t}">Page {t}</a>' for t in sorted(targets))
+        nav = "".join(f'<a href="/page/{t}">Nav {t}</a>' for t in range(min(3, pages)))
+        body = " ".join(f"Fixture paragraph {i}.{p} about AlphaWave services." for p in range(40))
+        return (
+            f"<html><head><title>Fixture {i}</title></head><body>"
+            f"<nav>{nav}</nav><main><h1>Fixture {i}</h1><p>{body}</p>{links}</main>"
+            f"</body></html>"
+        ).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay_ms / 1000)
+            path = self.path.rstrip("/")
+            index = 0 if path == "" else int(path.rsplit("/", 1)[-1]) if path.startswith("/page/") else -1
+            if not 0 <= index < pages:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            payload = render(index)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def bench_crawl(args):
+    """
+    Crawls the fixture site with the old serial loop (each page fetched twice) and
+    with AsyncCrawler, reporting wall-time and pages/sec. Nothing is ingested.
+    """
+    import requests
+    from bs4 import BeautifulSoup
+    from app.crawler import AsyncCrawler
+    from app.scraper import scrape_page, extract_internal_links
+
+    server, base_url = start_fixture_site(args.pages, args.delay_ms)
+    try:
+        start = time.perf_counter()
+        visited, to_visit = set(), [base_url]
+        while to_visit and len(visited) < args.pages:
+            url = to_visit.pop(0)
+            if url in visited:
+                continue
+            visited.add(url)
+            scrape_page(url)
+            soup = BeautifulSoup(requests.get(url).text, "html.parser")
+            to_visit.extend(link for link in extract_internal_links(soup, base_url) if link not in visited)
+        serial_s = time.perf_counter() - start
+        print(f"{'serial crawl':<24} pages={len(visited):<5} wall={serial_s:7.2f}s  "
+              f"{len(visited) / serial_s:8.1f} pages/s")
+
+        crawler = AsyncCrawler(base_url, max_pages=args.pages, concurrency=args.concurrency,
+                               per_host=args.per_host)
+        start = time.perf_counter()
+        crawled = asyncio.run(crawler.crawl())
+        async_s = time.perf_counter() - start
+        print(f"{'async crawl':<24} pages={crawled:<5} wall={async_s:7.2f}s  "
+              f"{crawled / async_s:8.1f} pages/s")
+    finally:
+        server.shutdown()
+
+
+# -------------------------
+# ANN recall / latency benchmark
+# -------------------------
+def bench_ann(args):
+    """
+    recall@k and latency of the pgvector ANN index against exact search, for each
+    ef_search (HNSW) or probes (IVFFlat) value. Queries are stored chunk embeddings
+    with Gaussian noise added, so they behave like unseen questions.
+    """
+    from app.database import pooled_connection, set_vector_search_params, close_pool
+    from app.schema import VECTOR_INDEX_NAME
+
+    vector_sql = "SELECT id FROM documents WHERE embedding IS NOT NULL ORDER BY embedding <=> %s LIMIT %s;"
+
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s;", (VECTOR_INDEX_NAME,))
+        row = cursor.fetchone()
+        method = "ivfflat" if row and "ivfflat" in row["indexdef"].lower() else "hnsw"
+        if row is None:
+            print("No vector index found - run python -m app.schema first. Measuring exact search only.")
+
+        cursor.execute(
+            "SELECT embedding::text AS v FROM documents WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s;",
+            (args.queries,)
+        )
+        queries = []
+        for r in cursor.fetchall():
+            values = [float(x) for x in r["v"].strip("[]").split(",")]
+            queries.append("[" + ",".join(str(x + random.gauss(0, args.noise)) for x in values) + "]")
+
+        # Ground truth: exact scan with index use disabled
+        exact, exact_ms = [], []
+        for q in queries:
+            cursor.execute("SET LOCAL enable_indexscan = off;")
+            start = time.perf_counter()
+            cursor.execute(vector_sql, (q, args.k))
+            exact.append({r["id"] for r in cursor.fetchall()})
+            exact_ms.append((time.perf_counter() - start) * 1000)
+            conn.commit()
+        summarize("exact", exact_ms, sum(exact_ms) / 1000)
+
+        knob = "ef_search" if method == "hnsw" else "probes"
+        for value in [int(v) for v in args.values.split(",")]:
+            latencies, hits = [], 0
+            for q, truth in zip(queries, exact):
+                set_vector_search_params(cursor, **{knob: value})
+                start = time.perf_counter()
+                cursor.execute(vector_sql, (q, args.k))
+                found = {r["id"] for r in cursor.fetchall()}
+                latencies.append((time.perf_counter() - start) * 1000)
+                hits += len(found & truth)
+                conn.commit()
+            recall = hits / max(1, sum(len(t) for t in exact))
+            summarize(f"{method} {knob}={value}", latencies, sum(latencies) / 1000)
+            print(f"{'':<24} recall@{args.k}={recall:.4f}")
+        cursor.close()
+    close_pool()
+
+
+# -------------------------
+# Python-side vs SQL-side fusion benchmark
+# -------------------------
+def payload_bytes(rows: list) -> int:
+    """Rough size of what came back over the wire: the text form of every value."""
+    return sum(len(str(value)) for row in rows for value in row.values())
+
+
+def bench_fusion(args):
+    """
+    Old path (two queries, 80 full rows, RRF + URL cap in Python) versus the
+    single fused_search statement. Reports latency, rows/bytes fetched per query,
+    and how often both paths pick the same candidate set.
+    """
+    from app.database import pooled_connection, fetch_candidates, fetch_fused_candidates, rrf_fuse, close_pool
+
+    queries = [
+        "Where is AlphaWave located?",
+        "What AI development services do you offer?",
+        "What is the DPP-Compliant Asset Management Platform?",
+        "Tell me about the UNIRI Sports Center AI Assistant",
+        "How can I contact AlphaWave?",
+    ]
+    vectors = [random_vector_str() for _ in queries]
+    stats = {"old": [0, 0], "new": [0, 0]}  # rows, bytes
+    same = [0, 0]
+
+    def old_path(i):
+        with pooled_connection() as conn:
+            vector_results, keyword_results = fetch_candidates(conn, vectors[i], queries[i])
+        stats["old"][0] += len(vector_results) + len(keyword_results)
+        stats["old"][1] += payload_bytes(vector_results) + payload_bytes(keyword_results)
+        return rrf_fuse(vector_results, keyword_results)
+
+    def new_path(i):
+        with pooled_connection() as conn:
+            candidates = fetch_fused_candidates(conn, vectors[i], queries[i], top_pages=0)
+        stats["new"][0] += len(candidates)
+        stats["new"][1] += payload_bytes(candidates)
+        return candidates
+
+    for i in range(len(queries)):
+        same[0] += {d["id"] for d in old_path(i)} == {d["id"] for d in new_path(i)}
+        same[1] += 1
+    stats = {"old": [0, 0], "new": [0, 0]}
+
+    for label, fn in (("old", old_path), ("new", new_path)):
+        latencies, wall = run_concurrent(lambda: fn(random.randrange(len(queries))), args.requests, args.concurrency)
+        summarize(f"{label} ({'2 queries + python' if label == 'old' else 'fused sql'})", latencies, wall)
+        print(f"{'':<24} rows/query={stats[label][0] / args.requests:6.1f}  "
+              f"bytes/query={stats[label][1] / args.requests:9.0f}")
+    print(f"identical candidate sets: {same[0]}/{same[1]} queries")
+    close_pool()
+
+
+# -------------------------
+# Reranker load benchmark
+# -------------------------
+def bench_rerank(args):
+    """
+    Rerank throughput at several concurrency levels: one shared in-thread FlashRank
+    Ranker (the old behaviour) versus the micro-batching RerankService.
+    Each request reranks 20 passages, like search_similar_documents.
+    """
+    from flashrank import Ranker, RerankRequest
+    from app.reranker import RerankService, RERANK_CONFIG, RERANK_MODEL, RERANK_CACHE_DIR
+
+    rng = random.Random(0)
+    words = ("alphawave ai platform rag assistant edge intelligence web 3d cloud privacy "
+             "contact zagreb consulting frontend backend scalable secure local model").split()
+    passages = [" ".join(rng.choice(words) for _ in range(120)) for _ in range(200)]
+    queries = ["Where is AlphaWave located?", "What AI services do you offer?", "Do you build 3D websites?"]
+
+    def make_request():
+        return rng.choice(queries), [{"id": i, "text": t} for i, t in enumerate(rng.sample(passages, 20))]
+
+    direct = Ranker(model_name=RERANK_MODEL, cache_dir=RERANK_CACHE_DIR)
+    config = dict(RERANK_CONFIG)
+    if args.max_wait_ms is not None:
+        config["max_wait_ms"] = args.max_wait_ms
+    service = RerankService(**config)
+    service.rerank(*make_request())  # start workers and load the model before timing
+
+    for users in [int(u) for u in args.users.split(",")]:
+        def old():
+            query, items = make_request()
+            direct.rerank(RerankRequest(query=query, passages=items))
+
+        def new():
+            service.rerank(*make_request())
+
+        before = service.stats()
+        summarize(f"in-thread  users={users}", *run_concurrent(old, args.requests, users))
+        summarize(f"service    users={users}", *run_concurrent(new, args.requests, users))
+        after = service.stats()
+        batches = after["batches"] - before["batches"]
+        print(f"{'':<24} avg requests/batch={(after['requests'] - before['requests']) / max(1, batches):.1f}")
+    service.shutdown()
+
+
+# -------------------------
+# SSE streaming load test
+# -------------------------
+def start_stand_in_api(history_ms: float, retrieval_ms: float, ttft_ms: float, tokens: int, token_ms: float):
+    """
+    Serves two stand-ins for /chat/stream with uvicorn in a background thread, using
+    sleeps for Supabase, retrieval and Ollama so only the serving model differs:
+      /sync  - the old shape: def endpoint, serial history fetch, sync token generator
+      /async - the new shape: async endpoint, history concurrent with retrieval, async generator
+    Returns (server, base_url).
+    """
+    import socket
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import StreamingResponse
+
+    stand_in = FastAPI()
+
+    def sync_tokens():
+        time.sleep(retrieval_ms / 1000)
+        time.sleep(ttft_ms / 1000)
+        for i in range(tokens):
+            yield f"data: token{i}\n\n"
+            time.sleep(token_ms / 1000)
+        yield "data: [DONE]\n\n"
+
+    async def async_tokens(history):
+        await asyncio.gather(asyncio.sleep(retrieval_ms / 1000), history)
+        await asyncio.sleep(ttft_ms / 1000)
+        for i in range(tokens):
+            yield f"data: token{i}\n\n"
+            await asyncio.sleep(token_ms / 1000)
+        yield "data: [DONE]\n\n"
+
+    @stand_in.post("/sync")
+    def sync_stream():
+        time.sleep(history_ms / 1000)
+        return StreamingResponse(sync_tokens(), media_type="text/event-stream")
+
+    @stand_in.post("/async")
+    async def async_stream():
+        history = asyncio.create_task(asyncio.sleep(history_ms / 1000))
+        return StreamingResponse(async_tokens(history), media_type="text/event-stream")
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = uvicorn.Server(uvicorn.Config(stand_in, host="127.0.0.1", port=port, log_level="warning",
+                                           backlog=4096, limit_concurrency=10000))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def run_streams(url: str, users: int, payload: dict = None, headers: dict = None):
+    """Opens `users` SSE streams at once; returns (ttft_ms, total_ms, wall_s, errors)."""
+    import aiohttp
+
+    ttfts, totals, errors = [], [], 0
+
+    async def one(session):
+        nonlocal errors
+        start = time.perf_counter()
+        first = None
+        try:
+            async with session.post(url, json=payload or {}, headers=headers) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    if first is None and line.startswith(b"data:"):
+                        first = time.perf_counter()
+            ttfts.append(((first or time.perf_counter()) - start) * 1000)
+            totals.append((time.perf_counter() - start) * 1000)
+        except Exception:
+            errors += 1
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(session) for _ in range(users)))
+        return ttfts, totals, time.perf_counter() - start, errors
+
+
+def report_streams(label: str, ttfts: list, totals: list, wall_s: float, errors: int):
+    print(
+        f"{label:<24} ok={len(totals):<5} err={errors:<4} "
+        f"ttft p50={percentile(ttfts, 50):8.0f}ms p99={percentile(ttfts, 99):8.0f}ms  "
+        f"total p50={percentile(totals, 50):8.0f}ms p99={percentile(totals, 99):8.0f}ms  "
+        f"wall={wall_s:6.2f}s"
+    )
+
+
+def bench_stream(args):
+    """
+    Concurrent SSE streams. With --url/--token, load-tests a running /chat/stream
+    (every stream reaches Ollama, so expect the LLM to be the limit). Without, compares
+    the old sync serving model with the async one on a stand-in API whose backends are
+    sleeps, showing how many simultaneous streams one process holds.
+    """
+    users_list = [int(u) for u in args.users.split(",")]
+    if args.url:
+        headers = {"Authorization": f"Bearer {args.token}"} if args.token else None
+        for users in users_list:
+            report_streams(f"chat/stream users={users}",
+                           *asyncio.run(run_streams(args.url, users, {"question": args.question}, headers)))
+        return
+
+    server, base_url = start_stand_in_api(args.history_ms, args.retrieval_ms, args.ttft_ms,
+                                          args.tokens, args.token_ms)
+    try:
+        for users in users_list:
+            report_streams(f"sync   users={users}", *asyncio.run(run_streams(f"{base_url}/sync", users)))
+            report_streams(f"async  users={users}", *asyncio.run(run_streams(f"{base_url}/async", users)))
+    finally:
+        server.should_exit = True
+
+
+# -------------------------
+# Token verification benchmark (stand-in JWKS server)
+# -------------------------
+def start_jwks_server(jwks: dict):
+    """Serves `jwks` at /auth/v1/.well-known/jwks.json on 127.0.0.1. Returns (server, base_url)."""
+    import json
+
+    payload = json.dumps(jwks).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        fetches = 0
+
+        def do_GET(self):
+            Handler.fetches += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.handler = Handler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def bench_auth(args):
+    """
+    Per-request auth cost: the remote auth.get_user round trip (simulated with
+    --remote-ms of latency) versus TokenVerifier with a stand-in JWKS server, for
+    first-seen tokens and repeat tokens. Also checks that forged, expired and
+    wrong-audience tokens are rejected locally and unknown key ids fall back to remote.
+    """
+    import json
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from app.auth import AuthenticatedUser, InvalidToken, TokenVerifier
+
+    signing_key = ec.generate_private_key(ec.SECP256R1())
+    public_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(signing_key.public_key()))
+    public_jwk.update({"kid": "bench-key", "alg": "ES256", "use": "sig"})
+    server, base_url = start_jwks_server({"keys": [public_jwk]})
+    issuer = f"{base_url}/auth/v1"
+
+    def issue(sub: str, kid: str = "bench-key", key=signing_key, ttl: int = 3600, aud: str = "authenticated"):
+        claims = {"sub": sub, "email": f"{sub}@example.com", "aud": aud, "iss": issuer,
+                  "exp": int(time.time()) + ttl, "role": "authenticated",
+                  "user_metadata": {"full_name": sub}}
+        return jwt.encode(claims, key, algorithm="ES256", headers={"kid": kid})
+
+    async def remote(token):
+        await asyncio.sleep(args.remote_ms / 1000)
+        return AuthenticatedUser(jwt.decode(token, options={"verify_signature": False}))
+
+    async def run():
+        verifier = TokenVerifier(base_url, remote=remote)
+        await verifier.refresh(force=True)
+        tokens = [issue(f"user{i}") for i in range(args.users)]
+
+        async def timed(fn, token):
+            start = time.perf_counter()
+            await fn(token)
+            return (time.perf_counter() - start) * 1000
+
+        async def measure(label, fn, batch):
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*(timed(fn, t) for t in batch))
+            summarize(label, list(latencies), time.perf_counter() - start)
+
+        batch = [tokens[i % len(tokens)] for i in range(args.requests)]
+        await measure("remote get_user", remote, batch)
+        await measure("local, first sight", verifier.verify, tokens)
+        await measure("local, cached", verifier.verify, batch)
+
+        forged = issue("mallory", key=ec.generate_private_key(ec.SECP256R1()))
+        for label, token in [("forged signature", forged), ("expired", issue("old", ttl=-10)),
+                             ("wrong audience", issue("svc", aud="service"))]:
+            try:
+                await verifier.verify(token)
+                print(f"{label:<24} ACCEPTED (unexpected)")
+            except InvalidToken as e:
+                print(f"{label:<24} rejected locally: {e}")
+        user = await verifier.verify(issue("rotated", kid="new-key"))
+        print(f"{'unknown key id':<24} verified by remote fallback as {user.email}")
+        print(f"{'':<24} {verifier.stats()}  jwks fetches={server.handler.fetches}")
+        await verifier.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+
+
+# -------------------------
+# Context packing: time-to-first-token
+# -------------------------
+SAMPLE_QUESTIONS = [
+    "What services does AlphaWave offer?",
+    "Where is AlphaWave located?",
+    "What is the DPP-Compliant Asset Management Platform?",
+    "Do you build 3D websites?",
+    "How can I contact the team?",
+    "What AI consulting do you provide?",
+]
+
+
+def bench_ttft(args):
+    """
+    Ollama time-to-first-token with the old plain "\n\n".join of the retrieved chunks
+    versus the packed context (merged neighbours, overlap removed, token budget), on
+    the same chunks. The two variants alternate order per question so Ollama's prompt
+    cache favours neither. Needs Postgres and Ollama.
+    """
+    from app.chunking import estimate_tokens
+    from app.context import build_context, context_budget
+    from app.database import search_similar_documents, close_pool
+    from app.logger import read_logs
+    from app.rag import chain, normalize_question, RAG_PROMPT, LLM_NUM_CTX
+
+    logged = list(dict.fromkeys(e["query"] for e in read_logs() if e.get("query")))
+    questions = (logged or SAMPLE_QUESTIONS)[:args.queries]
+
+    def first_token_ms(context: str, question: str) -> float:
+        start = time.perf_counter()
+        for chunk in chain.stream({"context": context, "chat_history": "", "question": question}):
+            if chunk:
+                break
+        return (time.perf_counter() - start) * 1000
+
+    ttfts = {"plain": [], "packed": []}
+    tokens = {"plain": [], "packed": []}
+    for i, question in enumerate(questions):
+        question = normalize_question(question)
+        results = search_similar_documents(question, limit=args.limit)
+        if not results:
+            continue
+        budget = context_budget(LLM_NUM_CTX, RAG_PROMPT.template, question)
+        variants = {
+            "plain": "\n\n".join(r["content"] for r in results),
+            "packed": build_context(results, budget)[0],
+        }
+        for name in (["plain", "packed"] if i % 2 == 0 else ["packed", "plain"]):
+            tokens[name].append(estimate_tokens(variants[name]))
+            ttfts[name].append(first_token_ms(variants[name], question))
+
+    for name in ("plain", "packed"):
+        avg_tokens = sum(tokens[name]) / max(1, len(tokens[name]))
+        print(f"{name + ' context':<24} n={len(ttfts[name]):<5} ~tokens={avg_tokens:7.0f}  "
+              f"ttft p50={percentile(ttfts[name], 50):8.0f}ms  p99={percentile(ttfts[name], 99):8.0f}ms")
+    close_pool()
+
+
+def bench_pages(args):
+    """
+    Flat fused search over every chunk versus the two-level search (top pages by
+    summary embedding, then their chunks). Reports retrieval SQL and rerank latency,
+    passages reranked per query, and how many of the flat top-k chunks the two-level
+    path also returns. Needs Postgres and Ollama (real query embeddings).
+    """
+    from app.database import (pooled_connection, fetch_fused_candidates, rerank_candidates,
+                              to_vector_str, close_pool)
+    from app.embeddings import generate_embedding
+    from app.logger import read_logs
+
+    logged = list(dict.fromkeys(e["query"] for e in read_logs() if e.get("query")))
+    questions = (logged or SAMPLE_QUESTIONS)[:args.queries]
+    vectors = [to_vector_str(generate_embedding(q)) for q in questions]
+
+    sql_ms = {"flat": [], "two-level": []}
+    rerank_ms = {"flat": [], "two-level": []}
+    passages = {"flat": [], "two-level": []}
+    overlap = []
+    for question, vector_str in zip(questions, vectors):
+        top = {}
+        for label, pages in (("flat", 0), ("two-level", args.pages)):
+            start = time.perf_counter()
+            with pooled_connection() as conn:
+                candidates = fetch_fused_candidates(conn, vector_str, question, top_pages=pages)
+            sql_ms[label].append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            results = rerank_candidates(question, candidates, args.k) if candidates else []
+            rerank_ms[label].append((time.perf_counter() - start) * 1000)
+            passages[label].append(len(candidates))
+            top[label] = {doc["id"] for doc in results}
+        if top["flat"]:
+            overlap.append(len(top["flat"] & top["two-level"]) / len(top["flat"]))
+
+    for label in ("flat", "two-level"):
+        print(f"{label:<12} sql p50={percentile(sql_ms[label], 50):7.1f}ms  "
+              f"rerank p50={percentile(rerank_ms[label], 50):7.1f}ms  "
+              f"passages/query={sum(passages[label]) / max(1, len(questions)):5.1f}")
+    print(f"top-{args.k} overlap with flat search: {100 * sum(overlap) / max(1, len(overlap)):.0f}%")
+    close_pool()
+
+
+def bench_backends(args):
+    """
+    Candidate retrieval (both legs + RRF, no rerank) from Postgres versus the embedded
+    memory-mapped store, on the same query embeddings. Reports latency and how many
+    of the Postgres candidates the store also returns. Build the store first
+    (python -m app.vector_store build).
+    """
+    from app.database import CANDIDATES_PER_LEG, RRF_K, get_retrieval_backend, close_pool
+    from app.embeddings import generate_embedding
+    from app.logger import read_logs
+
+    logged = list(dict.fromkeys(e["query"] for e in read_logs() if e.get("query")))
+    questions = (logged or SAMPLE_QUESTIONS)[:args.queries]
+    embeddings = [generate_embedding(q) for q in questions]
+    backends = {name: get_retrieval_backend(name) for name in ("postgres", "mmap")}
+
+    def run(name: str, i: int) -> list:
+        # Flat search on both sides: the store has no page-level pass
+        return backends[name].candidates(embeddings[i], questions[i], CANDIDATES_PER_LEG, RRF_K, top_pages=0)
+
+    overlap = []
+    for i in range(len(questions)):
+        postgres_ids = {d["id"] for d in run("postgres", i)}
+        mmap_ids = {d["id"] for d in run("mmap", i)}
+        if postgres_ids:
+            overlap.append(len(postgres_ids & mmap_ids) / len(postgres_ids))
+
+    for name in backends:
+        latencies, wall = run_concurrent(lambda: run(name, random.randrange(len(questions))),
+                                         args.requests, args.concurrency)
+        summarize(f"{name} candidates", latencies, wall)
+    print(f"candidate overlap with postgres: {100 * sum(overlap) / max(1, len(overlap)):.0f}% "
+          f"(keyword legs differ: Postgres stems, the store uses BM25 on plain tokens)")
+    print(f"store: {backends['mmap'].stats()}")
+    close_pool()
+
+
+def bench_quant(args):
+    """
+    recall@k of quantized first-pass search + exact rescoring against the exact <=>
+    ordering, for each shortlist size: Postgres halfvec / binary_quantize expressions,
+    and the memory-mapped store's int8 / binary codes (if a store has been built).
+    Also reports bytes per vector of each representation and the ANN index size.
+    With VECTOR_QUANTIZATION set, the statement the API serves (as picked by
+    _fused_statement for --top-pages) is compared with its exact form as well.
+    """
+    from app.database import (EMBEDDING_DIM, QUANTIZED_DISTANCE, VECTOR_SEARCH_CONFIG, TWO_LEVEL_CONFIG,
+                              RRF_K, MAX_CHUNKS_PER_URL, _fused_statement, _search_ef, execute_prepared,
+                              set_vector_search_params, pooled_connection, close_pool)
+    from app.schema import VECTOR_INDEX_NAME
+
+    exact_sql = "SELECT id FROM documents WHERE embedding IS NOT NULL ORDER BY embedding <=> %(q)s::vector LIMIT %(k)s;"
+    rescored_sql = """
+        SELECT id FROM (
+            SELECT id, embedding FROM documents WHERE embedding IS NOT NULL
+            ORDER BY {distance} LIMIT %(rescore)s
+        ) shortlist
+        ORDER BY embedding <=> %(q)s::vector LIMIT %(k)s;
+    """
+    rescore_values = [int(v) for v in args.rescore.split(",")]
+
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT embedding::text AS v, title FROM documents WHERE embedding IS NOT NULL ORDER BY random() LIMIT %s;",
+            (args.queries,)
+        )
+        queries, texts = [], []
+        for r in cursor.fetchall():
+            values = [float(x) for x in r["v"].strip("[]").split(",")]
+            queries.append([x + random.gauss(0, args.noise) for x in values])
+            texts.append(r["title"] or "")
+        query_strs = ["[" + ",".join(map(str, q)) + "]" for q in queries]
+
+        cursor.execute(f"""
+            SELECT avg(pg_column_size(embedding)) AS vector,
+                   avg(pg_column_size(embedding::halfvec({EMBEDDING_DIM}))) AS halfvec,
+                   avg(pg_column_size(binary_quantize(embedding)::bit({EMBEDDING_DIM}))) AS binary,
+                   pg_relation_size(to_regclass(%s)) AS index_bytes
+            FROM documents WHERE embedding IS NOT NULL;
+        """, (VECTOR_INDEX_NAME,))
+        sizes = cursor.fetchone()
+        print(f"bytes/vector: vector={sizes['vector']:.0f} halfvec={sizes['halfvec']:.0f} "
+              f"binary={sizes['binary']:.0f}; {VECTOR_INDEX_NAME}={(sizes['index_bytes'] or 0) / 1e6:.1f} MB")
+
+        exact, exact_ms = [], []
+        for q in query_strs:
+            cursor.execute("SET LOCAL enable_indexscan = off;")
+            start = time.perf_counter()
+            cursor.execute(exact_sql, {"q": q, "k": args.k})
+            exact.append({r["id"] for r in cursor.fetchall()})
+            exact_ms.append((time.perf_counter() - start) * 1000)
+            conn.commit()
+        summarize("postgres exact", exact_ms, sum(exact_ms) / 1000)
+
+        # Only the expression of the configured VECTOR_QUANTIZATION is indexed; the
+        # other one is a sequential scan, so compare its recall rather than its latency
+        for mode, distance in QUANTIZED_DISTANCE.items():
+            sql = rescored_sql.format(distance=distance.replace("$1", "%(q)s"))
+            for rescore in rescore_values:
+                latencies, hits = [], 0
+                for q, truth in zip(query_strs, exact):
+                    start = time.perf_counter()
+                    cursor.execute(sql, {"q": q, "k": args.k, "rescore": max(rescore, args.k)})
+                    hits += len({r["id"] for r in cursor.fetchall()} & truth)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                conn.commit()
+                summarize(f"postgres {mode} R={rescore}", latencies, sum(latencies) / 1000)
+                print(f"{'':<24} recall@{args.k}={hits / max(1, sum(len(t) for t in exact)):.4f}")
+
+        # The served statement end to end (both legs, RRF, per-URL cap), against the
+        # same statement with the exact vector leg
+        quantization = VECTOR_SEARCH_CONFIG["quantization"]
+        pages = TWO_LEVEL_CONFIG["pages"] if args.top_pages is None else args.top_pages
+        if quantization in QUANTIZED_DISTANCE:
+            def served(q, text, rescore=None, exact=False):
+                name, params = _fused_statement(q, text, 40, RRF_K, args.k, MAX_CHUNKS_PER_URL,
+                                                pages, rescore)
+                if exact:
+                    name, params = name.removesuffix("_rescored"), params[:-1]
+                # as fetch_fused_candidates, with HNSW returning the whole flat shortlist
+                set_vector_search_params(cursor, max(_search_ef(None, pages), 0 if pages else params[-1]))
+                execute_prepared(conn, cursor, name, params)
+                ids = [r["id"] for r in cursor.fetchall()]
+                conn.commit()
+                return name, set(ids)
+
+            served_truth = [served(q, t, exact=True)[1] for q, t in zip(query_strs, texts)]
+            for rescore in rescore_values:
+                latencies, hits = [], 0
+                for q, t, truth in zip(query_strs, texts, served_truth):
+                    start = time.perf_counter()
+                    name, found = served(q, t, rescore)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    hits += len(found & truth)
+                summarize(f"{name} R={rescore}", latencies, sum(latencies) / 1000)
+                print(f"{'':<24} recall@{args.k}={hits / max(1, sum(len(t) for t in served_truth)):.4f} "
+                      f"({quantization}, pages={pages})")
+        else:
+            print("Skipping the served statement: VECTOR_QUANTIZATION is none")
+        cursor.close()
+    close_pool()
+
+    from app.vector_store import MmapBackend
+    store = MmapBackend().current()
+    if store is None:
+        print("Skipping the vector store: none built (python -m app.vector_store build)")
+        return
+    truth = [{d["id"] for d in store.exact_search(q, args.k)} for q in queries]
+    for mode in ("none", "int8", "binary"):
+        store.quantize(mode)
+        for rescore in rescore_values if mode != "none" else [0]:
+            latencies, hits = [], 0
+            for q, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found = store.vector_search(q, args.k, rescore)
+                latencies.append((time.perf_counter() - start) * 1000)
+                hits += len({d["id"] for d in found} & expected)
+            label = f"store {mode}" + (f" R={rescore}" if mode != "none" else "")
+            summarize(label, latencies, sum(latencies) / 1000)
+            print(f"{'':<24} recall@{args.k}={hits / max(1, sum(len(t) for t in truth)):.4f} "
+                  f"bytes/vector={store.index_bytes / max(1, len(store)):.0f}")
+
+
+# -------------------------
+# Offline retrieval / answer evaluation
+# -------------------------
+def load_eval_set(path: str = None) -> list[dict]:
+    """
+    Eval items {query, relevant_urls, source}, one per distinct query.
+
+    A JSONL file may hold labelled items ({"query": ..., "relevant_urls": [...]}) or
+    interaction log entries (the chat_logs.jsonl format). Without a file the
+    interaction log is replayed. For log entries the URLs retrieved when the entry
+    was logged count as relevant, so recall/MRR then measure drift from what the
+    logged configuration returned rather than true relevance.
+    """
+    from app.logger import read_logs
+    from app.rag import normalize_question
+
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    else:
+        entries = read_logs()
+
+    items, seen = [], set()
+    for entry in entries:
+        query = entry.get("query")
+        if not query or normalize_question(query).lower() in seen:
+            continue
+        if "relevant_urls" in entry:
+            relevant, source = entry["relevant_urls"], "labelled"
+        else:
+            relevant = [c["url"] for c in entry.get("retrieved_chunks") or [] if c.get("url")]
+            source = "logged"
+        if not relevant:
+            continue
+        seen.add(normalize_question(query).lower())
+        items.append({"query": query, "relevant_urls": list(dict.fromkeys(relevant)), "source": source})
+    return items
+
+
+def ranked_urls(results: list) -> list:
+    """Distinct result URLs in rank order; neighbour expansions don't count as hits of their own."""
+    return list(dict.fromkeys(r["url"] for r in results if r.get("url") and "neighbour_of" not in r))
+
+
+def retrieval_quality(urls: list, relevant: list, ks: list) -> dict:
+    """recall@k for each k and reciprocal rank of the first relevant URL."""
+    relevant = set(relevant)
+    scores = {f"recall@{k}": len(relevant & set(urls[:k])) / len(relevant) for k in ks}
+    scores["rr"] = next((1 / (i + 1) for i, url in enumerate(urls) if url in relevant), 0.0)
+    return scores
+
+
+class StubChain:
+    """
+    Stand-in for the LCEL chain (rag.chain): sleeps for a fixed time-to-first-token
+    and per-token delay, then returns a canned answer. Keeps the LLM out of
+    retrieval/latency regressions while exercising the rest of generate_answer.
+    """
+
+    def __init__(self, ttft_ms: float, tokens: int, token_ms: float):
+        self.ttft_ms = ttft_ms
+        self.tokens = tokens
+        self.token_ms = token_ms
+
+    def stream(self, inputs: dict):
+        time.sleep(self.ttft_ms / 1000)
+        for i in range(self.tokens):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            yield f"tok{i} "
+
+    def invoke(self, inputs: dict) -> str:
+        return "".join(self.stream(inputs))
+
+    async def astream(self, inputs: dict):
+        await asyncio.sleep(self.ttft_ms / 1000)
+        for i in range(self.tokens):
+            if i:
+                await asyncio.sleep(self.token_ms / 1000)
+            yield f"tok{i} "
+
+
+def bench_admission(args):
+    """
+    LLM admission control against a fake slow LLM: fires --streams stream_answer and
+    --chats generate_answer calls at once through a scheduler with the given limits.
+    Retrieval, embeddings, the answer cache and logging are stubbed, so only the LLM
+    queue is measured. Reports served / 429 / 503 per priority, time to first token,
+    and the queue positions shown to streams. Needs no database or Ollama.
+    """
+    from app import rag
+    from app.admission import AdmissionRejected, LLMScheduler
+    from app.answer_cache import AnswerCache
+
+    doc = {"id": 1, "url": "https://example.com/stub", "title": "Stub", "content": "Stub context.", "rrf_score": 1.0}
+
+    async def asearch(question: str, limit: int = 5) -> list:
+        return [dict(doc)]
+
+    async def aembed(text: str) -> list:
+        return [1.0]
+
+    rag.chain = StubChain(args.ttft_ms, args.tokens, args.token_ms)
+    rag.llm_scheduler = LLMScheduler(args.max_concurrent, args.max_queue, args.max_wait_s)
+    rag.asearch_similar_documents = asearch
+    rag.search_similar_documents = lambda question, limit=5: [dict(doc)]
+    rag.agenerate_embedding = aembed
+    rag.generate_embedding = lambda text: [1.0]
+    rag.answer_cache = AnswerCache(max_entries=1, threshold=1.01)  # never hits
+    rag.log_interaction = lambda **kwargs: None
+    rag.COALESCE_CONFIG["enabled"] = False  # every request is its own LLM call
+
+    outcomes = {"stream": [], "chat": []}
+    positions = []
+
+    async def stream(i: int):
+        start = time.perf_counter()
+        first, outcome = None, "served"
+        try:
+            rag.admission_check(f"stream question {i}")
+        except AdmissionRejected as e:
+            outcomes["stream"].append((str(e.status_code), 0.0))
+            return
+        async for event in rag.stream_answer(f"stream question {i}"):
+            if event.startswith("data: [QUEUED]"):
+                positions.append(json.loads(event[len("data: [QUEUED]"):])["position"])
+            elif event.startswith("data: [BUSY]"):
+                outcome = str(json.loads(event[len("data: [BUSY]"):])["status"])
+            elif first is None and not event.startswith("data: [DONE]"):
+                first = time.perf_counter()
+        outcomes["stream"].append((outcome, ((first or time.perf_counter()) - start) * 1000))
+
+    def chat(i: int):
+        start = time.perf_counter()
+        try:
+            rag.generate_answer(f"chat question {i}")
+            outcomes["chat"].append(("served", (time.perf_counter() - start) * 1000))
+        except AdmissionRejected as e:
+            outcomes["chat"].append((str(e.status_code), (time.perf_counter() - start) * 1000))
+
+    async def burst():
+        await asyncio.gather(
+            *(stream(i) for i in range(args.streams)),
+            *(asyncio.to_thread(chat, i) for i in range(args.chats)),
+        )
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        asyncio.run(burst())
+        wall_s = time.perf_counter() - start
+
+    print(f"limits: {args.max_concurrent} concurrent, queue {args.max_queue}, wait {args.max_wait_s}s; "
+          f"one call = {args.ttft_ms + (args.tokens - 1) * args.token_ms:.0f} ms; wall {wall_s:.2f}s")
+    for kind, rows in outcomes.items():
+        served = [ms for outcome, ms in rows if outcome == "served"]
+        counts = {code: sum(outcome == code for outcome, _ in rows) for code in ("served", "429", "503")}
+        label = "ttft" if kind == "stream" else "latency"
+        print(f"{kind:<7} {counts}  {label} p50={percentile(served, 50):.0f} ms "
+              f"p95={percentile(served, 95):.0f} ms max={max(served, default=0):.0f} ms")
+    if positions:
+        print(f"queue positions shown to streams: max {max(positions)}, {len(positions)} updates")
+    print(f"scheduler: {rag.llm_scheduler.stats()}")
+
+
+def latency_summary(values: list) -> dict:
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(sum(values) / len(values), 2) if values else 0.0,
+    }
+
+
+def eval_config(args) -> dict:
+    """Every knob that can move the numbers, stored with the results."""
+    from app import database
+    from app.chunking import CHUNK_OVERLAP, CHUNK_SIZE
+    from app.embeddings import EMBED_MODEL
+    from app.rag import LLM_MODEL, LLM_NUM_CTX
+    from app.reranker import RERANK_MODEL
+    from app.vector_store import VECTOR_STORE_CONFIG
+
+    return {
+        "mode": args.mode,
+        "limit": args.limit,
+        "retrieval_backend": database.RETRIEVAL_BACKEND,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "rrf_k": database.RRF_K,
+        "candidates_per_leg": database.CANDIDATES_PER_LEG,
+        "rerank_candidates": database.RERANK_CANDIDATES,
+        "max_chunks_per_url": database.MAX_CHUNKS_PER_URL,
+        "two_level": dict(database.TWO_LEVEL_CONFIG),
+        "vector_search": dict(database.VECTOR_SEARCH_CONFIG),
+        "vector_store_quantization": VECTOR_STORE_CONFIG["quantization"],
+        "adaptive": dict(database.ADAPTIVE_CONFIG),
+        "embed_model": EMBED_MODEL,
+        "rerank_model": RERANK_MODEL,
+        "llm": "stub" if args.llm == "stub" else LLM_MODEL,
+        "num_ctx": LLM_NUM_CTX,
+    }
+
+
+def compare_to_baseline(report: dict, baseline_path: str, max_quality_drop: float) -> bool:
+    """Prints metric deltas against an earlier report; False if any quality metric dropped too far."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    ok = True
+    print(f"\nvs baseline {baseline_path} ({baseline.get('timestamp')}):")
+    for name, value in report["quality"].items():
+        before = baseline.get("quality", {}).get(name)
+        if before is None:
+            continue
+        regressed = before - value > max_quality_drop
+        ok = ok and not regressed
+        print(f"  {name:<12} {before:.3f} -> {value:.3f}{'  REGRESSION' if regressed else ''}")
+    for pct in ("p50", "p95"):
+        before = baseline.get("latency_ms", {}).get("total", {}).get(pct)
+        if before:
+            value = report["latency_ms"]["total"][pct]
+            print(f"  latency {pct:<4} {before:.1f} -> {value:.1f}ms ({(value - before) / before:+.0%})")
+    return ok
+
+
+def bench_eval(args):
+    """
+    Replays a labelled query set or the interaction log through search_similar_documents
+    (--mode retrieval) or the full generate_answer (--mode answer, real or stub LLM) and
+    reports recall@k / MRR, per-stage latency percentiles and throughput. The full report,
+    including per-query rows and the configuration used, is written to --output as JSON.
+    Needs Postgres and Ollama (query embeddings).
+    """
+    from app import database, rag
+    from app.answer_cache import AnswerCache
+    from app.tracing import Trace, use_trace
+
+    items = load_eval_set(args.queries_file)[:args.queries]
+    if not items:
+        print("No queries to evaluate (empty interaction log and no --queries-file).")
+        return
+    ks = sorted({int(k) for k in args.k.split(",")})
+
+    # Query-time knobs; the module constants are read on every search
+    if args.rrf_k is not None:
+        database.RRF_K = args.rrf_k
+    if args.candidates is not None:
+        database.CANDIDATES_PER_LEG = args.candidates
+    if args.rerank_candidates is not None:
+        database.RERANK_CANDIDATES = args.rerank_candidates
+        database.TWO_LEVEL_CONFIG["rerank_candidates"] = args.rerank_candidates
+    if args.top_pages is not None:
+        database.TWO_LEVEL_CONFIG["pages"] = args.top_pages
+    if args.backend is not None:
+        database.RETRIEVAL_BACKEND = args.backend
+    if args.adaptive is not None:
+        database.ADAPTIVE_CONFIG["enabled"] = args.adaptive == "on"
+
+    captured = {}
+    if args.mode == "answer":
+        if args.llm == "stub":
+            rag.chain = StubChain(args.stub_ttft_ms, args.stub_tokens, args.stub_token_ms)
+        if not args.answer_cache:
+            rag.answer_cache = AnswerCache(max_entries=1, threshold=1.01)  # never hits
+
+        # Keep eval traffic out of the interaction log; keep what it would have logged
+        def capture(query: str, results: list, trace=None, **kwargs):
+            captured[query] = (results, trace)
+        rag.log_interaction = capture
+
+    def run_one(item: dict) -> dict:
+        query = item["query"]
+        start = time.perf_counter()
+        try:
+            if args.mode == "answer":
+                rag.generate_answer(query)
+                results, trace = captured.pop(query, ([], None))
+            else:
+                trace = Trace("eval")
+                with use_trace(trace):
+                    results = database.search_similar_documents(rag.normalize_question(query), limit=args.limit)
+            error = None
+        except Exception as e:
+            results, trace, error = [], None, str(e)
+        latency_ms = (time.perf_counter() - start) * 1000
+        urls = ranked_urls(results)
+        return {
+            "query": query,
+            "source": item["source"],
+            **retrieval_quality(urls, item["relevant_urls"], ks),
+            "latency_ms": round(latency_ms, 2),
+            "stages": trace.stage_timings() if trace is not None else {},
+            "path": (trace.attributes.get("retrieval") or {}).get("path") if trace is not None else None,
+            "urls": urls,
+            "error": error,
+        }
+
+    with open(os.devnull, "w") as devnull, \
+            (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)):
+        run_one(items[0])  # warm-up: pools, reranker workers, model load
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            rows = list(executor.map(run_one, items))
+        wall_s = time.perf_counter() - start
+
+    ok_rows = [r for r in rows if r["error"] is None]
+    stage_values = {}
+    for row in ok_rows:
+        for name, ms in row["stages"].items():
+            stage_values.setdefault(name, []).append(ms)
+
+    quality = {f"recall@{k}": round(sum(r[f"recall@{k}"] for r in ok_rows) / max(1, len(ok_rows)), 4) for k in ks}
+    quality["mrr"] = round(sum(r["rr"] for r in ok_rows) / max(1, len(ok_rows)), 4)
+    by_path = {}
+    for row in ok_rows:
+        by_path.setdefault(row["path"] or "none", []).append(row)
+    paths = {
+        path: {
+            "queries": len(path_rows),
+            "mrr": round(sum(r["rr"] for r in path_rows) / len(path_rows), 4),
+            "latency_ms_p50": round(percentile([r["latency_ms"] for r in path_rows], 50), 2),
+        }
+        for path, path_rows in by_path.items()
+    }
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": eval_config(args),
+        "queries": len(rows),
+        "labelled": sum(r["source"] == "labelled" for r in rows),
+        "errors": len(rows) - len(ok_rows),
+        "concurrency": args.concurrency,
+        "throughput_qps": round(len(rows) / wall_s, 2) if wall_s > 0 else 0.0,
+        "quality": quality,
+        "latency_ms": {
+            "total": latency_summary([r["latency_ms"] for r in ok_rows]),
+            "stages": {name: latency_summary(values) for name, values in stage_values.items()},
+        },
+        "retrieval_paths": paths,
+        "per_query": rows,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"{len(rows)} queries ({report['labelled']} labelled, {report['errors']} errors), "
+          f"mode={args.mode}, concurrency={args.concurrency}, {report['throughput_qps']:.2f} q/s")
+    print("  " + "  ".join(f"{name}={value:.3f}" for name, value in quality.items()))
+    total = report["latency_ms"]["total"]
+    print(f"  {'total':<18} p50={total['p50']:8.1f}ms  p95={total['p95']:8.1f}ms  p99={total['p99']:8.1f}ms")
+    for name, summary in report["latency_ms"]["stages"].items():
+        print(f"  {name:<18} p50={summary['p50']:8.1f}ms  p95={summary['p95']:8.1f}ms  p99={summary['p99']:8.1f}ms")
+    for path, summary in paths.items():
+        print(f"  path {path:<13} {summary['queries']:4d} queries  mrr={summary['mrr']:.3f}  "
+              f"p50={summary['latency_ms_p50']:8.1f}ms")
+    print(f"Report written to {args.output}")
+
+    database.close_pool()
+    if args.baseline and not compare_to_baseline(report, args.baseline, args.max_quality_drop):
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AlphaWave backend benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("pool", help="search latency with and without the connection pool")
+    p.add_argument("--requests", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_pool)
+
+    p = sub.add_parser("crawl", help="crawl wall-time against a local fixture site")
+    p.add_argument("--pages", type=int, default=200)
+    p.add_argument("--delay-ms", type=float, default=50)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--per-host", type=int, default=16)
+    p.set_defaults(func=bench_crawl)
+
+    p = sub.add_parser("ann", help="recall@k vs latency of the vector index against exact search")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--values", default="10,20,40,80,160", help="ef_search (HNSW) or probes (IVFFlat) values")
+    p.add_argument("--noise", type=float, default=0.01)
+    p.set_defaults(func=bench_ann)
+
+    p = sub.add_parser("fusion", help="old two-query fusion path vs single fused SQL statement")
+    p.add_argument("--requests", type=int, default=300)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_fusion)
+
+    p = sub.add_parser("rerank", help="rerank throughput at several concurrency levels")
+    p.add_argument("--users", default="1,8,32")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--max-wait-ms", type=float, default=None, help="batching window (default: RERANK_MAX_WAIT_MS)")
+    p.set_defaults(func=bench_rerank)
+
+    p = sub.add_parser("stream", help="concurrent SSE streams: sync vs async serving, or a live /chat/stream")
+    p.add_argument("--users", default="10,100,300", help="simultaneous streams per run")
+    p.add_argument("--url", default=None, help="live endpoint, e.g. http://localhost:8000/chat/stream")
+    p.add_argument("--token", default=None, help="Supabase access token for --url")
+    p.add_argument("--question", default="What services does AlphaWave offer?")
+    p.add_argument("--history-ms", type=float, default=80)
+    p.add_argument("--retrieval-ms", type=float, default=60)
+    p.add_argument("--ttft-ms", type=float, default=300)
+    p.add_argument("--tokens", type=int, default=50)
+    p.add_argument("--token-ms", type=float, default=20)
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("auth", help="remote auth round trip vs local JWT verification")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--remote-ms", type=float, default=80, help="simulated Supabase Auth latency")
+    p.set_defaults(func=bench_auth)
+
+    p = sub.add_parser("ttft", help="LLM time-to-first-token: plain joined chunks vs packed context")
+    p.add_argument("--queries", type=int, default=20, help="questions (from the interaction log if any)")
+    p.add_argument("--limit", type=int, default=5, help="chunks retrieved per question")
+    p.set_defaults(func=bench_ttft)
+
+    p = sub.add_parser("pages", help="flat vs two-level (pages, then chunks) retrieval")
+    p.add_argument("--queries", type=int, default=20, help="questions (from the interaction log if any)")
+    p.add_argument("--pages", type=int, default=8, help="pages searched by the two-level path")
+    p.add_argument("--k", type=int, default=5)
+    p.set_defaults(func=bench_pages)
+
+    p = sub.add_parser("backends", help="candidate retrieval: Postgres vs the memory-mapped vector store")
+    p.add_argument("--queries", type=int, default=20, help="questions (from the interaction log if any)")
+    p.add_argument("--requests", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser("admission", help="LLM admission control under a burst, against a fake slow LLM")
+    p.add_argument("--streams", type=int, default=20)
+    p.add_argument("--chats", type=int, default=10)
+    p.add_argument("--max-concurrent", type=int, default=2)
+    p.add_argument("--max-queue", type=int, default=16)
+    p.add_argument("--max-wait-s", type=float, default=5)
+    p.add_argument("--ttft-ms", type=float, default=300)
+    p.add_argument("--tokens", type=int, default=20)
+    p.add_argument("--token-ms", type=float, default=20)
+    p.set_defaults(func=bench_admission)
+
+    p = sub.add_parser("quant", help="recall@k of quantized first pass + exact rescoring vs exact <=>")
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--rescore", default="50,100,200,400", help="comma-separated shortlist sizes")
+    p.add_argument("--noise", type=float, default=0.01)
+    p.add_argument("--top-pages", type=int, default=None,
+                   help="two-level search pages for the served statement (0 = flat)")
+    p.set_defaults(func=bench_quant)
+
+    p = sub.add_parser("eval", help="offline recall@k/MRR + per-stage latency over labelled or logged queries")
+    p.add_argument("--mode", choices=["retrieval", "answer"], default="retrieval",
+                   help="search_similar_documents only, or the full generate_answer")
+    p.add_argument("--queries-file", default=None,
+                   help="JSONL of labelled items or log entries (default: the interaction log)")
+    p.add_argument("--queries", type=int, default=200, help="max distinct queries")
+    p.add_argument("--k", default="1,3,5", help="recall cut-offs")
+    p.add_argument("--limit", type=int, default=5, help="chunks retrieved per query (retrieval mode)")
+    p.add_argument("--concurrency", type=int, default=1)
+    p.add_argument("--llm", choices=["stub", "ollama"], default="stub", help="answer mode LLM")
+    p.add_argument("--stub-ttft-ms", type=float, default=300)
+    p.add_argument("--stub-tokens", type=int, default=50)
+    p.add_argument("--stub-token-ms", type=float, default=20)
+    p.add_argument("--answer-cache", action="store_true", help="keep the semantic answer cache on")
+    p.add_argument("--rrf-k", type=int, default=None)
+    p.add_argument("--candidates", type=int, default=None, help="hits per retrieval leg (default 40)")
+    p.add_argument("--rerank-candidates", type=int, default=None, help="fused candidates reranked")
+    p.add_argument("--top-pages", type=int, default=None, help="two-level search pages (0 = flat)")
+    p.add_argument("--backend", choices=["postgres", "mmap"], default=None, help="retrieval backend")
+    p.add_argument("--adaptive", choices=["on", "off"], default=None,
+                   help="adaptive retrieval depth (default: ADAPTIVE_RETRIEVAL)")
+    p.add_argument("--output", default="eval_results.json")
+    p.add_argument("--baseline", default=None, help="earlier report to compare against")
+    p.add_argument("--max-quality-drop", type=float, default=0.02,
+                   help="exit 1 if a quality metric falls more than this below the baseline")
+    p.add_argument("--verbose", action="store_true", help="keep the pipeline's debug output")
+    p.set_defaults(func=bench_eval)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
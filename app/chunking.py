@@ -1,12 +1,45 @@
+import hashlib
+import os
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+# Rough characters per LLM token for English prose (qwen2.5 / llama-style BPE tokenizers)
+CHARS_PER_TOKEN = float(os.environ.get("CHARS_PER_TOKEN", 4))
 
-def chunk_text(text: str, chunk_size: int = 800, overlap: int = 120) -> list[str]:
+# Splitter settings used at ingestion; changing them needs a full re-index (--full)
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 800))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", 120))
+
+
+def chunk_text(text: str, chunk_size: int = None, overlap: int = None) -> list[str]:
     """
     Splits text into larger overlapping chunks to provide more context.
     """
     splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=overlap,
+        chunk_size=chunk_size or CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP if overlap is None else overlap,
     )
-    return splitter.split_text(text)
\ No newline at end of file
+    return splitter.split_text(text)
+
+
+def content_hash(text: str) -> str:
+    """Stable fingerprint of a page or chunk, used to skip unchanged content on re-index."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap prompt-token estimate used for budgeting; no tokenizer round trip to Ollama."""
+    return int(len(text) / CHARS_PER_TOKEN + 0.999) if text else 0
+
+
+def shorten(text: str, max_tokens: int) -> str:
+    """Cuts text to about max_tokens, preferring a sentence end, then a word boundary."""
+    max_chars = int(max_tokens * CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    sentence_end = max(cut.rfind(". "), cut.rfind("? "), cut.rfind("! "), cut.rfind("\n"))
+    if sentence_end > max_chars // 3:
+        cut = cut[:sentence_end + 1]
+    else:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip() + " …"
@@ -0,0 +1,158 @@
+import asyncio
+import os
+
+COALESCE_CONFIG = {
+    # Attach identical concurrent /chat/stream requests to one pipeline (0 disables)
+    "enabled": os.environ.get("COALESCE_REQUESTS", "1") != "0",
+}
+
+
+class QueuePosition(int):
+    """Status item in a flight: the shared request's place in the LLM queue (not answer text)."""
+
+
+class Flight:
+    """
+    One in-flight answer stream shared by every subscriber. Chunks are kept until the
+    stream ends, so a subscriber that joins late first replays the prefix, then
+    follows live. `meta` carries what the producer learns along the way (cache hit,
+    sources, context stats) for every subscriber's log entry. While the producer waits
+    for an LLM slot, subscribers also get its current QueuePosition.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.meta = {}
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.queue_position = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # Waiters hold the old event; a fresh one is armed for the next change
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def queued(self, position: int):
+        self.queue_position = position
+        self._notify()
+
+    def close(self, error: BaseException = None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def subscribe(self):
+        """
+        Yields every chunk from the first one, plus QueuePosition items while the answer
+        hasn't started; re-raises the producer's error at the end.
+        """
+        self.subscribers += 1
+        position = 0
+        queue_position = 0
+        try:
+            while True:
+                if position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                elif self.done:
+                    break
+                elif not self.chunks and self.queue_position != queue_position:
+                    queue_position = self.queue_position
+                    yield QueuePosition(queue_position)
+                else:
+                    await self._changed.wait()
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.subscribers -= 1
+            # Nobody is listening any more: stop generating, like a lone disconnected client
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()
+
+
+class Coalescer:
+    """
+    Single-flight for the async pipeline. Concurrent callers with the same key share
+    one execution: call() for awaitables (retrieval), stream() for token streams (the
+    answer). Only in-flight work is shared; once it finishes the key is free again and
+    repeat questions are left to the answer cache.
+    """
+
+    def __init__(self):
+        self._calls = {}    # key -> Task
+        self._streams = {}  # key -> Flight
+        self.started = 0
+        self.joined = 0
+
+    async def call(self, key, factory):
+        """Returns (factory() result, shared). Leaving early doesn't cancel the others' work."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(self._calls, key, done))
+        self._count(shared)
+        return await asyncio.shield(task), shared
+
+    def stream(self, key, producer) -> tuple[Flight, bool]:
+        """
+        Returns (flight, shared) for key. The first caller's producer(flight), an async
+        iterator of chunks, runs as its own task so the stream outlives whichever
+        subscriber started it; later callers only subscribe.
+        """
+        flight = self._streams.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = Flight()
+            self._streams[key] = flight
+            flight.task = asyncio.create_task(self._produce(key, flight, producer(flight)))
+        self._count(shared)
+        return flight, shared
+
+    def answering(self, prefix: tuple) -> bool:
+        """Whether an in-flight stream's key starts with prefix (a request could join it)."""
+        return any(isinstance(key, tuple) and key[:len(prefix)] == prefix for key in self._streams)
+
+    async def _produce(self, key, flight: Flight, chunks):
+        error = None
+        try:
+            async for chunk in chunks:
+                flight.publish(chunk)
+        except asyncio.CancelledError as e:
+            error = e
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            self._forget(self._streams, key, flight)
+            flight.close(error)
+
+    @staticmethod
+    def _forget(registry: dict, key, value):
+        if registry.get(key) is value:
+            del registry[key]
+
+    def _count(self, shared: bool):
+        if shared:
+            self.joined += 1
+        else:
+            self.started += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "started": self.started,
+            "joined": self.joined,
+        }
+
+
+coalescer = Coalescer()
@@ -0,0 +1,131 @@
+import os
+import re
+from app.chunking import estimate_tokens, shorten
+
+CONTEXT_CONFIG = {
+    # Tokens kept free in num_ctx for the generated answer
+    "answer_reserve_tokens": int(os.environ.get("CONTEXT_ANSWER_RESERVE", 512)),
+    # Upper bound on context tokens even when num_ctx leaves more room (prefill cost)
+    "max_tokens": int(os.environ.get("CONTEXT_MAX_TOKENS", 1500)),
+    # Longest chunk overlap looked for when merging neighbours (chunk_text uses 120)
+    "max_overlap_chars": int(os.environ.get("CONTEXT_MAX_OVERLAP", 200)),
+}
+
+# A block that only partly fits is kept if at least this many tokens remain
+MIN_PARTIAL_TOKENS = 40
+# Shorter common suffix/prefix runs are treated as coincidence, not chunk overlap
+MIN_OVERLAP_CHARS = 20
+
+CHUNK_TITLE = re.compile(r"^(.*?)\s*\(chunk\s+(\d+)\)\s*$", re.IGNORECASE)
+
+
+def context_budget(num_ctx: int, *prompt_parts: str) -> int:
+    """Tokens left for retrieved context once the prompt template, history, question and answer are paid for."""
+    fixed = sum(estimate_tokens(part) for part in prompt_parts if part)
+    available = num_ctx - CONTEXT_CONFIG["answer_reserve_tokens"] - fixed
+    return max(0, min(available, CONTEXT_CONFIG["max_tokens"]))
+
+
+def chunk_number(doc: dict):
+    """1-based position of a chunk within its page (chunk_index; "(chunk N)" title for older rows)."""
+    if doc.get("chunk_index") is not None:
+        return doc["chunk_index"] + 1
+    match = CHUNK_TITLE.match(doc.get("title") or "")
+    return int(match.group(2)) if match else None
+
+
+def page_title(doc: dict) -> str:
+    """Title of the chunk's page (pages.title; the chunk title minus its suffix for older rows)."""
+    if doc.get("page_title"):
+        return doc["page_title"]
+    raw_title = doc.get("title") or ""
+    match = CHUNK_TITLE.match(raw_title)
+    return match.group(1).strip() if match else raw_title.strip()
+
+
+def _score(doc: dict) -> float:
+    return doc.get("rerank_score", doc.get("rrf_score", 0))
+
+
+def overlap_length(previous: str, following: str, max_chars: int = 200) -> int:
+    """Length of the longest suffix of `previous` that is also a prefix of `following`."""
+    for size in range(min(max_chars, len(previous), len(following)), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(following[:size]):
+            return size
+    return 0
+
+
+def merge_adjacent(results: list, max_overlap_chars: int = 200) -> tuple[list, int]:
+    """
+    Joins chunks that are consecutive on the same page into one block, dropping the
+    text the splitter repeated at their boundary. Returns (blocks, overlap chars removed);
+    each block is {"url", "text", "score", "chunks"} with score = its best chunk's score.
+    """
+    by_url = {}
+    for doc in results:
+        by_url.setdefault(doc.get("url"), []).append(doc)
+
+    blocks, removed = [], 0
+    for url, docs in by_url.items():
+        docs.sort(key=lambda d: (chunk_number(d) is None, chunk_number(d) or 0))
+        current = None
+        for doc in docs:
+            number = chunk_number(doc)
+            if current is not None and number is not None and current["last"] is not None \
+                    and number == current["last"] + 1:
+                overlap = overlap_length(current["text"], doc["content"], max_overlap_chars)
+                removed += overlap
+                current["text"] += doc["content"][overlap:] if overlap else "\n" + doc["content"]
+                current["score"] = max(current["score"], _score(doc))
+                current["chunks"].append(doc["id"])
+                current["last"] = number
+                continue
+            current = {"url": url, "text": doc["content"], "score": _score(doc),
+                       "chunks": [doc["id"]], "last": number}
+            blocks.append(current)
+
+    for block in blocks:
+        del block["last"]
+    return blocks, removed
+
+
+def build_context(results: list, budget_tokens: int, max_overlap_chars: int = None) -> tuple[str, dict]:
+    """
+    Context stage between retrieval and the LLM: merges neighbouring chunks, removes
+    their overlap, orders blocks by (rerank) score and packs them into budget_tokens.
+    A block that only partly fits is cut at a sentence boundary; later ones are dropped.
+    Returns (context, stats) where tokens_before is the old plain "\n\n".join.
+    """
+    max_overlap_chars = max_overlap_chars or CONTEXT_CONFIG["max_overlap_chars"]
+    tokens_before = estimate_tokens("\n\n".join(r["content"] for r in results))
+    blocks, overlap_removed = merge_adjacent(results, max_overlap_chars)
+    blocks.sort(key=lambda b: b["score"], reverse=True)
+
+    parts, used, truncated, dropped = [], 0, 0, 0
+    for block in blocks:
+        tokens = estimate_tokens(block["text"]) + 1  # + separator
+        remaining = budget_tokens - used
+        if tokens > remaining:
+            if remaining >= MIN_PARTIAL_TOKENS and not truncated:
+                parts.append(shorten(block["text"], remaining - 1))
+                used = budget_tokens
+                truncated += 1
+            else:
+                dropped += 1
+            continue
+        parts.append(block["text"])
+        used += tokens
+
+    context = "\n\n".join(parts)
+    tokens = estimate_tokens(context)
+    return context, {
+        "chunks": len(results),
+        "blocks": len(blocks),
+        "overlap_chars_removed": overlap_removed,
+        "truncated": truncated,
+        "dropped": dropped,
+        "budget": budget_tokens,
+        "tokens": tokens,
+        "tokens_before": tokens_before,
+        "tokens_saved": max(0, tokens_before - tokens),
+    }
@@ -0,0 +1,163 @@
+import asyncio
+import random
+from collections import defaultdict
+from urllib.parse import urlparse
+import aiohttp
+from app.scraper import parse_page
+
+# Status codes worth retrying — anything else fails the page immediately
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Pages answering with these are treated as deleted from the site
+GONE_STATUSES = {404, 410}
+
+
+class AsyncCrawler:
+    """
+    BFS crawler built on asyncio + one shared keep-alive aiohttp session.
+
+    Every page is fetched once and parsed once (text + links via parse_page).
+    `concurrency` workers pull URLs from a FIFO frontier; `per_host` caps how many
+    requests hit the same host at once and `request_delay` spaces them out.
+    The crawl stops descending past `max_depth` and stops scheduling after `max_pages`.
+
+    If `page_state` ({url: {etag, last_modified, links}}) is given, requests are
+    conditional. A 304 page is reported as {"url", "not_modified": True, "links"} using
+    the stored links, so traversal continues without downloading it.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_pages: int = 500,
+        max_depth: int = 10,
+        concurrency: int = 8,
+        per_host: int = 4,
+        request_delay: float = 0.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 20.0,
+        page_state: dict = None,
+    ):
+        self.base_url = base_url
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.request_delay = request_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.page_state = page_state or {}
+
+        self.seen = set()
+        self.failed = {}
+        self.gone = set()
+        self.pages_crawled = 0
+
+    async def crawl(self, on_page=None) -> int:
+        """
+        Crawls from base_url. on_page(data) is called for every parsed page in a worker
+        thread (one call at a time) so blocking ingestion doesn't stall fetching.
+        Returns the number of pages successfully crawled.
+        """
+        self.seen = {self.base_url}
+        self.failed = {}
+        self.gone = set()
+        self.pages_crawled = 0
+
+        frontier = asyncio.Queue()
+        frontier.put_nowait((self.base_url, 0))
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        callback_lock = asyncio.Lock()
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def worker():
+                while True:
+                    url, depth = await frontier.get()
+                    try:
+                        data = await self._fetch(session, host_limits[urlparse(url).netloc], url)
+                        if data is None:
+                            continue
+                        self.pages_crawled += 1
+
+                        if depth < self.max_depth:
+                            for link in sorted(data["links"]):
+                                if link not in self.seen and len(self.seen) < self.max_pages:
+                                    self.seen.add(link)
+                                    frontier.put_nowait((link, depth + 1))
+
+                        if on_page is not None:
+                            async with callback_lock:
+                                await asyncio.to_thread(on_page, data)
+                    except Exception as e:
+                        self.failed[url] = str(e)
+                        print(f"Failed to process {url}: {e}")
+                    finally:
+                        frontier.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            await frontier.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        return self.pages_crawled
+
+    def _conditional_headers(self, url: str) -> dict:
+        state = self.page_state.get(url)
+        if not state:
+            return {}
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+        return headers
+
+    async def _fetch(self, session, host_limit, url: str):
+        """
+        GETs and parses a page with retry + exponential backoff.
+        Returns page data, a not_modified marker for 304s, or None for non-HTML/failures.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                async with host_limit:
+                    async with session.get(url, headers=self._conditional_headers(url)) as response:
+                        if response.status == 304:
+                            return {
+                                "url": url,
+                                "not_modified": True,
+                                "links": set(self.page_state.get(url, {}).get("links") or [])
+                            }
+                        if response.status in GONE_STATUSES:
+                            self.gone.add(url)
+                            return None
+                        if response.status in RETRY_STATUSES and attempt < self.retries:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history, status=response.status
+                            )
+                        response.raise_for_status()
+                        if "html" not in response.headers.get("Content-Type", "text/html"):
+                            return None
+                        html = await response.text()
+                        etag = response.headers.get("ETag")
+                        last_modified = response.headers.get("Last-Modified")
+                    if self.request_delay:
+                        await asyncio.sleep(self.request_delay)
+                data = parse_page(url, html)
+                data["etag"] = etag
+                data["last_modified"] = last_modified
+                return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+                if attempt >= self.retries or not retryable:
+                    self.failed[url] = str(e)
+                    print(f"Failed to scrape {url}: {e}")
+                    return None
+                # Exponential backoff with jitter
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+        return None
@@ -1,9 +1,18 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import BrokenExecutor
+from contextlib import contextmanager
+import asyncpg
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from app.embeddings import generate_embedding
-from flashrank import Ranker, RerankRequest
-
-reranker = Ranker(model_name="ms-marco-MiniLM-L-12-v2", cache_dir="/tmp/flashrank")
+from psycopg2 import pool
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import RealDictCursor, execute_values
+from app.embeddings import agenerate_embedding, generate_embedding, generate_embeddings, normalize_text
+from app.chunking import content_hash
+from app.reranker import rerank_score_cache, rerank_service
+from app import tracing
 
 
 DB_CONFIG = {
@@ -26,23 +35,425 @@ def get_connection():
     )
 
 
+# Chunks embedded per Ollama request / rows written per INSERT during bulk ingestion
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 32))
+
+
+def to_vector_str(embedding: list[float]) -> str:
+    return "[" + ",".join(map(str, embedding)) + "]"
+
+
+# -------------------------
+# Connection pool
+# -------------------------
+POOL_CONFIG = {
+    "min_size": int(os.environ.get("DB_POOL_MIN", 1)),
+    "max_size": int(os.environ.get("DB_POOL_MAX", 10)),
+    # asyncpg pool used by the async /chat/stream path
+    "async_max_size": int(os.environ.get("DB_ASYNC_POOL_MAX", 20)),
+    # Connections idle longer than this are pinged with SELECT 1 on checkout
+    "healthcheck_after_s": float(os.environ.get("DB_POOL_HEALTHCHECK_AFTER", 30)),
+}
+
+
+class PooledConnection(PgConnection):
+    """psycopg2 connection that remembers its prepared statements and last use."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = None
+
+
+def get_pool():
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_slots = threading.BoundedSemaphore(POOL_CONFIG["max_size"])
+                _pool = pool.ThreadedConnectionPool(
+                    POOL_CONFIG["min_size"],
+                    POOL_CONFIG["max_size"],
+                    connection_factory=PooledConnection,
+                    cursor_factory=RealDictCursor,
+                    **DB_CONFIG
+                )
+    return _pool
+
+
+def close_pool():
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            # A pool recreated later may have a different max_size
+            _pool_slots = None
+
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < POOL_CONFIG["healthcheck_after_s"]:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Checks a connection out of the shared pool for the duration of the block.
+    Blocks while all max_size connections are in use instead of failing, so the
+    sync FastAPI threadpool can safely share it. Broken connections are dropped
+    and replaced on checkout.
+    """
+    db_pool = get_pool()
+    _pool_slots.acquire()
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        while not _is_healthy(conn):
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+
+        yield conn
+
+        if not conn.closed:
+            conn.commit()
+    except Exception:
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        if conn is not None:
+            conn.last_used = time.monotonic()
+            db_pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
+
+
+# -------------------------
+# Async connection pool (asyncpg)
+# -------------------------
+_async_pool = None
+_async_pool_lock = None
+
+
+async def _init_async_connection(conn):
+    # asyncpg has no codec for pgvector; exchange vectors in their text form ("[0.1,...]")
+    await conn.set_type_codec("vector", encoder=str, decoder=str, schema="public", format="text")
+
+
+async def get_async_pool():
+    """
+    Lazily creates the asyncpg pool on the running event loop. acquire() waits
+    while all async_max_size connections are busy; asyncpg drops broken connections
+    on release and prepares each distinct SQL text once per connection (statement cache).
+    """
+    global _async_pool, _async_pool_lock
+    if _async_pool is None:
+        if _async_pool_lock is None:
+            _async_pool_lock = asyncio.Lock()
+        async with _async_pool_lock:
+            if _async_pool is None:
+                _async_pool = await asyncpg.create_pool(
+                    host=DB_CONFIG["host"],
+                    port=DB_CONFIG["port"],
+                    database=DB_CONFIG["dbname"],
+                    user=DB_CONFIG["user"],
+                    password=DB_CONFIG["password"],
+                    min_size=POOL_CONFIG["min_size"],
+                    max_size=POOL_CONFIG["async_max_size"],
+                    max_inactive_connection_lifetime=300,
+                    init=_init_async_connection,
+                )
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+# -------------------------
+# Hybrid search tuning
+# -------------------------
+RRF_K = 60                  # RRF Score = 1 / (rank + k)
+CANDIDATES_PER_LEG = 40     # vector / keyword hits fused per query
+RERANK_CANDIDATES = 20      # fused candidates passed to the reranker
+MAX_CHUNKS_PER_URL = 2      # diversity cap among those candidates
+
+# Two-level retrieval: pick pages by their summary embedding, then search chunks
+# of those pages only. Fewer, more focused candidates go to the reranker and the
+# final chunks are widened with their prev/next neighbours instead.
+TWO_LEVEL_CONFIG = {
+    # Pages searched per query; 0 = flat search over every chunk
+    "pages": int(os.environ.get("SEARCH_TOP_PAGES", 8)),
+    # Fused candidates passed to the reranker on the two-level path
+    "rerank_candidates": int(os.environ.get("TWO_LEVEL_RERANK_CANDIDATES", 12)),
+    # Add each final chunk's prev/next chunk to the context
+    "expand_neighbours": os.environ.get("EXPAND_NEIGHBOURS", "1") != "0",
+}
+
+# Adaptive retrieval: a shallow first pass, then the pool and rerank depth follow how
+# confident it was. When both legs agree on a clear winner the reranker is skipped;
+# when they disagree the full-depth pass runs and everything is reranked.
+ADAPTIVE_CONFIG = {
+    "enabled": os.environ.get("ADAPTIVE_RETRIEVAL", "0") != "0",
+    # Hits per leg in the first pass
+    "shallow_per_leg": int(os.environ.get("ADAPTIVE_SHALLOW_PER_LEG", 15)),
+    # Skip the reranker when agreement and margin both reach these
+    "skip_agreement": float(os.environ.get("ADAPTIVE_SKIP_AGREEMENT", 0.85)),
+    "skip_margin": float(os.environ.get("ADAPTIVE_SKIP_MARGIN", 0.25)),
+    # Below this agreement, refetch at CANDIDATES_PER_LEG and rerank every candidate
+    "deep_agreement": float(os.environ.get("ADAPTIVE_DEEP_AGREEMENT", 0.5)),
+    # Candidates reranked in between (never fewer than the requested limit)
+    "short_rerank": int(os.environ.get("ADAPTIVE_SHORT_RERANK", 8)),
+}
+
+
+# -------------------------
+# ANN search knobs (index itself is managed in app/schema.py)
+# -------------------------
+VECTOR_SEARCH_CONFIG = {
+    # HNSW candidate list size; must be >= the 40 vector candidates we fetch
+    "ef_search": int(os.environ.get("HNSW_EF_SEARCH", 80)),
+    "probes": int(os.environ.get("IVFFLAT_PROBES", 10)),
+    # Compact index representation: "none" (full vectors), "halfvec" (2x smaller)
+    # or "binary" (1 bit per dimension, 32x smaller). The index then only shortlists;
+    # the shortlist is rescored with the full-precision embedding.
+    "quantization": os.environ.get("VECTOR_QUANTIZATION", "none"),
+    # Shortlist size rescored at full precision when quantized
+    "rescore": int(os.environ.get("VECTOR_RESCORE_CANDIDATES", 200)),
+}
+
+EMBEDDING_DIM = 768  # nomic-embed-text; documents.embedding is VECTOR(768)
+
+# Distance on the compact representation; must match the index expression in app/schema.py
+QUANTIZED_DISTANCE = {
+    "halfvec": f"embedding::halfvec({EMBEDDING_DIM}) <=> $1::vector::halfvec({EMBEDDING_DIM})",
+    "binary": f"binary_quantize(embedding)::bit({EMBEDDING_DIM}) <~> binary_quantize($1::vector)",
+}
+
+
 # -------------------------
-# Keyword extraction (simple)
+# Server-side prepared statements
 # -------------------------
-def extract_keywords(query: str):
-    words = query.lower().split()
-    # Common words we want to ignore
-    stop_words = {"what", "where", "when", "how", "who", "this", "that", "with", "from", "the", "and", "for", "your", "with", "is", "are"}
-    
-    keywords = []
-    for w in words:
-        clean = w.strip("?,.!")
-        # Keep words that are 3+ chars and NOT in stop_words
-        # OR special important acronyms
-        if (len(clean) >= 3 and clean not in stop_words) or clean in ["ai", "io", "ux", "3d"]:
-            keywords.append(clean)
-    
-    return keywords
+PREPARED_STATEMENTS = {
+    "vector_search": """
+        SELECT id, url, title, content,
+               (1 - (embedding <=> $1::vector)) as score
+        FROM documents
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> $1::vector
+        LIMIT $2
+    """,
+    # $1 is the raw query text. plainto_tsquery stems it and drops stop words; its
+    # AND-ed terms are turned into an OR so partially matching chunks still rank.
+    # ts_rank_cd weights title (A) over content (B); normalization 1 damps long chunks.
+    "keyword_search": """
+        SELECT id, url, title, content,
+               ts_rank_cd(search_vector, q, 1) as score
+        FROM documents,
+             CAST(replace(plainto_tsquery('english', $1)::text, ' & ', ' | ') AS tsquery) AS q
+        WHERE search_vector @@ q
+        ORDER BY score DESC
+        LIMIT $2
+    """,
+    # Single round trip hybrid retrieval. $1 query vector, $2 query text,
+    # $3 candidates per leg, $4 RRF k, $5 max chunks per URL, $6 candidates returned.
+    # Ranks, fusion and the diversity cap only touch ids/urls; content is joined in
+    # for the final $6 rows alone.
+    "fused_search": """
+        WITH vector_leg AS (
+            SELECT id, url, score, row_number() OVER (ORDER BY score DESC, id) AS rank
+            FROM (
+                SELECT id, url, (1 - (embedding <=> $1::vector)) AS score
+                FROM documents
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> $1::vector
+                LIMIT $3
+            ) v
+        ),
+        keyword_leg AS (
+            SELECT id, url, row_number() OVER (ORDER BY score DESC, id) AS rank
+            FROM (
+                SELECT id, url, ts_rank_cd(search_vector, q, 1) AS score
+                FROM documents,
+                     CAST(replace(plainto_tsquery('english', $2)::text, ' & ', ' | ') AS tsquery) AS q
+                WHERE search_vector @@ q
+                ORDER BY score DESC
+                LIMIT $3
+            ) k
+        ),
+        fused AS (
+            SELECT id, min(url) AS url,
+                   sum(1.0 / (rank + $4))::float8 AS rrf_score,
+                   max(score) AS score
+            FROM (
+                SELECT id, url, rank, score FROM vector_leg
+                UNION ALL
+                SELECT id, url, rank, NULL::float8 FROM keyword_leg
+            ) legs
+            GROUP BY id
+        ),
+        diverse AS (
+            SELECT id, rrf_score, score,
+                   row_number() OVER (PARTITION BY url ORDER BY rrf_score DESC, id) AS url_rank
+            FROM fused
+        ),
+        top_candidates AS (
+            SELECT id, rrf_score, score
+            FROM diverse
+            WHERE url_rank <= $5
+            ORDER BY rrf_score DESC, id
+            LIMIT $6
+        )
+        SELECT d.id, d.url, d.title, d.content, d.chunk_index, p.title AS page_title,
+               c.rrf_score, c.score
+        FROM top_candidates c
+        JOIN documents d ON d.id = c.id
+        LEFT JOIN pages p ON p.url = d.url
+        ORDER BY c.rrf_score DESC, c.id
+    """,
+    # Two-level variant of fused_search: same parameters plus $7 pages. The top $7
+    # pages by summary embedding are chosen first and both legs only rank chunks of
+    # those pages (an exact scan of a few hundred rows, so no ANN index on this leg).
+    "page_fused_search": """
+        WITH top_pages AS (
+            SELECT url FROM pages
+            WHERE summary_embedding IS NOT NULL
+            ORDER BY summary_embedding <=> $1::vector
+            LIMIT $7
+        ),
+        page_chunks AS MATERIALIZED (
+            SELECT d.id, d.url, d.embedding, d.search_vector
+            FROM documents d
+            JOIN top_pages USING (url)
+        ),
+        vector_leg AS (
+            SELECT id, url, score, row_number() OVER (ORDER BY score DESC, id) AS rank
+            FROM (
+                SELECT id, url, (1 - (embedding <=> $1::vector)) AS score
+                FROM page_chunks
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> $1::vector
+                LIMIT $3
+            ) v
+        ),
+        keyword_leg AS (
+            SELECT id, url, row_number() OVER (ORDER BY score DESC, id) AS rank
+            FROM (
+                SELECT id, url, ts_rank_cd(search_vector, q, 1) AS score
+                FROM page_chunks,
+                     CAST(replace(plainto_tsquery('english', $2)::text, ' & ', ' | ') AS tsquery) AS q
+                WHERE search_vector @@ q
+                ORDER BY score DESC
+                LIMIT $3
+            ) k
+        ),
+        fused AS (
+            SELECT id, min(url) AS url,
+                   sum(1.0 / (rank + $4))::float8 AS rrf_score,
+                   max(score) AS score
+            FROM (
+                SELECT id, url, rank, score FROM vector_leg
+                UNION ALL
+                SELECT id, url, rank, NULL::float8 FROM keyword_leg
+            ) legs
+            GROUP BY id
+        ),
+        diverse AS (
+            SELECT id, rrf_score, score,
+                   row_number() OVER (PARTITION BY url ORDER BY rrf_score DESC, id) AS url_rank
+            FROM fused
+        ),
+        top_candidates AS (
+            SELECT id, rrf_score, score
+            FROM diverse
+            WHERE url_rank <= $5
+            ORDER BY rrf_score DESC, id
+            LIMIT $6
+        )
+        SELECT d.id, d.url, d.title, d.content, d.chunk_index, p.title AS page_title,
+               c.rrf_score, c.score
+        FROM top_candidates c
+        JOIN documents d ON d.id = c.id
+        LEFT JOIN pages p ON p.url = d.url
+        ORDER BY c.rrf_score DESC, c.id
+    """,
+    # prev/next chunks of the given chunk ids ($1 int[]), with the id they neighbour
+    "neighbour_chunks": """
+        SELECT n.id, n.url, n.title, n.content, n.chunk_index, p.title AS page_title,
+               a.id AS neighbour_of
+        FROM documents a
+        JOIN documents n ON n.id = a.prev_id OR n.id = a.next_id
+        LEFT JOIN pages p ON p.url = n.url
+        WHERE a.id = ANY($1::int[])
+        ORDER BY n.url, n.chunk_index, n.id
+    """,
+}
+
+# Vector leg of fused_search / page_fused_search, and its quantized form: the top
+# {shortlist} rows by the compact distance (served by the expression index on the flat
+# search) re-ranked by the exact <=> distance
+EXACT_VECTOR_LEG = """
+                SELECT id, url, (1 - (embedding <=> $1::vector)) AS score
+                FROM {source}
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> $1::vector
+                LIMIT $3
+"""
+RESCORED_VECTOR_LEG = """
+                SELECT id, url, (1 - (embedding <=> $1::vector)) AS score
+                FROM (
+                    SELECT id, url, embedding
+                    FROM {source}
+                    WHERE embedding IS NOT NULL
+                    ORDER BY {distance}
+                    LIMIT {shortlist}
+                ) shortlist
+                ORDER BY embedding <=> $1::vector
+                LIMIT $3
+"""
+
+if VECTOR_SEARCH_CONFIG["quantization"] in QUANTIZED_DISTANCE:
+    # Each statement's parameters plus the shortlist size ($7 flat, $8 two-level)
+    for _name, _source, _shortlist in (("fused_search", "documents", "$7"),
+                                       ("page_fused_search", "page_chunks", "$8")):
+        _exact = EXACT_VECTOR_LEG.format(source=_source)
+        assert _exact in PREPARED_STATEMENTS[_name]
+        PREPARED_STATEMENTS[f"{_name}_rescored"] = PREPARED_STATEMENTS[_name].replace(
+            _exact,
+            RESCORED_VECTOR_LEG.format(source=_source, shortlist=_shortlist,
+                                       distance=QUANTIZED_DISTANCE[VECTOR_SEARCH_CONFIG["quantization"]])
+        )
+    del _name, _source, _shortlist, _exact
+
+
+def execute_prepared(conn, cursor, name: str, params: tuple):
+    """
+    Runs one of PREPARED_STATEMENTS, issuing PREPARE on this connection first if needed.
+    Pooled connections keep their prepared plans for their whole lifetime.
+    """
+    prepared = getattr(conn, "prepared", set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]};")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders});", params)
 
 
 # -------------------------
@@ -50,79 +461,260 @@ def extract_keywords(query: str):
 # -------------------------
 def insert_document(url: str, title: str, content: str):
     embedding = generate_embedding(content)
-    vector_str = "[" + ",".join(map(str, embedding)) + "]"
+    vector_str = to_vector_str(embedding)
 
-    conn = get_connection()
-    cursor = conn.cursor()
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO documents (url, title, content, embedding)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id;
+        """, (url, title, content, vector_str))
+        new_id = cursor.fetchone()["id"]
+        cursor.close()
 
-    cursor.execute("""
-        INSERT INTO documents (url, title, content, embedding)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id;
-    """, (url, title, content, vector_str))
+    return new_id
 
-    new_id = cursor.fetchone()["id"]
-    conn.commit()
 
-    cursor.close()
-    conn.close()
+def _embed_rows(batch: list[dict], batch_size: int) -> list[tuple]:
+    """Embeds batch_size chunks per Ollama request; returns rows ready for _insert_rows."""
+    vectors = []
+    for i in range(0, len(batch), batch_size):
+        part = batch[i:i + batch_size]
+        vectors.extend(generate_embeddings([doc["content"] for doc in part]))
 
-    return new_id
+    return [
+        (
+            doc["url"], doc["title"], doc["content"],
+            doc.get("content_hash") or content_hash(doc["content"]),
+            doc.get("chunk_index"),
+            to_vector_str(vector)
+        )
+        for doc, vector in zip(batch, vectors)
+    ]
+
+
+def _insert_rows(cursor, rows: list[tuple], batch_size: int) -> list[int]:
+    new_ids = []
+    for i in range(0, len(rows), batch_size):
+        inserted = execute_values(
+            cursor,
+            "INSERT INTO documents (url, title, content, content_hash, chunk_index, embedding) VALUES %s RETURNING id;",
+            rows[i:i + batch_size],
+            page_size=batch_size,
+            fetch=True
+        )
+        new_ids.extend(row["id"] for row in inserted)
+    return new_ids
+
+
+def insert_documents(batch: list[dict], batch_size: int = INGEST_BATCH_SIZE) -> list[int]:
+    """
+    Bulk version of insert_document. Each item is a dict with url, title and content.
+    Chunks are embedded batch_size at a time, then written with one multi-row
+    INSERT per batch, all inside a single transaction. Returns the new ids in order.
+    """
+    rows = _embed_rows(batch, batch_size)
+
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        new_ids = _insert_rows(cursor, rows, batch_size)
+        cursor.close()
+
+    return new_ids
+
+
+# -------------------------
+# Incremental re-indexing
+# -------------------------
+# Rewrites prev_id/next_id from chunk_index order; only rows whose links changed are
+# written. {where} narrows it to one page (ingestion) or is empty (schema backfill).
+RELINK_CHUNKS_SQL = """
+    UPDATE documents AS d SET prev_id = n.prev_id, next_id = n.next_id
+    FROM (
+        SELECT id,
+               lag(id) OVER w AS prev_id,
+               lead(id) OVER w AS next_id
+        FROM documents {where}
+        WINDOW w AS (PARTITION BY url ORDER BY chunk_index, id)
+    ) AS n
+    WHERE d.id = n.id
+      AND (d.prev_id IS DISTINCT FROM n.prev_id OR d.next_id IS DISTINCT FROM n.next_id);
+"""
+
+# Page summary embedding = centroid of the page's chunk embeddings (pgvector avg),
+# so it costs no extra embedding call and stays in the same space as the queries
+UPSERT_PAGE_SQL = """
+    INSERT INTO pages (url, title, chunk_count, summary_embedding, updated_at)
+    SELECT url, %s, count(*), avg(embedding), now()
+    FROM documents
+    WHERE url = %s AND embedding IS NOT NULL
+    GROUP BY url
+    ON CONFLICT (url) DO UPDATE SET
+        title = coalesce(EXCLUDED.title, pages.title),
+        chunk_count = EXCLUDED.chunk_count,
+        summary_embedding = EXCLUDED.summary_embedding,
+        updated_at = now();
+"""
+
+
+def sync_page_chunks(url: str, chunks: list[dict], force: bool = False,
+                     batch_size: int = INGEST_BATCH_SIZE, title: str = None) -> dict:
+    """
+    Makes the stored chunks for `url` match `chunks` (dicts with title, content, content_hash),
+    given in page order. Chunks whose hash is already stored are kept (only their title and
+    chunk_index are updated if the ordinal moved), new hashes are embedded and inserted, and
+    stored chunks that no longer appear - including duplicates left by earlier full crawls -
+    are deleted. When anything changed, the page's prev/next links and its `pages` row
+    (title, chunk count, summary embedding) are rebuilt in the same transaction.
+    force=True re-embeds everything. Returns counts of inserted/deleted/unchanged chunks.
+    """
+    chunks = [{**chunk, "chunk_index": i} for i, chunk in enumerate(chunks)]
+
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, title, content, content_hash, chunk_index FROM documents WHERE url = %s ORDER BY id;",
+            (url,)
+        )
+        stored = cursor.fetchall()
+        cursor.close()
+
+    existing = {}
+    delete_ids = []
+    for row in stored:
+        row_hash = row["content_hash"] or content_hash(row["content"])
+        if force or row_hash in existing:
+            delete_ids.append(row["id"])
+        else:
+            existing[row_hash] = row
+
+    kept = set()
+    updates = []
+    new_chunks = []
+    for chunk in chunks:
+        row = existing.get(chunk["content_hash"])
+        if row is not None and chunk["content_hash"] not in kept:
+            kept.add(chunk["content_hash"])
+            if row["title"] != chunk["title"] or row["content_hash"] is None \
+                    or row["chunk_index"] != chunk["chunk_index"]:
+                updates.append((chunk["title"], chunk["content_hash"], chunk["chunk_index"], row["id"]))
+        else:
+            new_chunks.append({**chunk, "url": url})
+    delete_ids.extend(row["id"] for row_hash, row in existing.items() if row_hash not in kept)
+
+    # Embed outside the transaction so no connection is held during Ollama calls
+    rows = _embed_rows(new_chunks, batch_size)
+
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        if delete_ids:
+            cursor.execute("DELETE FROM documents WHERE id = ANY(%s);", (delete_ids,))
+        if updates:
+            execute_values(
+                cursor,
+                """UPDATE documents AS d
+                   SET title = v.title, content_hash = v.content_hash, chunk_index = v.chunk_index
+                   FROM (VALUES %s) AS v(title, content_hash, chunk_index, id) WHERE d.id = v.id;""",
+                updates
+            )
+        _insert_rows(cursor, rows, batch_size)
+        if delete_ids or updates or rows:
+            cursor.execute(RELINK_CHUNKS_SQL.format(where="WHERE url = %s"), (url,))
+            if chunks:
+                cursor.execute(UPSERT_PAGE_SQL, (title, url))
+            else:
+                cursor.execute("DELETE FROM pages WHERE url = %s;", (url,))
+        cursor.close()
+
+    return {"inserted": len(rows), "deleted": len(delete_ids), "unchanged": len(kept)}
+
+
+def get_page_states() -> dict:
+    """Returns {url: {etag, last_modified, content_hash, links}} for every crawled page."""
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT url, etag, last_modified, content_hash, links FROM page_state;")
+        states = {row["url"]: dict(row) for row in cursor.fetchall()}
+        cursor.close()
+    return states
+
+
+def save_page_state(url: str, etag: str, last_modified: str, page_hash: str, links: list):
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO page_state (url, etag, last_modified, content_hash, links, crawled_at)
+            VALUES (%s, %s, %s, %s, %s, now())
+            ON CONFLICT (url) DO UPDATE SET
+                etag = EXCLUDED.etag,
+                last_modified = EXCLUDED.last_modified,
+                content_hash = EXCLUDED.content_hash,
+                links = EXCLUDED.links,
+                crawled_at = now();
+        """, (url, etag, last_modified, page_hash, sorted(links)))
+        cursor.close()
+
+
+def touch_page_state(url: str):
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE page_state SET crawled_at = now() WHERE url = %s;", (url,))
+        cursor.close()
+
+
+def delete_page(url: str) -> int:
+    """Removes a page that no longer exists, with all of its chunks. Returns chunks deleted."""
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM documents WHERE url = %s;", (url,))
+        deleted = cursor.rowcount
+        cursor.execute("DELETE FROM pages WHERE url = %s;", (url,))
+        cursor.execute("DELETE FROM page_state WHERE url = %s;", (url,))
+        cursor.close()
+    return deleted
 
 
 # -------------------------
 # Hybrid search
 # -------------------------
-def search_similar_documents(query: str, limit: int = 5):
-    embedding = generate_embedding(query)
-    vector_str = "[" + ",".join(map(str, embedding)) + "]"
-    keywords = extract_keywords(query)
+def set_vector_search_params(cursor, ef_search: int = None, probes: int = None):
+    """
+    Sets the ANN recall/latency knobs for the current transaction only.
+    Higher ef_search (HNSW) or probes (IVFFlat) = better recall, slower queries.
+    """
+    ef_search = ef_search or VECTOR_SEARCH_CONFIG["ef_search"]
+    probes = probes or VECTOR_SEARCH_CONFIG["probes"]
+    cursor.execute("SET LOCAL hnsw.ef_search = %s;", (int(ef_search),))
+    cursor.execute("SET LOCAL ivfflat.probes = %s;", (int(probes),))
 
-    conn = get_connection()
+
+def fetch_candidates(conn, vector_str: str, query: str, limit: int = 40,
+                     ef_search: int = None, probes: int = None):
+    """Runs the vector and full-text legs of the hybrid search on one connection."""
     cursor = conn.cursor()
+    set_vector_search_params(cursor, ef_search, probes)
 
     # 1. Fetch Top 40 by Vector Similarity
-    sql_vector = """
-        SELECT id, url, title, content,
-               (1 - (embedding <=> %s)) as score
-        FROM documents
-        WHERE embedding IS NOT NULL
-        ORDER BY embedding <=> %s
-        LIMIT 40;
-    """
-    cursor.execute(sql_vector, (vector_str, vector_str))
+    execute_prepared(conn, cursor, "vector_search", (vector_str, limit))
     vector_results = cursor.fetchall()
 
-    # 2. Fetch Top 40 by Keyword Matching
-    keyword_results = []
-    if keywords:
-        like_clauses = []
-        params = []
-        for word in keywords:
-            like_clauses.append("(title ILIKE %s OR content ILIKE %s)")
-            params.extend([f"%{word}%", f"%{word}%"])
-
-        keyword_sql = " + ".join([f"(CASE WHEN {clause} THEN 1 ELSE 0 END)" for clause in like_clauses])
-
-        sql_keyword = f"""
-            SELECT id, url, title, content,
-                   ({keyword_sql}) as score
-            FROM documents
-            WHERE { " OR ".join(like_clauses) }
-            ORDER BY ({keyword_sql}) DESC
-            LIMIT 40;
-        """
-        # We need to repeat params for: 1. SELECT, 2. WHERE, 3. ORDER BY
-        all_params = params * 3
-        cursor.execute(sql_keyword, all_params)
-        keyword_results = cursor.fetchall()
+    # 2. Fetch Top 40 by full-text rank (GIN index on search_vector)
+    execute_prepared(conn, cursor, "keyword_search", (query, limit))
+    keyword_results = cursor.fetchall()
 
     cursor.close()
-    conn.close()
+    return vector_results, keyword_results
+
 
-    # 3. Reciprocal Rank Fusion (RRF)
+def rrf_fuse(vector_results: list, keyword_results: list, k: int = RRF_K,
+             max_candidates: int = RERANK_CANDIDATES, max_per_url: int = MAX_CHUNKS_PER_URL) -> list:
+    """
+    Python-side Reciprocal Rank Fusion + per-URL diversity cap over two full result lists.
+    This is the original two-query path; search_similar_documents now does the same
+    work in SQL (fetch_fused_candidates). Kept for benchmarking and comparison.
+    """
     # RRF Score = 1 / (rank + k), where k is a constant (e.g., 60)
-    k = 60
     scores = {}
     doc_map = {}
 
@@ -142,22 +734,288 @@ def search_similar_documents(query: str, limit: int = 5):
     candidates = []
     url_counts = {}
     for doc_id in sorted_ids:
-        if len(candidates) >= 20:
+        if len(candidates) >= max_candidates:
             break
         doc = doc_map[doc_id]
         url = doc.get("url", "")
-        if url_counts.get(url, 0) >= 2:
+        if url_counts.get(url, 0) >= max_per_url:
             continue
         url_counts[url] = url_counts.get(url, 0) + 1
         doc["rrf_score"] = scores[doc_id]
         doc["distance"] = 1 - doc.get("score", 0) if "score" in doc else 1.0
         candidates.append(doc)
 
-    # Rerank candidates with FlashRank cross-encoder
-    passages = [{"id": i, "text": doc["content"]} for i, doc in enumerate(candidates)]
-    rerank_request = RerankRequest(query=query, passages=passages)
-    reranked = reranker.rerank(rerank_request)
+    return candidates
+
+
+def _fused_statement(vector_str: str, query: str, candidate_limit: int, k: int, max_candidates: int,
+                     max_per_url: int, top_pages: int, rescore: int = None) -> tuple[str, tuple]:
+    """
+    (statement name, params) for flat (top_pages=0) or two-level fused search; the
+    _rescored form of either when VECTOR_QUANTIZATION is set, with a shortlist of
+    `rescore` (default VECTOR_SEARCH_CONFIG["rescore"]) rows.
+    """
+    if top_pages:
+        name = "page_fused_search"
+        max_candidates = max_candidates or TWO_LEVEL_CONFIG["rerank_candidates"]
+        params = (vector_str, query, candidate_limit, k, max_per_url, max_candidates, top_pages)
+    else:
+        name = "fused_search"
+        max_candidates = max_candidates or RERANK_CANDIDATES
+        params = (vector_str, query, candidate_limit, k, max_per_url, max_candidates)
+    if f"{name}_rescored" in PREPARED_STATEMENTS:
+        rescore = VECTOR_SEARCH_CONFIG["rescore"] if rescore is None else rescore
+        return f"{name}_rescored", params + (max(candidate_limit, rescore),)
+    return name, params
+
+
+def _search_ef(ef_search: int = None, top_pages: int = 0) -> int:
+    """
+    ef_search for this query. A quantized shortlist on the flat search needs at least
+    `rescore` rows from HNSW; the two-level search only uses HNSW to pick top_pages pages.
+    """
+    ef_search = ef_search or VECTOR_SEARCH_CONFIG["ef_search"]
+    if not top_pages and "fused_search_rescored" in PREPARED_STATEMENTS:
+        ef_search = max(ef_search, VECTOR_SEARCH_CONFIG["rescore"])
+    return int(ef_search)
+
+
+def fetch_fused_candidates(conn, vector_str: str, query: str, candidate_limit: int = 40,
+                           k: int = RRF_K, max_candidates: int = None,
+                           max_per_url: int = MAX_CHUNKS_PER_URL,
+                           ef_search: int = None, probes: int = None, top_pages: int = None) -> list:
+    """
+    Both retrieval legs, RRF fusion and the per-URL cap in one round trip
+    (the fused_search prepared statement). Only the final candidates carry content.
+    With top_pages (default TWO_LEVEL_CONFIG["pages"]) the legs only rank chunks of the
+    best-matching pages (page_fused_search); if no page has a summary embedding yet,
+    this falls back to the flat search.
+    """
+    top_pages = TWO_LEVEL_CONFIG["pages"] if top_pages is None else top_pages
+    cursor = conn.cursor()
+    set_vector_search_params(cursor, _search_ef(ef_search, top_pages), probes)
+    name, params = _fused_statement(vector_str, query, candidate_limit, k, max_candidates, max_per_url, top_pages)
+    execute_prepared(conn, cursor, name, params)
+    candidates = cursor.fetchall()
+    if not candidates and top_pages:
+        set_vector_search_params(cursor, _search_ef(ef_search), probes)
+        name, params = _fused_statement(vector_str, query, candidate_limit, k, max_candidates, max_per_url, 0)
+        execute_prepared(conn, cursor, name, params)
+        candidates = cursor.fetchall()
+    cursor.close()
+
+    for doc in candidates:
+        doc["distance"] = 1 - doc["score"] if doc["score"] is not None else 1.0
+    return candidates
+
+
+async def afetch_fused_candidates(conn, vector_str: str, query: str, candidate_limit: int = 40,
+                                  k: int = RRF_K, max_candidates: int = None,
+                                  max_per_url: int = MAX_CHUNKS_PER_URL,
+                                  ef_search: int = None, probes: int = None, top_pages: int = None) -> list:
+    """fetch_fused_candidates on an asyncpg connection; must run inside a transaction (SET LOCAL)."""
+    top_pages = TWO_LEVEL_CONFIG["pages"] if top_pages is None else top_pages
+    probes = int(probes or VECTOR_SEARCH_CONFIG["probes"])
+    await conn.execute(f"SET LOCAL hnsw.ef_search = {_search_ef(ef_search, top_pages)}; "
+                       f"SET LOCAL ivfflat.probes = {probes};")
+    name, params = _fused_statement(vector_str, query, candidate_limit, k, max_candidates, max_per_url, top_pages)
+    rows = await conn.fetch(PREPARED_STATEMENTS[name], *params)
+    if not rows and top_pages:
+        await conn.execute(f"SET LOCAL hnsw.ef_search = {_search_ef(ef_search)};")
+        name, params = _fused_statement(vector_str, query, candidate_limit, k, max_candidates, max_per_url, 0)
+        rows = await conn.fetch(PREPARED_STATEMENTS[name], *params)
+
+    candidates = [dict(row) for row in rows]
+    for doc in candidates:
+        doc["distance"] = 1 - doc["score"] if doc["score"] is not None else 1.0
+    return candidates
+
+
+def _add_neighbours(results: list, neighbours: list) -> list:
+    """
+    Appends prev/next chunks of the final results that aren't results themselves.
+    A neighbour inherits its anchor's scores so the context stage keeps it with
+    (and merges it into) the anchor's block; "neighbour_of" marks it as expansion.
+    """
+    by_id = {doc["id"]: doc for doc in results}
+    expanded = list(results)
+    for doc in neighbours:
+        if doc["id"] in by_id:
+            continue
+        anchor = by_id[doc["neighbour_of"]]
+        doc["rrf_score"] = anchor.get("rrf_score", 0)
+        doc["rerank_score"] = anchor.get("rerank_score", doc["rrf_score"])
+        doc["distance"] = anchor.get("distance", 1.0)
+        by_id[doc["id"]] = doc
+        expanded.append(doc)
+    return expanded
+
+
+def expand_neighbours(results: list, backend=None) -> list:
+    """Widens the final chunks with their prev/next chunks (one lookup by id)."""
+    if not results:
+        return results
+    backend = backend or get_retrieval_backend()
+    with tracing.span("neighbour_expand") as span:
+        expanded = _add_neighbours(results, backend.neighbours([doc["id"] for doc in results]))
+        span.set("added", len(expanded) - len(results))
+    return expanded
+
+
+async def aexpand_neighbours(results: list, backend=None) -> list:
+    """expand_neighbours without blocking the event loop."""
+    if not results:
+        return results
+    backend = backend or get_retrieval_backend()
+    with tracing.span("neighbour_expand") as span:
+        expanded = _add_neighbours(results, await backend.aneighbours([doc["id"] for doc in results]))
+        span.set("added", len(expanded) - len(results))
+    return expanded
+
+
+# -------------------------
+# Retrieval backends
+# -------------------------
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "postgres")  # "postgres" or "mmap"
+
+
+class RetrievalBackend:
+    """
+    Where search_similar_documents gets its fused candidates and neighbour chunks;
+    embedding the query and reranking happen around it and are shared by every backend.
+    Candidates are dicts with id, url, title, content, chunk_index, page_title,
+    rrf_score, score and distance, best first.
+    """
+
+    name = ""
+
+    def candidates(self, embedding: list[float], query: str, candidate_limit: int = 40, k: int = None,
+                   max_candidates: int = None, ef_search: int = None, probes: int = None,
+                   top_pages: int = None) -> list:
+        raise NotImplementedError
+
+    def neighbours(self, ids: list) -> list:
+        """prev/next chunks of `ids`, each with "neighbour_of" set to the id it neighbours."""
+        raise NotImplementedError
 
+    async def acandidates(self, *args, **kwargs) -> list:
+        return await asyncio.to_thread(self.candidates, *args, **kwargs)
+
+    async def aneighbours(self, ids: list) -> list:
+        return await asyncio.to_thread(self.neighbours, ids)
+
+
+class PostgresBackend(RetrievalBackend):
+    """fused_search / page_fused_search on the psycopg2 pool, or the asyncpg pool when awaited."""
+
+    name = "postgres"
+
+    def candidates(self, embedding, query, candidate_limit=40, k=None, max_candidates=None,
+                   ef_search=None, probes=None, top_pages=None):
+        # Vector + full-text candidates, RRF and URL diversity in a single statement,
+        # so the vector leg, keyword leg and fusion share one "retrieval_sql" span
+        with pooled_connection() as conn, tracing.span("retrieval_sql") as span:
+            candidates = fetch_fused_candidates(conn, to_vector_str(embedding), query, candidate_limit,
+                                                k or RRF_K, max_candidates, ef_search=ef_search, probes=probes,
+                                                top_pages=top_pages)
+            span.set("candidates", len(candidates))
+        return candidates
+
+    async def acandidates(self, embedding, query, candidate_limit=40, k=None, max_candidates=None,
+                          ef_search=None, probes=None, top_pages=None):
+        pool = await get_async_pool()
+        async with pool.acquire() as conn, conn.transaction():
+            with tracing.span("retrieval_sql") as span:
+                candidates = await afetch_fused_candidates(conn, to_vector_str(embedding), query, candidate_limit,
+                                                           k or RRF_K, max_candidates,
+                                                           ef_search=ef_search, probes=probes,
+                                                           top_pages=top_pages)
+                span.set("candidates", len(candidates))
+        return candidates
+
+    def neighbours(self, ids):
+        with pooled_connection() as conn:
+            cursor = conn.cursor()
+            execute_prepared(conn, cursor, "neighbour_chunks", (ids,))
+            neighbours = cursor.fetchall()
+            cursor.close()
+        return neighbours
+
+    async def aneighbours(self, ids):
+        pool = await get_async_pool()
+        rows = await pool.fetch(PREPARED_STATEMENTS["neighbour_chunks"], ids)
+        return [dict(row) for row in rows]
+
+
+_backends = {}
+
+
+def get_retrieval_backend(name: str = None) -> RetrievalBackend:
+    """The configured backend (RETRIEVAL_BACKEND), created once per process."""
+    name = name or RETRIEVAL_BACKEND
+    if name not in _backends:
+        if name == "postgres":
+            _backends[name] = PostgresBackend()
+        elif name == "mmap":
+            from app.vector_store import MmapBackend
+            _backends[name] = MmapBackend()
+        else:
+            raise ValueError(f"Unknown retrieval backend: {name}")
+    return _backends[name]
+
+
+def _cached_scores(query: str, candidates: list) -> tuple[dict, list]:
+    """({candidate index: cached score}, passages still to score) from the rerank score cache."""
+    # Same key normalization as the coalescer and answer cache
+    cached = rerank_score_cache.get_many(normalize_text(query), [doc["id"] for doc in candidates])
+    scores = {i: cached[doc["id"]] for i, doc in enumerate(candidates) if doc["id"] in cached}
+    passages = [{"id": i, "text": doc["content"]} for i, doc in enumerate(candidates) if i not in scores]
+    return scores, passages
+
+
+def _merge_scores(query: str, candidates: list, scores: dict, reranked: list) -> list:
+    """Adds freshly scored passages to `scores` and the cache; returns all of them best first."""
+    fresh = {item["id"]: float(item["score"]) for item in reranked}
+    rerank_score_cache.put_many(normalize_text(query), {candidates[i]["id"]: score for i, score in fresh.items()})
+    scores.update(fresh)
+    return sorted(({"id": i, "score": score} for i, score in scores.items()),
+                  key=lambda item: item["score"], reverse=True)
+
+
+def rerank_candidates(query: str, candidates: list, limit: int) -> list:
+    """
+    Reorders candidates with the FlashRank cross-encoder and keeps the top `limit`.
+    Scoring goes through the shared rerank service, which batches concurrent requests;
+    passages already scored for this query come from the rerank score cache. If the
+    rerank workers died, this request keeps the RRF order while the service restarts them.
+    """
+    scores, passages = _cached_scores(query, candidates)
+    with tracing.span("rerank", passages=len(passages), cached=len(scores)) as span:
+        try:
+            reranked = rerank_service.rerank(query, passages) if passages else []
+        except BrokenExecutor as e:
+            return _rrf_fallback(span, candidates, limit, e)
+    return _apply_rerank(candidates, _merge_scores(query, candidates, scores, reranked), limit)
+
+
+async def arerank_candidates(query: str, candidates: list, limit: int) -> list:
+    """rerank_candidates without blocking the event loop while the batch is scored."""
+    scores, passages = _cached_scores(query, candidates)
+    with tracing.span("rerank", passages=len(passages), cached=len(scores)) as span:
+        try:
+            reranked = await asyncio.wrap_future(rerank_service.submit(query, passages)) if passages else []
+        except BrokenExecutor as e:
+            return _rrf_fallback(span, candidates, limit, e)
+    return _apply_rerank(candidates, _merge_scores(query, candidates, scores, reranked), limit)
+
+
+def _rrf_fallback(span, candidates: list, limit: int, error: BaseException) -> list:
+    print(f"Reranker unavailable, keeping RRF order: {error!r}")
+    span.set("fallback", True)
+    return candidates[:limit]
+
+
+def _apply_rerank(candidates: list, reranked: list, limit: int) -> list:
     # Build final results in reranked order
     final_results = []
     for item in reranked[:limit]:
@@ -168,6 +1026,104 @@ def search_similar_documents(query: str, limit: int = 5):
     return final_results
 
 
+def plan_retrieval(candidates: list, k: int = None) -> dict:
+    """
+    Confidence of a first pass, from its fused scores:
+
+    - agreement: how close the top candidate is to ranking first in both legs (1.0),
+      versus being found by one leg only (0.0)
+    - margin: relative RRF gap between the top two candidates
+
+    Returns {"path", "agreement", "margin"}; path is "skip" (no rerank), "short"
+    (rerank the head of the pool) or "deep" (full-depth pool, rerank all).
+    """
+    k = k or RRF_K
+    top = candidates[0]["rrf_score"] if candidates else 0.0
+    second = candidates[1]["rrf_score"] if len(candidates) > 1 else 0.0
+    agreement = min(1.0, max(0.0, top * (k + 1) - 1))
+    margin = (top - second) / top if top else 0.0
+    if agreement >= ADAPTIVE_CONFIG["skip_agreement"] and margin >= ADAPTIVE_CONFIG["skip_margin"]:
+        path = "skip"
+    elif agreement >= ADAPTIVE_CONFIG["deep_agreement"]:
+        path = "short"
+    else:
+        path = "deep"
+    return {"path": path, "agreement": round(agreement, 3), "margin": round(margin, 3)}
+
+
+def _rerank_pool(plan: dict, candidates: list, limit: int) -> list:
+    """Candidates the plan sends to the reranker."""
+    if plan["path"] == "skip":
+        return []
+    if plan["path"] == "short":
+        return candidates[:max(limit, ADAPTIVE_CONFIG["short_rerank"])]
+    return candidates
+
+
+def _annotate_retrieval(plan: dict, pool: int, candidates: list, reranked: list):
+    tracing.annotate("retrieval", {**plan, "pool": pool, "candidates": len(candidates),
+                                   "reranked": len(reranked)})
+
+
+def search_similar_documents(query: str, limit: int = 5, ef_search: int = None, probes: int = None,
+                             backend: str = None, adaptive: bool = None):
+    """
+    Hybrid search + rerank. With adaptive retrieval (ADAPTIVE_CONFIG, or `adaptive`)
+    the candidate pool and rerank depth follow plan_retrieval; the path taken is
+    annotated on the current trace as "retrieval".
+    """
+    adaptive = ADAPTIVE_CONFIG["enabled"] if adaptive is None else adaptive
+    embedding = generate_embedding(query)
+    retrieval = get_retrieval_backend(backend)
+    pool = ADAPTIVE_CONFIG["shallow_per_leg"] if adaptive else CANDIDATES_PER_LEG
+    candidates = retrieval.candidates(embedding, query, pool, RRF_K,
+                                      ef_search=ef_search, probes=probes)
+
+    if not candidates:
+        return []
+
+    plan = plan_retrieval(candidates) if adaptive else {"path": "full"}
+    if plan["path"] == "deep":
+        pool = CANDIDATES_PER_LEG
+        candidates = retrieval.candidates(embedding, query, pool, RRF_K,
+                                          ef_search=ef_search, probes=probes) or candidates
+
+    # Rerank candidates with FlashRank cross-encoder
+    reranked = _rerank_pool(plan, candidates, limit)
+    results = rerank_candidates(query, reranked, limit) if reranked else candidates[:limit]
+    _annotate_retrieval(plan, pool, candidates, reranked)
+    if TWO_LEVEL_CONFIG["expand_neighbours"]:
+        results = expand_neighbours(results, retrieval)
+    return results
+
+
+async def asearch_similar_documents(query: str, limit: int = 5, ef_search: int = None, probes: int = None,
+                                    backend: str = None, adaptive: bool = None):
+    """search_similar_documents for the async request path (asyncpg + awaited rerank)."""
+    adaptive = ADAPTIVE_CONFIG["enabled"] if adaptive is None else adaptive
+    embedding = await agenerate_embedding(query)
+    retrieval = get_retrieval_backend(backend)
+    pool = ADAPTIVE_CONFIG["shallow_per_leg"] if adaptive else CANDIDATES_PER_LEG
+    candidates = await retrieval.acandidates(embedding, query, pool, RRF_K,
+                                             ef_search=ef_search, probes=probes)
+
+    if not candidates:
+        return []
+
+    plan = plan_retrieval(candidates) if adaptive else {"path": "full"}
+    if plan["path"] == "deep":
+        pool = CANDIDATES_PER_LEG
+        candidates = await retrieval.acandidates(embedding, query, pool, RRF_K,
+                                                 ef_search=ef_search, probes=probes) or candidates
+
+    reranked = _rerank_pool(plan, candidates, limit)
+    results = await arerank_candidates(query, reranked, limit) if reranked else candidates[:limit]
+    _annotate_retrieval(plan, pool, candidates, reranked)
+    if TWO_LEVEL_CONFIG["expand_neighbours"]:
+        results = await aexpand_neighbours(results, retrieval)
+    return results
+
+
 # -------------------------
 # Manual test
 # -------------------------
@@ -1,12 +1,191 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
 from langchain_ollama import OllamaEmbeddings
+from app import tracing
 
 EMBED_MODEL = "nomic-embed-text"
 
 embeddings = OllamaEmbeddings(model=EMBED_MODEL)
 
+EMBED_CACHE_CONFIG = {
+    "max_entries": int(os.environ.get("EMBED_CACHE_SIZE", 2048)),
+    # Empty path disables the persistent SQLite tier; the file is created on first use
+    "path": os.environ.get("EMBED_CACHE_PATH", "embedding_cache.sqlite3"),
+    # Seconds before an entry is re-embedded; 0 keeps entries until evicted
+    "ttl_s": float(os.environ.get("EMBED_CACHE_TTL", 0)),
+}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapses whitespace so trivially different queries share a cache entry. Case is
+    kept: nomic-embed-text is case-sensitive, so "RAG" and "rag" embed differently.
+    """
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Two-tier query embedding cache keyed on (model, normalized text).
+
+    Tier 1 is a bounded in-memory LRU. Tier 2 is an optional SQLite file that
+    survives restarts, opened on first use so merely importing this module creates
+    nothing; rows from any other model are purged when it is opened, so changing
+    EMBED_MODEL invalidates the cache automatically.
+    """
+
+    def __init__(self, model: str, max_entries: int = 2048, path: str = "", ttl_s: float = 0):
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Separate locks: an in-memory lookup (made on the event loop) never waits for
+        # a SQLite read or commit running in a worker thread
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.path = path
+        self._db = None
+
+    def _disk(self):
+        """The SQLite tier (None if disabled), opened on first call; caller holds _db_lock."""
+        if self._db is None and self.path:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (model, text)
+                )
+            """)
+            self._db.execute("DELETE FROM embeddings WHERE model != ?", (self.model,))
+            self._db.commit()
+        return self._db
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_s > 0 and time.time() - created_at > self.ttl_s
+
+    def get(self, text: str):
+        """Memory, then disk; counts a miss if neither has the text."""
+        vector = self.get_memory(text)
+        return vector if vector is not None else self.get_disk(text)
+
+    def get_memory(self, text: str):
+        """In-memory tier only (no I/O, safe on the event loop); a miss here isn't counted."""
+        key = normalize_text(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        return None
+
+    def get_disk(self, text: str):
+        """SQLite tier (blocking); promotes a hit into memory, counts a miss otherwise."""
+        key = normalize_text(text)
+        with self._db_lock:
+            db = self._disk()
+            row = db.execute(
+                "SELECT vector, created_at FROM embeddings WHERE model = ? AND text = ?",
+                (self.model, key)
+            ).fetchone() if db is not None else None
+        with self._lock:
+            if row is not None and not self._expired(row[1]):
+                vector = array("f", row[0]).tolist()
+                self._remember(key, vector, row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return vector
+            self.misses += 1
+            return None
+
+    def put(self, text: str, vector: list[float]):
+        key = normalize_text(text)
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, vector, created_at)
+        with self._db_lock:
+            db = self._disk()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO embeddings (model, text, vector, created_at) VALUES (?, ?, ?, ?)",
+                    (self.model, key, array("f", vector).tobytes(), created_at)
+                )
+                db.commit()
+
+    def _remember(self, key: str, vector: list[float], created_at: float):
+        self._entries[key] = (vector, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        with self._db_lock:
+            db = self._disk()
+            if db is not None:
+                db.execute("DELETE FROM embeddings WHERE model = ?", (self.model,))
+                db.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "model": self.model,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+query_cache = EmbeddingCache(EMBED_MODEL, **EMBED_CACHE_CONFIG)
+
 
 def generate_embedding(text: str) -> list[float]:
-    return embeddings.embed_query(text)
+    with tracing.span("embed_query") as span:
+        cached = query_cache.get(text)
+        span.set("cache_hit", cached is not None)
+        if cached is not None:
+            return cached
+        vector = embeddings.embed_query(text)
+        query_cache.put(text, vector)
+        return vector
+
+
+async def agenerate_embedding(text: str) -> list[float]:
+    """
+    Async generate_embedding for the event-loop request path. Only the in-memory lookup
+    runs on the loop; the SQLite read and write run in a thread.
+    """
+    with tracing.span("embed_query") as span:
+        cached = query_cache.get_memory(text)
+        if cached is None:
+            cached = await asyncio.to_thread(query_cache.get_disk, text)
+        span.set("cache_hit", cached is not None)
+        if cached is not None:
+            return cached
+        vector = await embeddings.aembed_query(text)
+        await asyncio.to_thread(query_cache.put, text, vector)
+        return vector
+
+
+def generate_embeddings(texts: list[str]) -> list[list[float]]:
+    """Embeds several texts in one Ollama request."""
+    if not texts:
+        return []
+    return embeddings.embed_documents(texts)
 
 
 if __name__ == "__main__":
@@ -14,4 +193,6 @@ if __name__ == "__main__":
     embedding = generate_embedding(test_text)
     print("Embedding generated!")
     print(f"Vector length: {len(embedding)}")
-    print("First 5 values:", embedding[:5])
\ No newline at end of file
+    print("First 5 values:", embedding[:5])
+    generate_embedding("  " + test_text)
+    print("Cache stats:", query_cache.stats())
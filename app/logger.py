@@ -1,15 +1,164 @@
+import atexit
 import json
 import os
+import queue
+import sqlite3
+import threading
 from datetime import datetime
+from app.metrics import metrics
 
+LOG_DB = os.environ.get("LOG_DB", "chat_logs.sqlite3")
+# Legacy rewrite-on-every-request log; imported into LOG_DB once if present
 LOG_FILE = "chat_logs.jsonl"
-MAX_LOGS = 500
+MAX_LOGS = int(os.environ.get("LOG_MAX_ENTRIES", 500))
+# Entries waiting for the writer thread; beyond this new entries are dropped, never blocked on
+LOG_QUEUE_SIZE = 10000
 
-def log_interaction(query: str, normalized_query: str, results: list, answer: str, latency_ms: float, user_email: str = "Anonymous", user_name: str = "Guest", session_start: str = None):
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+_schema_ready = False
+_readers = threading.local()
+dropped_entries = 0
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    """
+    Opens the interaction log database. WAL mode + busy timeout let several uvicorn
+    workers append and the API read concurrently without corrupting the file.
+    """
+    conn = sqlite3.connect(path or LOG_DB, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+
+def _ensure_schema(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS interactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            session_start TEXT,
+            user_email TEXT,
+            latency_ms REAL,
+            entry TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS interactions_user_idx ON interactions (user_email, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS interactions_session_idx ON interactions (session_start, id);")
+    conn.commit()
+    _import_legacy_log(conn)
+
+
+def _setup():
+    """Creates the table and imports the legacy log, once per process (writer or first reader)."""
+    global _schema_ready
+    with _writer_lock:
+        if not _schema_ready:
+            conn = connect()
+            try:
+                _ensure_schema(conn)
+            finally:
+                conn.close()
+            _schema_ready = True
+
+
+def _reader() -> sqlite3.Connection:
+    """This thread's read-only connection, opened once and reused (e.g. by every /logs/stream poll)."""
+    conn = getattr(_readers, "conn", None)
+    if conn is None:
+        _setup()
+        conn = sqlite3.connect(LOG_DB, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON;")
+        _readers.conn = conn
+    return conn
+
+
+def _insert(conn: sqlite3.Connection, entries: list):
+    conn.executemany(
+        "INSERT INTO interactions (timestamp, session_start, user_email, latency_ms, entry) VALUES (?, ?, ?, ?, ?)",
+        [
+            (e.get("timestamp", ""), e.get("session_start"), e.get("user_email"), e.get("latency_ms"),
+             json.dumps(e, ensure_ascii=False))
+            for e in entries
+        ]
+    )
+    # Rolling window: keep the newest MAX_LOGS rows (cheap range delete on the primary key)
+    conn.execute("DELETE FROM interactions WHERE id <= (SELECT max(id) FROM interactions) - ?", (MAX_LOGS,))
+    conn.commit()
+
+
+def _import_legacy_log(conn: sqlite3.Connection):
+    if not os.path.exists(LOG_FILE):
+        return
+    # Write lock for check + import, so concurrent workers import the file only once
+    conn.execute("BEGIN IMMEDIATE")
+    if conn.execute("SELECT 1 FROM interactions LIMIT 1").fetchone() is not None:
+        conn.rollback()
+        return
+    entries = []
+    with open(LOG_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    _insert(conn, entries)
+    if entries:
+        print(f"Imported {len(entries)} entries from {LOG_FILE} into {LOG_DB}")
+
+
+def _writer_loop():
+    _setup()
+    conn = connect()
+    while True:
+        # Block for one entry, then drain whatever else is queued into the same transaction
+        batch = [_queue.get()]
+        while True:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _insert(conn, batch)
+        except Exception as e:
+            print(f"Failed to write log: {e}")
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+                _writer.start()
+
+
+def flush(timeout: float = 5.0):
+    """Waits (up to timeout) for queued entries to be written. Used at shutdown."""
+    if _writer is None:
+        return
+    done = threading.Event()
+    threading.Thread(target=lambda: (_queue.join(), done.set()), daemon=True).start()
+    done.wait(timeout)
+
+
+atexit.register(flush)
+
+
+def log_interaction(query: str, normalized_query: str, results: list, answer: str, latency_ms: float, user_email: str = "Anonymous", user_name: str = "Guest", session_start: str = None, cache_hit: bool = False, history_stats: dict = None, context_stats: dict = None, coalesced: dict = None, trace=None):
     """
-    Logs the RAG interaction to a .jsonl file for dashboard viewing.
-    Keeps a rolling window of MAX_LOGS entries — oldest are dropped when cap is reached.
+    Logs the RAG interaction for dashboard viewing, with per-stage timings from `trace`.
+    Only builds the entry, updates the in-memory metrics and enqueues it; a background
+    thread appends it to the SQLite log, which keeps a rolling window of MAX_LOGS entries.
     """
+    global dropped_entries
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "session_start": session_start,
@@ -25,22 +174,94 @@ def log_interaction(query: str, normalized_query: str, results: list, answer: st
             } for r in results
         ],
         "answer": answer,
-        "latency_ms": round(latency_ms, 2)
+        "latency_ms": round(latency_ms, 2),
+        "cache_hit": cache_hit,
+        "trace_id": trace.trace_id if trace is not None else None,
+        "stages": trace.stage_timings() if trace is not None else {},
+        "history": history_stats,
+        "context": context_stats,
+        "coalesced": coalesced,
+        "retrieval": trace.attributes.get("retrieval") if trace is not None else None
     }
 
+    metrics.record(log_entry)
+
+    _ensure_writer()
     try:
-        # Read existing lines
-        lines = []
-        if os.path.exists(LOG_FILE):
-            with open(LOG_FILE, "r", encoding="utf-8") as f:
-                lines = [l for l in f if l.strip()]
-
-        # Append new entry, then trim oldest if over cap
-        lines.append(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        if len(lines) > MAX_LOGS:
-            lines = lines[-MAX_LOGS:]
-
-        with open(LOG_FILE, "w", encoding="utf-8") as f:
-            f.writelines(lines)
-    except Exception as e:
-        print(f"Failed to write log: {e}")
+        _queue.put_nowait(log_entry)
+    except queue.Full:
+        dropped_entries += 1
+        print("Failed to write log: queue full, entry dropped")
+
+
+def _project(row, fields: list = None) -> dict:
+    entry = json.loads(row["entry"])
+    if fields:
+        entry = {field: entry.get(field) for field in fields}
+    entry["id"] = row["id"]
+    return entry
+
+
+def read_logs(limit: int = MAX_LOGS) -> list:
+    """Newest-first log entries."""
+    return query_logs(limit=limit)["entries"]
+
+
+def query_logs(since_id: int = None, before_id: int = None, limit: int = 100, fields: list = None,
+               user_email: str = None, session_start: str = None,
+               min_latency_ms: float = None, max_latency_ms: float = None) -> dict:
+    """
+    Filtered, paginated log query. Entries come back newest first with their "id".
+
+    - before_id pages backwards through history (pass the returned next_cursor)
+    - since_id returns only entries newer than it (incremental refresh); if more than
+      `limit` are new, the oldest `limit` are returned and has_more is set
+    - fields projects each entry down to those keys ("id" is always included)
+
+    Filters hit the (user_email, id) / (session_start, id) indexes, so a refresh costs
+    O(new entries) rather than O(log size).
+    """
+    clauses, params = [], []
+    if since_id is not None:
+        clauses.append("id > ?")
+        params.append(since_id)
+    if before_id is not None:
+        clauses.append("id < ?")
+        params.append(before_id)
+    if user_email is not None:
+        clauses.append("user_email = ?")
+        params.append(user_email)
+    if session_start is not None:
+        clauses.append("session_start = ?")
+        params.append(session_start)
+    if min_latency_ms is not None:
+        clauses.append("latency_ms >= ?")
+        params.append(min_latency_ms)
+    if max_latency_ms is not None:
+        clauses.append("latency_ms <= ?")
+        params.append(max_latency_ms)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # Incremental reads walk forward from the cursor so no new entry is skipped
+    order = "ASC" if since_id is not None else "DESC"
+
+    conn = _reader()
+    rows = conn.execute(
+        f"SELECT id, entry FROM interactions {where} ORDER BY id {order} LIMIT ?",
+        (*params, limit)
+    ).fetchall()
+    latest_id = conn.execute("SELECT max(id) AS id FROM interactions").fetchone()["id"]
+
+    entries = [_project(row, fields) for row in rows]
+    if order == "ASC":
+        entries.reverse()
+    return {
+        "entries": entries,
+        "next_cursor": entries[-1]["id"] if entries and order == "DESC" and len(entries) == limit else None,
+        "has_more": order == "ASC" and len(entries) == limit,
+        "latest_id": latest_id,
+    }
+
+
+def get_log(log_id: int):
+    row = _reader().execute("SELECT id, entry FROM interactions WHERE id = ?", (log_id,)).fetchone()
+    return _project(row) if row is not None else None
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from app.chunking import estimate_tokens, shorten
+
+MEMORY_CONFIG = {
+    "max_users": int(os.environ.get("MEMORY_MAX_USERS", 5000)),
+    # Most recent chat_history rows kept per user (the prompt never uses more)
+    "max_messages": int(os.environ.get("MEMORY_MAX_MESSAGES", 10)),
+    # Cached conversations are re-read from Supabase after this long
+    "ttl_s": float(os.environ.get("MEMORY_TTL", 600)),
+}
+
+HISTORY_CONFIG = {
+    # Prompt tokens the chat history may use (num_ctx is 4096)
+    "budget_tokens": int(os.environ.get("HISTORY_TOKEN_BUDGET", 600)),
+    # Newest turns kept verbatim; older ones are cut to their opening sentences
+    "recent_turns": int(os.environ.get("HISTORY_RECENT_TURNS", 2)),
+    "older_turn_tokens": int(os.environ.get("HISTORY_OLDER_TURN_TOKENS", 60)),
+}
+
+# A turn that only partly fits is kept if at least this many tokens remain
+MIN_PARTIAL_TOKENS = 20
+
+
+def _timestamp(value) -> float:
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def _since(messages: list, session_start: str = None) -> list:
+    if not session_start:
+        return list(messages)
+    since = _timestamp(session_start)
+    return [m for m in messages if _timestamp(m.get("created_at")) >= since]
+
+
+class ConversationMemory:
+    """
+    Write-through cache of each user's most recent chat_history rows.
+
+    A user's tail is loaded from Supabase on the first miss, and every message saved
+    through POST /history is appended to it, so follow-up questions skip the read
+    round trip. Session filtering happens locally: a session's messages are always a
+    suffix of the user's timeline. The cache is per process - with several workers a
+    message saved through another worker shows up once the entry expires (ttl_s).
+    """
+
+    def __init__(self, max_users: int = 5000, max_messages: int = 10, ttl_s: float = 600):
+        self.max_users = max_users
+        self.max_messages = max_messages
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()  # user_id -> (loaded_at, [message, ...] oldest first)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, session_start: str = None):
+        """Cached messages (oldest first, since session_start if given), or None on a miss."""
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_s:
+                self.misses += 1
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return _since(entry[1], session_start)
+
+    def load(self, user_id: str, messages: list, session_start: str = None) -> list:
+        """Replaces a user's cached tail with rows read from Supabase (any order); returns it like get()."""
+        messages = sorted(
+            ({"role": m["role"], "content": m["content"], "created_at": m.get("created_at")} for m in messages),
+            key=lambda m: _timestamp(m["created_at"])
+        )
+        messages = messages[-self.max_messages:]
+        with self._lock:
+            self._users[str(user_id)] = (time.monotonic(), messages)
+            self._users.move_to_end(str(user_id))
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return _since(messages, session_start)
+
+    def append(self, user_id: str, message: dict):
+        """Adds a just-saved row. Users that aren't cached are left to load on their next read."""
+        with self._lock:
+            entry = self._users.get(str(user_id))
+            if entry is None:
+                return
+            messages = entry[1] + [{"role": message["role"], "content": message["content"],
+                                    "created_at": message.get("created_at")}]
+            messages.sort(key=lambda m: _timestamp(m["created_at"]))
+            self._users[str(user_id)] = (entry[0], messages[-self.max_messages:])
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._users.pop(str(user_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def _format(message: dict, content: str = None) -> str:
+    role = "AI" if message["role"] == "assistant" else "User"
+    return f"{role}: {message['content'] if content is None else content}"
+
+
+def assemble_history(messages: list, budget_tokens: int = 600, recent_turns: int = 2,
+                     older_turn_tokens: int = 60) -> tuple[str, dict]:
+    """
+    Builds the "AI: ...\\nUser: ..." history block within budget_tokens.
+
+    Walks from the newest turn back: the newest recent_turns are kept whole, older
+    turns are cut to their opening sentences, and once the budget runs out the turn
+    that only partly fits is truncated and everything older is dropped.
+    Returns (history, stats) where stats["tokens_saved"] compares against the old
+    verbatim concatenation of all messages.
+    """
+    verbatim_tokens = estimate_tokens("\n".join(_format(m) for m in messages))
+    lines, used, shortened = [], 0, 0
+    for age, message in enumerate(reversed(messages)):
+        content = message["content"]
+        if age >= recent_turns:
+            short = shorten(content, older_turn_tokens)
+            shortened += short != content
+            content = short
+        line = _format(message, content)
+        tokens = estimate_tokens(line) + 1  # + newline
+        remaining = budget_tokens - used
+        if tokens > remaining:
+            if remaining >= MIN_PARTIAL_TOKENS:
+                prefix_tokens = estimate_tokens(_format(message, "")) + 1
+                lines.append(_format(message, shorten(content, remaining - prefix_tokens)))
+                shortened += 1
+            break
+        lines.append(line)
+        used += tokens
+
+    history = "\n".join(reversed(lines))
+    tokens = estimate_tokens(history)
+    return history, {
+        "messages": len(messages),
+        "included": len(lines),
+        "shortened": shortened,
+        "tokens": tokens,
+        "tokens_saved": max(0, verbatim_tokens - tokens),
+    }
+
+
+conversation_memory = ConversationMemory(**MEMORY_CONFIG)
@@ -0,0 +1,263 @@
+import heapq
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from app.embeddings import normalize_text
+
+NO_ANSWER_PHRASE = "I don't have that information"
+
+# Time windows reported by /metrics
+WINDOWS = {"1m": 60, "5m": 300, "15m": 900, "1h": 3600}
+
+# Prometheus histogram buckets for request latency, in seconds
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30)
+
+# Distinct queries/urls/chunks tracked before the long tail is pruned
+MAX_TRACKED_KEYS = 5000
+
+# Stages that make up retrieval, summed per request for the per-path breakdown
+RETRIEVAL_STAGES = ("embed_query", "retrieval_sql", "retrieval_mmap", "rerank", "neighbour_expand")
+
+
+def _prune(counter: Counter):
+    if len(counter) > MAX_TRACKED_KEYS:
+        keep = counter.most_common(MAX_TRACKED_KEYS // 5)
+        counter.clear()
+        counter.update(dict(keep))
+
+
+def _percentile(ordered: list, pct: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _stage_percentiles(events: list) -> dict:
+    by_stage = {}
+    for event in events:
+        for stage, ms in event[4].items():
+            by_stage.setdefault(stage, []).append(ms)
+    return {
+        stage: {"p50": round(_percentile(sorted(values), 50), 2), "p95": round(_percentile(sorted(values), 95), 2)}
+        for stage, values in by_stage.items()
+    }
+
+
+def _path_breakdown(events: list) -> dict:
+    """Requests, latency, retrieval time and no-answer rate per retrieval path (adaptive or "full")."""
+    by_path = {}
+    for event in events:
+        if event[5]:
+            by_path.setdefault(event[5], []).append(event)
+    breakdown = {}
+    for path, recent in by_path.items():
+        retrieval_ms = sorted(sum(e[4].get(stage, 0) for stage in RETRIEVAL_STAGES) for e in recent)
+        breakdown[path] = {
+            "requests": len(recent),
+            "share": round(len(recent) / len(events), 4),
+            "latency_ms_p50": round(_percentile(sorted(e[1] for e in recent), 50), 2),
+            "retrieval_ms_p50": round(_percentile(retrieval_ms, 50), 2),
+            "no_answer_rate": round(sum(e[2] for e in recent) / len(recent), 4),
+        }
+    return breakdown
+
+
+class MetricsRegistry:
+    """
+    Rolling aggregates over interaction log entries, updated as each entry is logged.
+
+    Keeps the last hour of (time, latency) events for windowed percentiles and rates,
+    all-time counters and a latency histogram for Prometheus, and frequency counters
+    for queries, retrieved URLs and chunks. Each process keeps its own registry.
+    """
+
+    def __init__(self, horizon_s: int = max(WINDOWS.values())):
+        self.horizon_s = horizon_s
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._events = deque()  # (timestamp, latency_ms, no_answer, cache_hit, stages, retrieval path)
+        self.requests_total = 0
+        self.no_answer_total = 0
+        self.cache_hits_total = 0
+        self.coalesced_total = 0
+        self.latency_sum_s = 0.0
+        self.history_tokens_saved_total = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.queries = Counter()
+        self.urls = Counter()
+        self.chunks = Counter()
+        self.retrieval_paths = Counter()
+        self.seeded = False
+
+    @staticmethod
+    def _event(entry: dict, timestamp: float) -> tuple:
+        return (
+            timestamp,
+            float(entry.get("latency_ms") or 0),
+            NO_ANSWER_PHRASE in (entry.get("answer") or ""),
+            bool(entry.get("cache_hit")),
+            entry.get("stages") or {},
+            (entry.get("retrieval") or {}).get("path"),
+        )
+
+    def record(self, entry: dict, timestamp: float = None):
+        event = self._event(entry, timestamp or time.time())
+        with self._lock:
+            self._events.append(event)
+            self._expire(time.time())
+            self._count(entry, event)
+
+    def _count(self, entry: dict, event: tuple):
+        """All-time counters and frequency counters for one entry; caller holds the lock."""
+        _, latency_ms, no_answer, cache_hit, _, path = event
+        self.requests_total += 1
+        self.no_answer_total += no_answer
+        self.cache_hits_total += cache_hit
+        self.coalesced_total += bool((entry.get("coalesced") or {}).get("answer"))
+        self.history_tokens_saved_total += (entry.get("history") or {}).get("tokens_saved", 0)
+        if path:
+            self.retrieval_paths[path] += 1
+        latency_s = latency_ms / 1000
+        self.latency_sum_s += latency_s
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency_s <= bound:
+                self.latency_buckets[i] += 1
+
+        self.queries[normalize_text(entry.get("query") or "").casefold()] += 1
+        for chunk in entry.get("retrieved_chunks") or []:
+            self.urls[chunk.get("url")] += 1
+            self.chunks[chunk.get("title")] += 1
+        _prune(self.queries)
+        _prune(self.urls)
+        _prune(self.chunks)
+
+    def seed(self, entries: list):
+        """
+        Warms the registry from existing log entries written before this process started.
+        The events are built first and merged in time order with the live ones in one
+        step, so a snapshot never sees a half-seeded registry and _expire still finds
+        the oldest event at the head.
+        """
+        seeded = []
+        for entry in entries:
+            try:
+                timestamp = datetime.fromisoformat(entry["timestamp"]).timestamp()
+            except (KeyError, TypeError, ValueError):
+                continue
+            if timestamp < self.started_at:
+                seeded.append((self._event(entry, timestamp), entry))
+        seeded.sort(key=lambda item: item[0][0])
+
+        with self._lock:
+            if self.seeded:
+                return
+            self._events = deque(heapq.merge((event for event, _ in seeded), self._events, key=lambda e: e[0]))
+            self._expire(time.time())
+            for event, entry in seeded:
+                self._count(entry, event)
+            self.seeded = True
+
+    def _expire(self, now: float):
+        while self._events and self._events[0][0] < now - self.horizon_s:
+            self._events.popleft()
+
+    def snapshot(self, top_n: int = 10) -> dict:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            events = list(self._events)
+            windows = {}
+            for name, seconds in WINDOWS.items():
+                recent = [e for e in events if e[0] >= now - seconds]
+                latencies = sorted(e[1] for e in recent)
+                windows[name] = {
+                    "requests": len(recent),
+                    "queries_per_minute": round(len(recent) / (seconds / 60), 2),
+                    "latency_ms": {
+                        "p50": round(_percentile(latencies, 50), 2),
+                        "p95": round(_percentile(latencies, 95), 2),
+                        "p99": round(_percentile(latencies, 99), 2),
+                    },
+                    "no_answer_rate": round(sum(e[2] for e in recent) / len(recent), 4) if recent else 0.0,
+                    "cache_hit_rate": round(sum(e[3] for e in recent) / len(recent), 4) if recent else 0.0,
+                    "stages_ms": _stage_percentiles(recent),
+                    "retrieval_paths": _path_breakdown(recent),
+                }
+            return {
+                "uptime_s": round(now - self.started_at, 1),
+                "totals": {
+                    "requests": self.requests_total,
+                    "no_answer": self.no_answer_total,
+                    "cache_hits": self.cache_hits_total,
+                    "coalesced": self.coalesced_total,
+                    "history_tokens_saved": self.history_tokens_saved_total,
+                    "retrieval_paths": dict(self.retrieval_paths),
+                },
+                "windows": windows,
+                "top_queries": [{"query": q, "count": c} for q, c in self.queries.most_common(top_n)],
+                "top_urls": [{"url": u, "count": c} for u, c in self.urls.most_common(top_n)],
+                "top_chunks": [{"title": t, "count": c} for t, c in self.chunks.most_common(top_n)],
+            }
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition. Aggregate numbers only - no query text or users."""
+        snapshot = self.snapshot(top_n=0)
+        lines = [
+            "# HELP rag_requests_total Answered chat requests.",
+            "# TYPE rag_requests_total counter",
+            f"rag_requests_total {self.requests_total}",
+            "# HELP rag_no_answer_total Answers containing \"I don't have that information\".",
+            "# TYPE rag_no_answer_total counter",
+            f"rag_no_answer_total {self.no_answer_total}",
+            "# HELP rag_answer_cache_hits_total Answers served from the semantic answer cache.",
+            "# TYPE rag_answer_cache_hits_total counter",
+            f"rag_answer_cache_hits_total {self.cache_hits_total}",
+            "# HELP rag_coalesced_total Answers streamed from another in-flight request for the same question.",
+            "# TYPE rag_coalesced_total counter",
+            f"rag_coalesced_total {self.coalesced_total}",
+            "# HELP rag_history_tokens_saved_total Prompt tokens saved by token-budgeted history assembly.",
+            "# TYPE rag_history_tokens_saved_total counter",
+            f"rag_history_tokens_saved_total {self.history_tokens_saved_total}",
+            "# HELP rag_retrieval_path_total Requests by retrieval path (adaptive skip/short/deep, or full).",
+            "# TYPE rag_retrieval_path_total counter",
+            *(f'rag_retrieval_path_total{{path="{path}"}} {count}' for path, count in self.retrieval_paths.items()),
+            "# HELP rag_request_latency_seconds End-to-end RAG request latency.",
+            "# TYPE rag_request_latency_seconds histogram",
+        ]
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            lines.append(f'rag_request_latency_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [
+            f'rag_request_latency_seconds_bucket{{le="+Inf"}} {self.requests_total}',
+            f"rag_request_latency_seconds_sum {round(self.latency_sum_s, 3)}",
+            f"rag_request_latency_seconds_count {self.requests_total}",
+            "# HELP rag_request_latency_window_seconds Latency percentiles over a sliding window.",
+            "# TYPE rag_request_latency_window_seconds gauge",
+        ]
+        for name, window in snapshot["windows"].items():
+            for quantile in ("p50", "p95", "p99"):
+                value = window["latency_ms"][quantile] / 1000
+                lines.append(
+                    f'rag_request_latency_window_seconds{{window="{name}",quantile="0.{quantile[1:]}"}} {value}'
+                )
+        lines += [
+            "# HELP rag_queries_per_minute Request rate over a sliding window.",
+            "# TYPE rag_queries_per_minute gauge",
+        ]
+        for name, window in snapshot["windows"].items():
+            lines.append(f'rag_queries_per_minute{{window="{name}"}} {window["queries_per_minute"]}')
+        lines += [
+            "# HELP rag_stage_latency_window_seconds Per-stage latency percentiles over a sliding window.",
+            "# TYPE rag_stage_latency_window_seconds gauge",
+        ]
+        for name, window in snapshot["windows"].items():
+            for stage, quantiles in window["stages_ms"].items():
+                for quantile, value in quantiles.items():
+                    lines.append(
+                        f'rag_stage_latency_window_seconds{{window="{name}",stage="{stage}",quantile="0.{quantile[1:]}"}} {value / 1000}'
+                    )
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -1,13 +1,21 @@
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_ollama import ChatOllama
-from app.database import search_similar_documents
+from app.database import asearch_similar_documents, search_similar_documents
+from app.embeddings import agenerate_embedding, generate_embedding, normalize_text
+from app.admission import PRIORITY_CHAT, PRIORITY_STREAM, AdmissionRejected, llm_scheduler
+from app.answer_cache import answer_cache
+from app.coalescing import COALESCE_CONFIG, QueuePosition, coalescer
+from app.context import build_context, chunk_number, context_budget, page_title
+from app.tracing import Trace, use_trace
+import os
 
 LLM_MODEL = "qwen2.5:7b"
+LLM_NUM_CTX = int(os.environ.get("LLM_NUM_CTX", 4096))
 
 llm = ChatOllama(
     model=LLM_MODEL,
-    num_ctx=4096,     # Optimized context window for speed and accuracy
+    num_ctx=LLM_NUM_CTX,     # Optimized context window for speed and accuracy
     temperature=0     # Factual responses, no creative drifting
 )
 
@@ -37,12 +45,22 @@ def normalize_question(question: str) -> str:
 
 
 
+import asyncio
+import inspect
 import time
-import re
 import json
 from app.logger import log_interaction
 
 
+def pack_context(results: list, chat_history: str, question: str, trace: Trace) -> tuple[str, dict]:
+    """Fits the retrieved chunks into what num_ctx leaves after the rest of the prompt."""
+    with trace.span("context_pack") as span:
+        budget = context_budget(LLM_NUM_CTX, RAG_PROMPT.template, chat_history, question)
+        context, stats = build_context(results, budget)
+        span.set("tokens", stats["tokens"])
+    return context, stats
+
+
 def extract_sources(results: list) -> list:
     best_by_url = {}
     for r in results:
@@ -55,29 +73,28 @@ def extract_sources(results: list) -> list:
             best_by_url[url] = r
     sources = []
     for url, r in best_by_url.items():
-        raw_title = r.get("title", "")
-        match = re.match(r"^(.*?)\s*\(chunk\s+(\d+)\)\s*$", raw_title, re.IGNORECASE)
-        page_title = match.group(1).strip() if match else raw_title.strip()
-        chunk_num = int(match.group(2)) if match else 1
         score = r.get("rerank_score", r.get("rrf_score", 0))
-        sources.append({"url": url, "title": page_title, "chunk": chunk_num, "_score": score})
+        sources.append({"url": url, "title": page_title(r), "chunk": chunk_number(r) or 1, "_score": score})
     sources.sort(key=lambda x: x["_score"], reverse=True)
     for s in sources:
         del s["_score"]
     return sources
 
 
-def generate_answer(question: str, user_email: str = "Anonymous", user_name: str = "Guest", chat_history: str = "") -> str:
+def generate_answer(question: str, user_email: str = "Anonymous", user_name: str = "Guest", chat_history: str = "", history_stats: dict = None, trace: Trace = None) -> str:
     start_time = time.time()
+    trace = trace or Trace("chat")
     normalized_question = normalize_question(question)
     
     # Use the fast, high-quality RRF hybrid search
     # retrieving 5 chunks for maximum speed while keeping high relevance
     print(f"DEBUG: Contextual Memory (History Buffer):\n{chat_history}\n")
     print(f"\nPerforming fast RRF search for: {normalized_question}")
-    results = search_similar_documents(normalized_question, limit=5)
+    with use_trace(trace):
+        results = search_similar_documents(normalized_question, limit=5)
     
     if not results:
+        trace.finish()
         return "I don't know.", []
 
     print("\nRetrieved Chunks (RRF Ranked):\n")
@@ -86,16 +103,37 @@ def generate_answer(question: str, user_email: str = "Anonymous", user_name: str
         print(f"RRF SCORE: {r.get('rrf_score', 0):.4f}")
         print("-" * 50)
 
-    context = "\n\n".join([r["content"] for r in results])
-
-    # Only one LLM call now - for the final answer!
-    answer = chain.invoke({
-        "context": context, 
-        "chat_history": chat_history, 
-        "question": normalized_question
-    })
+    # Semantic answer cache: same retrieved chunks + near-identical question -> reuse answer
+    with use_trace(trace), trace.span("answer_cache"):
+        query_embedding = generate_embedding(normalized_question)
+        cached = answer_cache.get(query_embedding, results, chat_history)
+    cache_hit = cached is not None
+    context_stats = None
+
+    if cache_hit:
+        answer, sources = cached
+    else:
+        context, context_stats = pack_context(results, chat_history, normalized_question, trace)
+
+        # Only one LLM call now - for the final answer! Waits for an LLM slot first;
+        # AdmissionRejected (429/503) propagates to the API
+        ticket = llm_scheduler.enqueue(PRIORITY_CHAT)
+        try:
+            with trace.span("llm_queue"):
+                ticket.wait()
+            with trace.span("llm_generate"):
+                answer = chain.invoke({
+                    "context": context, 
+                    "chat_history": chat_history, 
+                    "question": normalized_question
+                })
+        finally:
+            ticket.release()
+        sources = [] if "I don't have that information" in answer else extract_sources(results)
+        answer_cache.put(query_embedding, results, chat_history, answer, sources)
     
     elapsed_time = (time.time() - start_time) * 1000  # ms
+    trace.finish()
     
     # Log the interaction for the dashboard
     log_interaction(
@@ -105,27 +143,124 @@ def generate_answer(question: str, user_email: str = "Anonymous", user_name: str
         answer=answer,
         latency_ms=elapsed_time,
         user_email=user_email,
-        user_name=user_name
+        user_name=user_name,
+        cache_hit=cache_hit,
+        history_stats=history_stats,
+        context_stats=context_stats,
+        trace=trace
     )
 
-    sources = [] if "I don't have that information" in answer else extract_sources(results)
     return answer, sources
 
 
-def stream_answer(question: str, user_email: str = "Anonymous", user_name: str = "Guest", chat_history: str = "", session_start: str = None):
-    """Generator that yields SSE-formatted token strings from the LLM."""
+def _coalesce_key(*parts):
+    """Key for sharing in-flight work; a unique object when coalescing is off."""
+    return parts if COALESCE_CONFIG["enabled"] else object()
+
+
+def admission_check(question: str):
+    """
+    Fast 429 before a stream starts when the LLM queue is full, unless the question
+    can join an answer that is already being generated.
+    """
+    if not coalescer.answering(("answer", normalize_text(normalize_question(question)))):
+        llm_scheduler.check()
+
+
+async def _shared_search(normalized_question: str, trace: Trace) -> tuple[list, bool]:
+    """Retrieval for the question, shared with concurrent requests for the same question."""
+    async def search():
+        with use_trace(trace):
+            results = await asearch_similar_documents(normalized_question, limit=5)
+        return results, trace.attributes.get("retrieval")
+
+    wait_start = time.perf_counter_ns()
+    (results, plan), shared = await coalescer.call(_coalesce_key("search", normalize_text(normalized_question)), search)
+    if shared:
+        # The stages themselves are in the trace of the request that ran them
+        trace.add_span("retrieval_shared", wait_start, time.perf_counter_ns())
+        if plan is not None:
+            trace.annotate("retrieval", plan)
+    return list(results), shared
+
+
+async def _answer_chunks(flight, normalized_question: str, results: list, chat_history: str, trace: Trace):
+    """
+    Producer of one (possibly shared) answer: answer cache lookup, context packing and
+    the LLM stream. Runs once per flight with the first request's trace; the outcome
+    goes to flight.meta, and the answer is cached once however many requests share it.
+    """
+    with use_trace(trace), trace.span("answer_cache"):
+        query_embedding = await agenerate_embedding(normalized_question)
+        cached = answer_cache.get(query_embedding, results, chat_history)
+
+    if cached is not None:
+        # Replay the stored answer without touching the LLM
+        answer, flight.meta["sources"] = cached
+        flight.meta["cache_hit"] = True
+        yield answer
+        return
+
+    context, flight.meta["context_stats"] = pack_context(results, chat_history, normalized_question, trace)
+    parts = []
+    # Streams queue ahead of /chat; subscribers see the position while this waits
+    ticket = llm_scheduler.enqueue(PRIORITY_STREAM)
+    try:
+        queue_start = time.perf_counter_ns()
+        async for position in ticket.positions():
+            flight.queued(position)
+        trace.add_span("llm_queue", queue_start, time.perf_counter_ns())
+        async for chunk in chain.astream({
+            "context": context,
+            "chat_history": chat_history,
+            "question": normalized_question
+        }):
+            if chunk:
+                parts.append(chunk)
+                yield chunk
+    finally:
+        ticket.release()
+
+    answer = "".join(parts)
+    sources = [] if "I don't have that information" in answer else extract_sources(results)
+    flight.meta["sources"] = sources
+    if parts:
+        answer_cache.put(query_embedding, results, chat_history, answer, sources)
+
+
+async def stream_answer(question: str, user_email: str = "Anonymous", user_name: str = "Guest", chat_history="", session_start: str = None, history_stats: dict = None, trace: Trace = None):
+    """
+    Async generator that yields SSE-formatted token strings from the LLM.
+
+    chat_history is a string or an awaitable resolving to (history, history_stats)
+    (the endpoint's history fetch task); it is awaited concurrently with query
+    embedding and retrieval.
+    Concurrent requests for the same normalized question share one retrieval, and
+    those whose history is also identical share one answer stream: its tokens fan out
+    to every request, and a request that joins mid-answer gets the prefix replayed.
+    The trace is only made current around stages, never across a yield.
+    """
     start_time = time.time()
+    trace = trace or Trace("chat_stream")
     normalized_question = normalize_question(question)
 
-    print(f"DEBUG: Contextual Memory (History Buffer):\n{chat_history}\n")
     print(f"\nPerforming fast RRF search for: {normalized_question}")
 
     results = []
     full_answer_parts = []
     error_msg = None
+    flight = None
+    coalesced = {"retrieval": False, "answer": False}
 
     try:
-        results = search_similar_documents(normalized_question, limit=5)
+        if inspect.isawaitable(chat_history):
+            (results, coalesced["retrieval"]), (chat_history, history_stats) = await asyncio.gather(
+                _shared_search(normalized_question, trace),
+                chat_history
+            )
+        else:
+            results, coalesced["retrieval"] = await _shared_search(normalized_question, trace)
+        print(f"DEBUG: Contextual Memory (History Buffer):\n{chat_history}\n")
 
         if not results:
             yield "data: I don't know.\n\n"
@@ -136,25 +271,48 @@ def stream_answer(question: str, user_email: str = "Anonymous", user_name: str =
                 print(f"RRF SCORE: {r.get('rrf_score', 0):.4f}")
                 print("-" * 50)
 
-            context = "\n\n".join([r["content"] for r in results])
-
-            for chunk in chain.stream({
-                "context": context,
-                "chat_history": chat_history,
-                "question": normalized_question
-            }):
-                if chunk:
-                    full_answer_parts.append(chunk)
-                    safe_chunk = chunk.replace("\n", "\\n")
-                    yield f"data: {safe_chunk}\n\n"
-
+            key = _coalesce_key("answer", normalize_text(normalized_question), normalize_text(chat_history or ""),
+                                tuple(r["id"] for r in results))
+            flight, coalesced["answer"] = coalescer.stream(
+                key, lambda f: _answer_chunks(f, normalized_question, results, chat_history, trace)
+            )
+
+            # TTFT = request sent (or joined) -> first token; generation = first -> last token.
+            # Ollama streams one token per chunk, so chunks/s approximates tokens/s.
+            llm_start = time.perf_counter_ns()
+            first_token = None
+            tokens = 0
+            async for chunk in flight.subscribe():
+                if isinstance(chunk, QueuePosition):
+                    yield f"data: [QUEUED]{json.dumps({'position': int(chunk)})}\n\n"
+                    continue
+                if first_token is None and not flight.meta.get("cache_hit"):
+                    first_token = time.perf_counter_ns()
+                    trace.add_span("llm_ttft", llm_start, first_token, coalesced=coalesced["answer"])
+                tokens += 1
+                full_answer_parts.append(chunk)
+                safe_chunk = chunk.replace("\n", "\\n")
+                yield f"data: {safe_chunk}\n\n"
+            if first_token is not None:
+                llm_end = time.perf_counter_ns()
+                seconds = (llm_end - first_token) / 1e9
+                trace.add_span("llm_generate", first_token, llm_end, tokens=tokens, coalesced=coalesced["answer"],
+                               tokens_per_s=round(tokens / seconds, 2) if seconds > 0 else 0.0)
+
+    except AdmissionRejected as e:
+        # Headers are already sent, so the 503 and Retry-After travel as an event
+        error_msg = str(e)
+        yield f"data: [BUSY]{json.dumps({'status': e.status_code, 'retry_after': e.retry_after})}\n\n"
     except Exception as e:
         error_msg = str(e)
         print(f"ERROR in stream_answer: {error_msg}")
         yield f"data: [ERROR] {error_msg}\n\n"
 
+    meta = flight.meta if flight is not None else {}
+    sources = meta.get("sources")
     full_answer = "".join(full_answer_parts) if full_answer_parts else (f"[ERROR] {error_msg}" if error_msg else "I don't know.")
     elapsed_ms = (time.time() - start_time) * 1000
+    trace.finish()
     log_interaction(
         query=question,
         normalized_query=normalized_question,
@@ -163,13 +321,18 @@ def stream_answer(question: str, user_email: str = "Anonymous", user_name: str =
         latency_ms=elapsed_ms,
         user_email=user_email,
         user_name=user_name,
-        session_start=session_start
+        session_start=session_start,
+        cache_hit=bool(meta.get("cache_hit")),
+        history_stats=history_stats,
+        context_stats=meta.get("context_stats"),
+        coalesced=coalesced,
+        trace=trace
     )
 
-    if "I don't have that information" not in full_answer:
+    if sources is None and "I don't have that information" not in full_answer:
         sources = extract_sources(results)
-        if sources:
-            yield f"data: [SOURCES]{json.dumps(sources, ensure_ascii=False)}\n\n"
+    if sources:
+        yield f"data: [SOURCES]{json.dumps(sources, ensure_ascii=False)}\n\n"
 
     yield "data: [DONE]\n\n"
 
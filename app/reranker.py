@@ -0,0 +1,285 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from flashrank import Ranker
+
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "ms-marco-MiniLM-L-12-v2")
+RERANK_CACHE_DIR = "/tmp/flashrank"
+# Ranker internals used by the workers (session, tokenizer) match this release
+FLASHRANK_VERSION = "0.2.10"
+# FlashRank's listwise (LLM) rerankers order a whole list and give no per-pair score,
+# so they can't be batched across queries
+LISTWISE_MODELS = {"rank_zephyr_7b_v1_full"}
+
+RERANK_CONFIG = {
+    # Worker processes running the cross-encoder; 0 scores in-process (one thread)
+    "workers": int(os.environ.get("RERANK_WORKERS", os.cpu_count() or 1)),
+    # How long the first pending request waits for others to join its batch
+    "max_wait_ms": float(os.environ.get("RERANK_MAX_WAIT_MS", 5)),
+    # Upper bound on (query, passage) pairs per model invocation
+    "max_batch_pairs": int(os.environ.get("RERANK_MAX_BATCH_PAIRS", 320)),
+}
+# (query, chunk id) scores kept by the rerank score cache
+RERANK_SCORE_CACHE_SIZE = int(os.environ.get("RERANK_SCORE_CACHE_SIZE", 20000))
+
+
+# -------------------------
+# Worker side (runs inside each pool process)
+# -------------------------
+_ranker = None
+
+
+def _init_worker(model_name: str, cache_dir: str, threads: int):
+    """Loads the model once per worker and limits ONNX threads so workers don't oversubscribe cores."""
+    global _ranker
+    _ranker = Ranker(model_name=model_name, cache_dir=cache_dir)
+    # _score_pairs drives Ranker's tokenizer and ONNX session directly (Ranker.rerank
+    # takes a single query), so fail here rather than on the first batch if they moved
+    session, tokenizer = getattr(_ranker, "session", None), getattr(_ranker, "tokenizer", None)
+    if not hasattr(session, "run") or not hasattr(tokenizer, "encode_batch"):
+        raise RuntimeError(
+            f"flashrank.Ranker({model_name!r}) has no ONNX session or tokenizer; the reranker "
+            f"needs a pairwise cross-encoder and flashrank=={FLASHRANK_VERSION}"
+        )
+    if threads > 0:
+        try:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            _ranker.session = ort.InferenceSession(session._model_path, options, providers=session.get_providers())
+        except Exception as e:
+            print(f"Reranker worker keeps default ONNX threading: {e}")
+
+
+def _score_pairs(pairs: list) -> list[float]:
+    """
+    Scores (query, passage) pairs from any number of queries in one ONNX run.
+    Mirrors the pairwise path of flashrank.Ranker.rerank, which only accepts a single query.
+    """
+    encoded = _ranker.tokenizer.encode_batch([[query, text] for query, text in pairs])
+    input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+    token_type_ids = np.array([e.type_ids for e in encoded], dtype=np.int64)
+    attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+
+    onnx_input = {"input_ids": input_ids, "attention_mask": attention_mask}
+    if not np.all(token_type_ids == 0):
+        onnx_input["token_type_ids"] = token_type_ids
+
+    logits = _ranker.session.run(None, onnx_input)[0]
+    if logits.shape[1] == 1:
+        scores = 1 / (1 + np.exp(-logits.flatten()))
+    else:
+        exp_logits = np.exp(logits)
+        scores = exp_logits[:, 1] / np.sum(exp_logits, axis=1)
+    return [float(s) for s in scores]
+
+
+# -------------------------
+# Request side
+# -------------------------
+class _Pending:
+    __slots__ = ("query", "passages", "future")
+
+    def __init__(self, query: str, passages: list):
+        self.query = query
+        self.passages = passages
+        self.future = Future()
+
+
+class RerankService:
+    """
+    Micro-batching front end for the cross-encoder.
+
+    Request threads enqueue (query, passages) and block on a Future. One dispatcher
+    thread takes the oldest request, waits up to max_wait_ms for others, and sends
+    all of their pairs to a worker as one model invocation. At most `workers`
+    batches are in flight, so under load requests pile up and form larger batches
+    instead of contending for CPU. If a worker dies (OOM kill, ONNX crash) the broken
+    pool is replaced; the requests of that batch fail with BrokenExecutor.
+    """
+
+    def __init__(self, workers: int = 1, max_wait_ms: float = 5, max_batch_pairs: int = 320,
+                 model_name: str = RERANK_MODEL, cache_dir: str = RERANK_CACHE_DIR):
+        if model_name in LISTWISE_MODELS:
+            raise ValueError(f"{model_name} is a listwise reranker; RERANK_MODEL must be a pairwise cross-encoder")
+        self.workers = workers
+        self.max_wait_s = max_wait_ms / 1000
+        self.max_batch_pairs = max_batch_pairs
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.batches = 0
+        self.requests = 0
+        self.restarts = 0
+        self._queue = queue.Queue()
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max(1, workers))
+        self._lock = threading.Lock()
+        self._dispatcher = None
+
+    def _start(self):
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self._executor = self._new_executor()
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="rerank-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _new_executor(self):
+        if self.workers > 0:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                # spawn: forking a process that already runs threads (uvicorn) is unsafe
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.cache_dir, threads),
+            )
+        return ThreadPoolExecutor(
+            max_workers=1,
+            initializer=_init_worker,
+            initargs=(self.model_name, self.cache_dir, 0),
+        )
+
+    def _recover(self, executor, error: BaseException):
+        """Replaces `executor` if `error` says it is broken (once, however many batches saw it)."""
+        if not isinstance(error, BrokenExecutor):
+            return
+        with self._lock:
+            if self._executor is not executor:
+                return
+            print(f"Rerank workers died, starting a new pool: {error!r}")
+            # Not inline: this can run in a callback under the broken pool's shutdown lock
+            threading.Thread(target=executor.shutdown, kwargs={"wait": False, "cancel_futures": True},
+                             daemon=True).start()
+            self._executor = self._new_executor()
+            self.restarts += 1
+
+    def submit(self, query: str, passages: list) -> Future:
+        """Queues a rerank; the Future resolves to FlashRank-style results sorted by score."""
+        self._start()
+        pending = _Pending(query, passages)
+        if not passages:
+            pending.future.set_result([])
+        else:
+            self._queue.put(pending)
+        return pending.future
+
+    def rerank(self, query: str, passages: list) -> list:
+        return self.submit(query, passages).result()
+
+    def _dispatch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # Wait for a free worker first: requests arriving meanwhile join this batch
+            self._slots.acquire()
+            pairs = len(batch[0].passages)
+            deadline = time.monotonic() + self.max_wait_s
+            while pairs < self.max_batch_pairs:
+                try:
+                    remaining = deadline - time.monotonic()
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                pairs += len(item.passages)
+
+            flat = [(p.query, passage["text"]) for p in batch for passage in p.passages]
+            executor = self._executor
+            try:
+                future = executor.submit(_score_pairs, flat)
+            except Exception as e:
+                self._slots.release()
+                self._recover(executor, e)
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            future.add_done_callback(lambda f, batch=batch, executor=executor: self._complete(batch, f, executor))
+
+    def _complete(self, batch: list, future: Future, executor):
+        self._slots.release()
+        try:
+            scores = future.result()
+        except Exception as e:
+            self._recover(executor, e)
+            for p in batch:
+                p.future.set_exception(e)
+            return
+
+        offset = 0
+        for p in batch:
+            results = []
+            for passage, score in zip(p.passages, scores[offset:offset + len(p.passages)]):
+                results.append({**passage, "score": score})
+            offset += len(p.passages)
+            results.sort(key=lambda x: x["score"], reverse=True)
+            p.future.set_result(results)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "requests": self.requests,
+            "batches": self.batches,
+            "restarts": self.restarts,
+            "avg_batch_requests": round(self.requests / self.batches, 2) if self.batches else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RerankScoreCache:
+    """
+    LRU of cross-encoder scores keyed on (normalize_text(query), chunk id). Chunk content
+    never changes under an id (re-indexing inserts changed chunks with new ids) and
+    the model is fixed per process, so a cached score is exact until evicted. Repeat
+    and coalesced-late questions only score the chunks they haven't seen.
+    """
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, query: str, chunk_ids: list) -> dict:
+        """{chunk id: score} for the ids that are cached."""
+        found = {}
+        with self._lock:
+            for chunk_id in chunk_ids:
+                score = self._scores.get((query, chunk_id))
+                if score is not None:
+                    self._scores.move_to_end((query, chunk_id))
+                    found[chunk_id] = score
+            self.hits += len(found)
+            self.misses += len(chunk_ids) - len(found)
+        return found
+
+    def put_many(self, query: str, scores: dict):
+        with self._lock:
+            for chunk_id, score in scores.items():
+                self._scores[(query, chunk_id)] = score
+                self._scores.move_to_end((query, chunk_id))
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._scores),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+rerank_service = RerankService(**RERANK_CONFIG)
+rerank_score_cache = RerankScoreCache(RERANK_SCORE_CACHE_SIZE)
@@ -0,0 +1,184 @@
+import os
+from app.database import EMBEDDING_DIM, RELINK_CHUNKS_SQL, VECTOR_SEARCH_CONFIG, get_connection
+
+
+# -------------------------
+# Schema migrations (idempotent)
+# -------------------------
+SCHEMA_STATEMENTS = [
+    # Per-chunk fingerprint so re-crawls only embed new or changed chunks
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash TEXT;",
+    "CREATE INDEX IF NOT EXISTS documents_url_idx ON documents (url);",
+    # Full-text index for the lexical leg of hybrid search (title weighted above content)
+    """
+    ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(content, '')), 'B')
+        ) STORED;
+    """,
+    "CREATE INDEX IF NOT EXISTS documents_search_idx ON documents USING GIN (search_vector);",
+    # Per-URL crawl state for conditional GET and skipping unchanged pages
+    """
+    CREATE TABLE IF NOT EXISTS page_state (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT,
+        links TEXT[] NOT NULL DEFAULT '{}',
+        crawled_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """,
+    # Chunk ordinal within its page and links to the neighbouring chunks
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_index INT;",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS prev_id INT;",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS next_id INT;",
+    # Rows indexed before chunk_index existed: recover it from the "(chunk N)" title
+    r"""
+    UPDATE documents
+    SET chunk_index = substring(title from '\(chunk (\d+)\)\s*$')::int - 1
+    WHERE chunk_index IS NULL AND title ~ '\(chunk \d+\)\s*$';
+    """,
+    RELINK_CHUNKS_SQL.format(where=""),
+    # One row per indexed page; summary_embedding is the centroid of its chunk embeddings
+    """
+    CREATE TABLE IF NOT EXISTS pages (
+        url TEXT PRIMARY KEY,
+        title TEXT,
+        chunk_count INT NOT NULL DEFAULT 0,
+        summary_embedding VECTOR(768),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS pages_summary_idx ON pages USING hnsw (summary_embedding vector_cosine_ops);",
+    r"""
+    INSERT INTO pages (url, title, chunk_count, summary_embedding)
+    SELECT url,
+           min(regexp_replace(title, '\s*\(chunk \d+\)\s*$', '')),
+           count(*),
+           avg(embedding)
+    FROM documents
+    WHERE embedding IS NOT NULL
+    GROUP BY url
+    ON CONFLICT (url) DO NOTHING;
+    """,
+]
+
+
+def ensure_schema():
+    """Applies SCHEMA_STATEMENTS. Safe to run on every ingestion."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    for statement in SCHEMA_STATEMENTS:
+        cursor.execute(statement)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+# -------------------------
+# ANN index on documents.embedding
+# -------------------------
+VECTOR_INDEX_NAME = "documents_embedding_idx"
+
+VECTOR_INDEX_CONFIG = {
+    "method": os.environ.get("VECTOR_INDEX_METHOD", "hnsw"),  # "hnsw" or "ivfflat"
+    "m": int(os.environ.get("HNSW_M", 16)),
+    "ef_construction": int(os.environ.get("HNSW_EF_CONSTRUCTION", 64)),
+    # IVFFlat list count; 0 derives it from the row count (rows / 1000, at least 10)
+    "lists": int(os.environ.get("IVFFLAT_LISTS", 0)),
+}
+
+# (indexed expression, operator class) per VECTOR_QUANTIZATION; the expressions
+# match QUANTIZED_DISTANCE in app/database.py so the rescored search can use the index
+VECTOR_INDEX_KEYS = {
+    "none": ("embedding", "vector_cosine_ops"),
+    "halfvec": (f"(embedding::halfvec({EMBEDDING_DIM}))", "halfvec_cosine_ops"),
+    "binary": (f"(binary_quantize(embedding)::bit({EMBEDDING_DIM}))", "bit_hamming_ops"),
+}
+
+
+def _vector_index_sql(cursor, method: str, quantization: str = "none") -> str:
+    if quantization not in VECTOR_INDEX_KEYS:
+        raise ValueError(f"Unknown vector quantization: {quantization}")
+    expression, opclass = VECTOR_INDEX_KEYS[quantization]
+    if method == "hnsw":
+        return (
+            f"CREATE INDEX CONCURRENTLY {VECTOR_INDEX_NAME} ON documents "
+            f"USING hnsw ({expression} {opclass}) "
+            f"WITH (m = {VECTOR_INDEX_CONFIG['m']}, ef_construction = {VECTOR_INDEX_CONFIG['ef_construction']});"
+        )
+    if method == "ivfflat":
+        lists = VECTOR_INDEX_CONFIG["lists"]
+        if not lists:
+            cursor.execute("SELECT count(*) AS n FROM documents;")
+            lists = max(10, cursor.fetchone()["n"] // 1000)
+        return (
+            f"CREATE INDEX CONCURRENTLY {VECTOR_INDEX_NAME} ON documents "
+            f"USING ivfflat ({expression} {opclass}) WITH (lists = {lists});"
+        )
+    raise ValueError(f"Unknown vector index method: {method}")
+
+
+def ensure_vector_index(method: str = None, rebuild: bool = False, quantization: str = None) -> str:
+    """
+    Creates the ANN index on documents.embedding if it is missing or invalid, replaces
+    it if it was built with a different method or quantization (VECTOR_QUANTIZATION), and
+    rebuilds it when rebuild=True (e.g. after a full re-index, or after an IVFFlat
+    corpus has grown). All operations are CONCURRENTLY so searches keep working.
+    Returns what was done.
+    """
+    method = method or VECTOR_INDEX_CONFIG["method"]
+    quantization = quantization or VECTOR_SEARCH_CONFIG["quantization"]
+    opclass = VECTOR_INDEX_KEYS.get(quantization, ("", quantization))[1]
+    label = method if quantization == "none" else f"{method} ({quantization})"
+    conn = get_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        # A CREATE INDEX CONCURRENTLY that failed or was interrupted leaves an INVALID
+        # index under the same name, which the planner never uses; treat it as missing
+        cursor.execute("""
+            SELECT i.indexdef, x.indisvalid
+            FROM pg_indexes i
+            JOIN pg_namespace n ON n.nspname = i.schemaname
+            JOIN pg_class c ON c.relname = i.indexname AND c.relnamespace = n.oid
+            JOIN pg_index x ON x.indexrelid = c.oid
+            WHERE i.indexname = %s;
+        """, (VECTOR_INDEX_NAME,))
+        row = cursor.fetchone()
+        if row is not None and (not row["indisvalid"]
+                                or f"using {method}" not in row["indexdef"].lower()
+                                or opclass not in row["indexdef"].lower()):
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME};")
+            row = None
+
+        if row is None:
+            cursor.execute(_vector_index_sql(cursor, method, quantization))
+            action = f"created {label} index"
+        elif rebuild:
+            cursor.execute(f"REINDEX INDEX CONCURRENTLY {VECTOR_INDEX_NAME};")
+            action = f"rebuilt {label} index"
+        else:
+            action = f"{label} index up to date"
+
+        cursor.execute("ANALYZE documents;")
+        return action
+    finally:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply schema migrations and manage the vector index")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default=None)
+    parser.add_argument("--quantization", choices=list(VECTOR_INDEX_KEYS), default=None,
+                        help="must match VECTOR_QUANTIZATION of the API processes")
+    parser.add_argument("--rebuild-index", action="store_true")
+    args = parser.parse_args()
+
+    ensure_schema()
+    print("Schema is up to date.")
+    print(f"Vector index: {ensure_vector_index(args.method, rebuild=args.rebuild_index, quantization=args.quantization)}")
@@ -1,22 +1,23 @@
+import time
 import requests
 from bs4 import BeautifulSoup
-from app.chunking import chunk_text
-from app.database import insert_document
+from app.chunking import chunk_text, content_hash
+from app.database import sync_page_chunks, save_page_state, touch_page_state, delete_page
 from urllib.parse import urljoin, urlparse
-from app.database import get_connection
 
 
-def scrape_page(url: str) -> dict:
-    response = requests.get(url)
-    response.raise_for_status()
+def parse_page(url: str, html: str) -> dict:
+    """Parses a fetched page once, returning its title, clean text and internal links."""
+    soup = BeautifulSoup(html, "html.parser")
 
-    soup = BeautifulSoup(response.text, "html.parser")
+    # Collect links before removing nav/header/footer, which hold most of the site's links
+    links = extract_internal_links(soup, url)
 
     # Remove scripts, styles and layout/navigation elements
     for tag in soup(["script", "style", "noscript", "nav", "header", "footer"]):
         tag.decompose()
 
-    title = soup.title.string.strip() if soup.title else "No Title"
+    title = soup.title.string.strip() if soup.title and soup.title.string else "No Title"
 
     # Extract visible text
     main = soup.find("main")
@@ -32,9 +33,17 @@ def scrape_page(url: str) -> dict:
     return {
         "url": url,
         "title": title,
-        "content": clean_text
+        "content": clean_text,
+        "links": links
     }
 
+
+def scrape_page(url: str) -> dict:
+    response = requests.get(url)
+    response.raise_for_status()
+    return parse_page(url, response.text)
+
+
 def extract_internal_links(soup, base_url: str) -> set:
     links = set()
     parsed_base = urlparse(base_url)
@@ -57,60 +66,94 @@ def extract_internal_links(soup, base_url: str) -> set:
     return links
 
 
+def ingest_page(data: dict, page_states: dict, force: bool = False) -> dict:
+    """
+    Incrementally indexes one crawled page. Pages that answered 304 or whose text hash
+    is unchanged are skipped; otherwise only new/changed chunks are embedded and chunks
+    that disappeared are deleted. force=True re-embeds the whole page.
+    Returns chunk counts {inserted, deleted, unchanged} plus "skipped" for skipped pages.
+    """
+    url = data["url"]
+    if data.get("not_modified") and not force:
+        touch_page_state(url)
+        return {"inserted": 0, "deleted": 0, "unchanged": 0, "skipped": 1}
+
+    # Hash title + text so a retitled page still updates its "(chunk N)" labels
+    page_hash = content_hash(data["title"] + "\n" + data["content"])
+    previous = page_states.get(url, {})
+    if previous.get("content_hash") == page_hash and not force:
+        save_page_state(url, data.get("etag"), data.get("last_modified"), page_hash, data["links"])
+        return {"inserted": 0, "deleted": 0, "unchanged": 0, "skipped": 1}
+
+    chunks = [
+        {
+            "title": f"{data['title']} (chunk {i+1})",
+            "content": chunk,
+            "content_hash": content_hash(chunk)
+        } for i, chunk in enumerate(chunk_text(data["content"]))
+    ]
+    stats = sync_page_chunks(url, chunks, force=force, title=data["title"])
+    save_page_state(url, data.get("etag"), data.get("last_modified"), page_hash, data["links"])
+    return {**stats, "skipped": 0}
+
+
 if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from app.crawler import AsyncCrawler
+    from app.database import RETRIEVAL_BACKEND, get_page_states
+    from app.schema import ensure_schema, ensure_vector_index
+
+    parser = argparse.ArgumentParser(description="Crawl the site and (re-)index it")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore ETags and content hashes and re-embed every page")
+    args = parser.parse_args()
+
     try:
         base_url = "https://alphawave.hr/"
 
-        visited = set()
-        to_visit = set([base_url])
+        ensure_schema()
+        page_states = {} if args.full else get_page_states()
+        totals = {"inserted": 0, "deleted": 0, "unchanged": 0, "skipped": 0}
+        ingest_seconds = 0.0
+
+        def on_page(data: dict):
+            global ingest_seconds
+            ingest_start = time.perf_counter()
+            stats = ingest_page(data, page_states, force=args.full)
+            ingest_seconds += time.perf_counter() - ingest_start
+            for key in totals:
+                totals[key] += stats[key]
+            status = "unchanged" if stats["skipped"] else \
+                f"+{stats['inserted']} -{stats['deleted']} ={stats['unchanged']} chunks"
+            print(f"Indexed: {data['url']} ({status})")
 
         print("Starting crawl...")
+        crawler = AsyncCrawler(base_url, page_state=page_states)
+        crawl_start = time.perf_counter()
+        pages = asyncio.run(crawler.crawl(on_page))
+        print(f"\nCrawled {pages} pages in {time.perf_counter() - crawl_start:.1f}s "
+              f"({totals['skipped']} unchanged)")
+
+        for url in sorted(crawler.gone):
+            print(f"Removing deleted page: {url} ({delete_page(url)} chunks)")
+
+        print(f"Chunks: {totals['inserted']} embedded, {totals['deleted']} deleted, "
+              f"{totals['unchanged']} reused")
+        if ingest_seconds > 0 and totals["inserted"]:
+            print(f"Ingested {totals['inserted']} chunks in {ingest_seconds:.1f}s "
+                  f"({totals['inserted'] / ingest_seconds:.1f} chunks/sec)")
+
+        print("\nUpdating vector index and running ANALYZE...")
+        print(f"Vector index: {ensure_vector_index(rebuild=args.full)}")
 
-        while to_visit:
-            url = to_visit.pop()
-
-            if url in visited:
-                continue
-
-            print(f"\nScraping: {url}")
-
-            try:
-                data = scrape_page(url)
-            except Exception as e:
-                print(f"Failed to scrape {url}: {e}")
-                visited.add(url)
-                continue
-            visited.add(url)
-            
-            # Extract links from current page
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, "html.parser")
-            links = extract_internal_links(soup, base_url)
-
-            for link in links:
-                if link not in visited:
-                    to_visit.add(link)
-
-            # Chunk and insert
-            chunks = chunk_text(data["content"])
-
-            for i, chunk in enumerate(chunks):
-                insert_document(
-                    url=url,
-                    title=f"{data['title']} (chunk {i+1})",
-                    content=chunk
-                )
-
-        print("\nRunning ANALYZE...")
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("ANALYZE documents;")
-        conn.commit()
-        cursor.close()
-        conn.close()
+        if RETRIEVAL_BACKEND == "mmap":
+            from app.vector_store import build_vector_store
+            store = build_vector_store()
+            print(f"Vector store: {store['version']} ({store['chunks']} chunks), swapped in for running workers")
 
         print("\nCrawl completed successfully!")
 
     except Exception as e:
         print("Error occurred:")
-        print(e)
\ No newline at end of file
+        print(e)
@@ -0,0 +1,200 @@
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# OTLP/JSON trace export (one resourceSpans document per line); empty disables export
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+SERVICE_NAME = "alphawave-rag"
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_unix_ns", "duration_ns", "attributes")
+
+    def __init__(self, name: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_unix_ns = time.time_ns()
+        self.duration_ns = 0
+        self.attributes = dict(attributes or {})
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    """Stand-in yielded by span() when no trace is active, so callers can always .set()."""
+
+    def set(self, key: str, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+class Trace:
+    """
+    Per-request collection of timed spans. Cheap enough to leave on: a span is two
+    perf_counter_ns calls and a list append. Use as trace.span("stage") directly, or
+    activate with use_trace(trace) so tracing.span() in lower layers records into it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._stack = []
+        self._root = Span(name)
+        self._root_start = time.perf_counter_ns()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = self._stack[-1].span_id if self._stack else self._root.span_id
+        span = Span(name, parent, attributes)
+        self._stack.append(span)
+        start = time.perf_counter_ns()
+        try:
+            yield span
+        finally:
+            span.duration_ns = time.perf_counter_ns() - start
+            # remove() rather than pop(): concurrent asyncio stages can finish out of order
+            self._stack.remove(span)
+            self.spans.append(span)
+
+    def add_span(self, name: str, start_perf_ns: int, end_perf_ns: int, **attributes) -> Span:
+        """Records a span measured by hand (e.g. time-to-first-token inside a stream loop)."""
+        span = Span(name, self._root.span_id, attributes)
+        span.start_unix_ns = self._root.start_unix_ns + (start_perf_ns - self._root_start)
+        span.duration_ns = end_perf_ns - start_perf_ns
+        self.spans.append(span)
+        return span
+
+    def annotate(self, key: str, value):
+        """Sets a request-level attribute (on the root span), e.g. which retrieval path ran."""
+        self._root.set(key, value)
+
+    @property
+    def attributes(self) -> dict:
+        return self._root.attributes
+
+    def stage_timings(self) -> dict:
+        """{stage name: total ms} for the interaction log, in the order stages started."""
+        timings = {}
+        for span in sorted(self.spans, key=lambda s: s.start_unix_ns):
+            timings[span.name] = round(timings.get(span.name, 0) + span.duration_ns / 1e6, 2)
+        return timings
+
+    def finish(self):
+        self._root.duration_ns = time.perf_counter_ns() - self._root_start
+        if TRACE_EXPORT_PATH:
+            _export(self)
+
+    def to_otlp(self) -> dict:
+        """OTLP/JSON representation, loadable by OpenTelemetry collectors' file receivers."""
+        def encode(span: Span) -> dict:
+            encoded = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_unix_ns),
+                "endTimeUnixNano": str(span.start_unix_ns + span.duration_ns),
+                "attributes": [
+                    {"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()
+                ],
+            }
+            if span.parent_id:
+                encoded["parentSpanId"] = span.parent_id
+            return encoded
+
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "app.tracing"},
+                    "spans": [encode(self._root)] + [encode(s) for s in self.spans],
+                }],
+            }]
+        }
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, dict):
+        return {"stringValue": json.dumps(value)}
+    return {"stringValue": str(value)}
+
+
+@contextmanager
+def use_trace(trace):
+    """Makes `trace` current for tracing.span() calls made in this block (same thread)."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Records a span into the current trace, or does nothing when no trace is active."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+    with trace.span(name, **attributes) as s:
+        yield s
+
+
+def annotate(key: str, value):
+    """Trace.annotate on the current trace, or nothing when no trace is active."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotate(key, value)
+
+
+# -------------------------
+# Background exporter (off the request path)
+# -------------------------
+_export_queue = queue.Queue(maxsize=10000)
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def _export_loop():
+    while True:
+        batch = [_export_queue.get()]
+        while True:
+            try:
+                batch.append(_export_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(t.to_otlp()) + "\n" for t in batch)
+        except Exception as e:
+            print(f"Failed to export traces: {e}")
+
+
+def _export(trace: Trace):
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+                _exporter.start()
+    try:
+        _export_queue.put_nowait(trace)
+    except queue.Full:
+        pass
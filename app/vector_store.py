@@ -0,0 +1,436 @@
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import numpy as np
+from app import database, tracing
+from app.database import RetrievalBackend, get_connection, rrf_fuse
+from app.embeddings import EMBED_MODEL
+
+VECTOR_STORE_CONFIG = {
+    # Root directory holding store versions and the CURRENT pointer
+    "path": os.environ.get("VECTOR_STORE_DIR", "vector_store"),
+    # float32 is searched in place with BLAS. float16 halves the file (and page cache)
+    # but is converted block by block on every query, ~15x slower per search
+    "dtype": os.environ.get("VECTOR_STORE_DTYPE", "float32"),
+    # How often readers check CURRENT for a newer version
+    "reload_check_s": float(os.environ.get("VECTOR_STORE_RELOAD_S", 2)),
+    # Versions kept on disk (older ones may still be mapped by other workers)
+    "keep_versions": int(os.environ.get("VECTOR_STORE_KEEP", 2)),
+    # First-pass codes: "none" (exact scan), "int8" (4x smaller) or "binary" (32x smaller).
+    # The shortlist (VECTOR_RESCORE_CANDIDATES rows) is rescored from the float matrix
+    "quantization": os.environ.get("VECTOR_STORE_QUANTIZATION", "none"),
+}
+
+CURRENT_FILE = "CURRENT"
+EMBEDDINGS_FILE = "embeddings.npy"
+CODES_FILE = "codes.npy"
+SCALES_FILE = "scales.npy"
+META_FILE = "meta.json"
+QUANTIZATIONS = ("none", "int8", "binary")
+# Rows converted to float32 per matmul when the matrix is float16 or int8
+MATMUL_BLOCK_ROWS = 4096
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 2  # title terms count double, like the 'A' weight of search_vector
+
+TOKEN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have how i in is it its of on or that the this "
+    "to was were what when where which who why will with you your do does can".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN.findall(text.lower()) if t not in STOP_WORDS]
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-dimension int8 codes; matrix ~= codes * scales."""
+    scales = np.abs(matrix).max(axis=0, initial=0).astype(np.float32) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(matrix / scales), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def quantize_binary(matrix: np.ndarray) -> np.ndarray:
+    """Sign bits packed 8 per byte: (N, dim / 8) uint8."""
+    return np.packbits(np.asarray(matrix) > 0, axis=-1)
+
+
+# Set bits per byte value, for numpy versions without bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(codes: np.ndarray, query_bits: np.ndarray) -> np.ndarray:
+    """Hamming distance of packed query bits to every row of packed codes."""
+    diff = np.bitwise_xor(codes, query_bits)
+    if hasattr(np, "bitwise_count") and diff.shape[1] % 8 == 0:
+        return np.bitwise_count(diff.view(np.uint64)).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT[diff].sum(axis=1, dtype=np.int32)
+
+
+class VectorStore:
+    """
+    One immutable store version: an (N, dim) matrix of L2-normalized chunk embeddings,
+    memory-mapped read-only so every worker shares the same page-cached copy, plus the
+    chunk metadata from the sidecar meta.json. Vector search is an exact top-k over a
+    single matmul; the keyword leg is BM25 over an inverted index built on load.
+
+    With quantization the first pass scans compact codes instead (int8 dot products or
+    binary Hamming distance) and only the best `rescore` rows are read from the float
+    matrix and rescored exactly, so the hot working set is the codes file.
+    """
+
+    def __init__(self, path: str, quantization: str = None):
+        self.path = path
+        self.version = os.path.basename(path)
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.meta = meta
+        self.chunks = meta["chunks"]
+        # Some numpy versions can't mmap the zero-length data of an empty store
+        self.matrix = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r" if meta["count"] else None)
+        self.row_of = {chunk_id: row for row, chunk_id in enumerate(self.chunks["id"])}
+        self.quantize(quantization or meta.get("quantization", "none"))
+        self._build_keyword_index()
+
+    def quantize(self, mode: str):
+        """
+        Switches the first-pass representation. Codes written by the build are mapped
+        from disk; other modes are computed in memory from the float matrix.
+        """
+        if mode not in QUANTIZATIONS:
+            raise ValueError(f"Unknown vector store quantization: {mode}")
+        self.quantization, self.codes, self.scales = mode, None, None
+        if mode == "none":
+            return
+        if self.meta.get("quantization") == mode:
+            self.codes = np.load(os.path.join(self.path, CODES_FILE), mmap_mode="r" if self.meta["count"] else None)
+            if mode == "int8":
+                self.scales = np.load(os.path.join(self.path, SCALES_FILE))
+        elif mode == "int8":
+            self.codes, self.scales = quantize_int8(np.asarray(self.matrix, dtype=np.float32))
+        else:
+            self.codes = quantize_binary(self.matrix)
+
+    @property
+    def index_bytes(self) -> int:
+        """Bytes scanned per query by the first pass."""
+        return (self.codes if self.codes is not None else self.matrix).nbytes
+
+    def __len__(self) -> int:
+        return len(self.chunks["id"])
+
+    def _build_keyword_index(self):
+        postings = {}
+        lengths = np.zeros(len(self), dtype=np.float32)
+        for row, (title, content) in enumerate(zip(self.chunks["title"], self.chunks["content"])):
+            counts = {}
+            for term in tokenize(title or ""):
+                counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+            for term in tokenize(content or ""):
+                counts[term] = counts.get(term, 0) + 1
+            lengths[row] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(tf)
+        self.postings = {
+            term: (np.array(rows, dtype=np.int32), np.array(tfs, dtype=np.float32))
+            for term, (rows, tfs) in postings.items()
+        }
+        self.lengths = lengths
+        self.avg_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    def _doc(self, row: int, **scores) -> dict:
+        return {
+            "id": self.chunks["id"][row],
+            "url": self.chunks["url"][row],
+            "title": self.chunks["title"][row],
+            "content": self.chunks["content"][row],
+            "chunk_index": self.chunks["chunk_index"][row],
+            "page_title": self.chunks["page_title"][row],
+            **scores,
+        }
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    @staticmethod
+    def _normalized(embedding) -> np.ndarray:
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm else query
+
+    @staticmethod
+    def _blocked_matmul(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            return matrix @ query
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), MATMUL_BLOCK_ROWS):
+            block = matrix[start:start + MATMUL_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+    def similarities(self, embedding) -> np.ndarray:
+        """Cosine similarity of the query to every chunk."""
+        return self._blocked_matmul(self.matrix, self._normalized(embedding))
+
+    def approximate_scores(self, embedding) -> np.ndarray:
+        """First-pass scores from the codes (higher is better; only the order matters)."""
+        query = self._normalized(embedding)
+        if self.quantization == "int8":
+            return self._blocked_matmul(self.codes, query * self.scales)
+        if self.quantization == "binary":
+            return -hamming_distances(self.codes, quantize_binary(query))
+        return self._blocked_matmul(self.matrix, query)
+
+    def exact_search(self, embedding, k: int) -> list:
+        scores = self.similarities(embedding)
+        return [self._doc(row, score=float(scores[row])) for row in self._top(scores, k)]
+
+    def vector_search(self, embedding, k: int, rescore: int = None) -> list:
+        """Top-k by cosine similarity; quantized stores rescore a shortlist of max(k, rescore) rows."""
+        if self.quantization == "none":
+            return self.exact_search(embedding, k)
+        rescore = database.VECTOR_SEARCH_CONFIG["rescore"] if rescore is None else rescore
+        shortlist = np.sort(self._top(self.approximate_scores(embedding), max(k, rescore)))
+        # Sorted rows keep the reads from the float matrix sequential
+        scores = np.asarray(self.matrix[shortlist], dtype=np.float32) @ self._normalized(embedding)
+        return [self._doc(int(shortlist[i]), score=float(scores[i])) for i in self._top(scores, k)]
+
+    def keyword_search(self, query: str, k: int) -> list:
+        """BM25 with OR semantics over the query terms (the Postgres leg OR-s them too)."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        n = len(self)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, tfs = posting
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[rows] / self.avg_length)
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        matched = int(np.count_nonzero(scores))
+        return [self._doc(row, keyword_score=float(scores[row])) for row in self._top(scores, min(k, matched))]
+
+    def neighbours(self, ids: list) -> list:
+        found = []
+        for chunk_id in ids:
+            row = self.row_of.get(chunk_id)
+            if row is None:
+                continue
+            for neighbour_id in (self.chunks["prev_id"][row], self.chunks["next_id"][row]):
+                neighbour_row = self.row_of.get(neighbour_id)
+                if neighbour_row is not None:
+                    found.append({**self._doc(neighbour_row), "neighbour_of": chunk_id})
+        return found
+
+
+# -------------------------
+# Building (ingestion side)
+# -------------------------
+def _read_current(root: str):
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def build_vector_store(root: str = None, dtype: str = None, quantization: str = None) -> dict:
+    """
+    Exports every embedded chunk from Postgres into a new store version and makes it
+    current. The version is written completely before CURRENT is replaced (os.replace
+    is atomic), so readers see either the old or the new store, never a partial one.
+    Returns {version, chunks, bytes, index_bytes}.
+    """
+    root = root or VECTOR_STORE_CONFIG["path"]
+    dtype = np.dtype(dtype or VECTOR_STORE_CONFIG["dtype"])
+    quantization = quantization or VECTOR_STORE_CONFIG["quantization"]
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown vector store quantization: {quantization}")
+    os.makedirs(root, exist_ok=True)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT d.id, d.url, d.title, d.content, d.chunk_index, d.prev_id, d.next_id,
+               p.title AS page_title, d.embedding::text AS embedding
+        FROM documents d
+        LEFT JOIN pages p ON p.url = d.url
+        WHERE d.embedding IS NOT NULL
+        ORDER BY d.id;
+    """)
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    if rows:
+        matrix = np.array([json.loads(row["embedding"]) for row in rows], dtype=np.float32)
+    else:
+        # Nothing embedded yet (fresh database): an empty store that matches no query
+        matrix = np.zeros((0, database.EMBEDDING_DIM), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1, norms)
+
+    version = f"v{time.time_ns()}"
+    path = os.path.join(root, version)
+    os.makedirs(path)
+    np.save(os.path.join(path, EMBEDDINGS_FILE), matrix.astype(dtype))
+    index_bytes = matrix.shape[0] * matrix.shape[1] * dtype.itemsize
+    if quantization == "int8":
+        codes, scales = quantize_int8(matrix)
+        np.save(os.path.join(path, CODES_FILE), codes)
+        np.save(os.path.join(path, SCALES_FILE), scales)
+        index_bytes = codes.nbytes
+    elif quantization == "binary":
+        codes = quantize_binary(matrix)
+        np.save(os.path.join(path, CODES_FILE), codes)
+        index_bytes = codes.nbytes
+    columns = ("id", "url", "title", "content", "chunk_index", "prev_id", "next_id", "page_title")
+    meta = {
+        "version": version,
+        "model": EMBED_MODEL,
+        "dim": int(matrix.shape[1]),
+        "dtype": dtype.name,
+        "quantization": quantization,
+        "count": len(rows),
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "chunks": {column: [row[column] for row in rows] for column in columns},
+    }
+    with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    pointer = os.path.join(root, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(pointer, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(root, CURRENT_FILE))
+
+    _prune_versions(root, keep=VECTOR_STORE_CONFIG["keep_versions"])
+    return {"version": version, "chunks": len(rows), "bytes": matrix.shape[0] * matrix.shape[1] * dtype.itemsize,
+            "index_bytes": index_bytes}
+
+
+def _prune_versions(root: str, keep: int):
+    current = _read_current(root)
+    versions = sorted(name for name in os.listdir(root) if name.startswith("v") and name != current)
+    for name in versions[:max(0, len(versions) - (keep - 1))]:
+        # Files still mapped by a worker can't be removed on Windows; try again next build
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+# -------------------------
+# Serving side
+# -------------------------
+class MmapBackend(RetrievalBackend):
+    """
+    Retrieval from the embedded store instead of Postgres: exact vector top-k and BM25
+    keyword top-k, fused with the same RRF + per-URL cap as the SQL path. Picks up a
+    rebuilt store within reload_check_s without a restart. Until a store has been
+    built, requests are served by the Postgres backend.
+    """
+
+    name = "mmap"
+
+    def __init__(self, root: str = None, reload_check_s: float = None):
+        self.root = root or VECTOR_STORE_CONFIG["path"]
+        self.reload_check_s = VECTOR_STORE_CONFIG["reload_check_s"] if reload_check_s is None else reload_check_s
+        self.store = None
+        self.reloads = 0
+        self.fallbacks = 0
+        self._missing_logged = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """The newest store version, or None if none was built; loading a new one swaps a single reference."""
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_check_s:
+            return self.store
+        with self._lock:
+            self._checked_at = now
+            version = _read_current(self.root)
+            if version is None:
+                if not self._missing_logged:
+                    self._missing_logged = True
+                    print(f"No vector store in {self.root}, using Postgres until "
+                          f"python -m app.vector_store build has run")
+            elif self.store is None or self.store.version != version:
+                self.store = VectorStore(os.path.join(self.root, version))
+                self.reloads += 1
+        return self.store
+
+    def _fallback(self) -> RetrievalBackend:
+        self.fallbacks += 1
+        return database.get_retrieval_backend("postgres")
+
+    def candidates(self, embedding, query: str, candidate_limit: int = 40, k: int = None,
+                   max_candidates: int = None, **params) -> list:
+        store = self.current()
+        if store is None:
+            return self._fallback().candidates(embedding, query, candidate_limit, k, max_candidates, **params)
+        with tracing.span("retrieval_mmap") as span:
+            vector_results = store.vector_search(embedding, candidate_limit)
+            keyword_results = store.keyword_search(query, candidate_limit)
+            candidates = rrf_fuse(vector_results, keyword_results, k or database.RRF_K,
+                                  max_candidates or database.RERANK_CANDIDATES, database.MAX_CHUNKS_PER_URL)
+            span.set("candidates", len(candidates))
+
+        # Like fused_search: score/distance are the vector similarity, None if only the keyword leg matched
+        similarity = {doc["id"]: doc["score"] for doc in vector_results}
+        for doc in candidates:
+            doc["score"] = similarity.get(doc["id"])
+            doc["distance"] = 1 - doc["score"] if doc["score"] is not None else 1.0
+        return candidates
+
+    def neighbours(self, ids: list) -> list:
+        store = self.current()
+        if store is None:
+            return self._fallback().neighbours(ids)
+        return store.neighbours(ids)
+
+    def stats(self) -> dict:
+        store = self.store
+        return {
+            "version": store.version if store is not None else None,
+            "chunks": len(store) if store is not None else 0,
+            "dtype": store.matrix.dtype.name if store is not None else None,
+            "quantization": store.quantization if store is not None else None,
+            "reloads": self.reloads,
+            "fallbacks": self.fallbacks,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or inspect the embedded vector store")
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--dir", default=None)
+    parser.add_argument("--dtype", choices=["float16", "float32"], default=None)
+    parser.add_argument("--quantization", choices=list(QUANTIZATIONS), default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        result = build_vector_store(args.dir, args.dtype, args.quantization)
+        print(f"Built {result['version']}: {result['chunks']} chunks, "
+              f"{result['bytes'] / 1e6:.1f} MB of vectors ({result['index_bytes'] / 1e6:.1f} MB scanned per query) "
+              f"in {time.perf_counter() - start:.1f}s")
+    else:
+        backend = MmapBackend(args.dir)
+        store = backend.current()
+        if store is None:
+            raise SystemExit(f"No vector store in {backend.root}")
+        print(json.dumps({k: v for k, v in store.meta.items() if k != "chunks"}, indent=2))
@@ -2,6 +2,13 @@ import React, { useState, useEffect, useRef } from 'react';
 import './ChatWidget.css';
 import { supabase } from "./supabaseClient";
 
+// 429/503 from the API (LLM queue full or too long a wait), as a message for the chat
+function busyError(retryAfter) {
+    const error = new Error(`The assistant is busy right now. Please try again in ${retryAfter || 'a few'} seconds.`);
+    error.busy = true;
+    return error;
+}
+
 const ChatWidget = ({ onExpand, sessionStart }) => {
     const [isOpen, setIsOpen] = useState(false);
     const [messages, setMessages] = useState([]);
@@ -72,6 +79,9 @@ const ChatWidget = ({ onExpand, sessionStart }) => {
                 body: JSON.stringify({ question: userMsg.content, session_start: sessionStart }),
             });
 
+            if (response.status === 429 || response.status === 503) {
+                throw busyError(response.headers.get('Retry-After'));
+            }
             if (!response.ok) throw new Error(`HTTP error: ${response.status}`);
 
             const reader = response.body.getReader();
@@ -103,6 +113,19 @@ const ChatWidget = ({ onExpand, sessionStart }) => {
                         if (payload.startsWith('[ERROR]')) {
                             throw new Error(payload.slice(8));
                         }
+                        if (payload.startsWith('[QUEUED]')) {
+                            // Waiting for a free LLM slot; replaced by the first token
+                            const { position } = JSON.parse(payload.slice(8));
+                            setMessages((prev) => {
+                                const updated = [...prev];
+                                updated[updated.length - 1] = { ...updated[updated.length - 1], content: `Waiting for a free slot (position ${position})...` };
+                                return updated;
+                            });
+                            continue;
+                        }
+                        if (payload.startsWith('[BUSY]')) {
+                            throw busyError(JSON.parse(payload.slice(6)).retry_after);
+                        }
                         if (payload.startsWith('[SOURCES]')) {
                             try {
                                 const sources = JSON.parse(payload.slice(9));
@@ -129,7 +152,7 @@ const ChatWidget = ({ onExpand, sessionStart }) => {
             console.error('Error sending message:', error);
             setMessages((prev) => {
                 const updated = [...prev];
-                updated[updated.length - 1] = { role: 'assistant', content: 'Connection error. Please try again later.' };
+                updated[updated.length - 1] = { role: 'assistant', content: error.busy ? error.message : 'Connection error. Please try again later.' };
                 return updated;
             });
         } finally {
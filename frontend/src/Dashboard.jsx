@@ -1,7 +1,44 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import "./Dashboard.css";
 import { supabase } from "./supabaseClient";
 
+const MAX_LOGS = 500;
+// Everything the tables need; full entries (answer etc.) are fetched on click
+const LIST_FIELDS = "timestamp,session_start,user_email,user_name,query,latency_ms,retrieved_chunks,stages,retrieval";
+// Pipeline stages recorded by app/tracing.py, in request order
+const STAGE_COLORS = {
+    history_fetch: "#8e8e93",
+    embed_query: "#5ac8fa",
+    retrieval_sql: "#007aff",
+    retrieval_mmap: "#30b0c7",
+    retrieval_shared: "#64d2ff",
+    rerank: "#af52de",
+    neighbour_expand: "#5856d6",
+    answer_cache: "#ffcc00",
+    context_pack: "#ff2d55",
+    llm_queue: "#ff6482",
+    llm_ttft: "#ff9f10",
+    llm_generate: "#34c759",
+};
+// Retrieval paths logged by app/database.py ("full" = adaptive retrieval off)
+const PATH_COLORS = {
+    skip: "#34c759",
+    short: "#5ac8fa",
+    deep: "#af52de",
+    full: "#8e8e93",
+};
+
+function PathBadge({ retrieval }) {
+    if (!retrieval?.path) return <span className="stage-empty">–</span>;
+    const title = retrieval.agreement === undefined ? undefined
+        : `agreement ${retrieval.agreement}, margin ${retrieval.margin}, reranked ${retrieval.reranked}/${retrieval.candidates}`;
+    return (
+        <span className="path-badge" title={title} style={{ borderColor: PATH_COLORS[retrieval.path] || "#636366" }}>
+            {retrieval.path}
+        </span>
+    );
+}
+
 function groupByUser(logs) {
     const userMap = {};
     logs.forEach(log => {
@@ -30,6 +67,24 @@ function groupByUser(logs) {
     }));
 }
 
+function StageBar({ stages }) {
+    const entries = Object.entries(stages || {}).filter(([, ms]) => ms > 0);
+    const total = entries.reduce((sum, [, ms]) => sum + ms, 0);
+    if (!total) return <span className="stage-empty">—</span>;
+
+    return (
+        <div className="stage-bar" title={entries.map(([name, ms]) => `${name}: ${Math.round(ms)}ms`).join("\n")}>
+            {entries.map(([name, ms]) => (
+                <span
+                    key={name}
+                    className="stage-segment"
+                    style={{ width: `${(ms / total) * 100}%`, background: STAGE_COLORS[name] || "#636366" }}
+                />
+            ))}
+        </div>
+    );
+}
+
 function SessionGroup({ session, onSelectLog }) {
     const [expanded, setExpanded] = useState(false);
 
@@ -65,6 +120,8 @@ function SessionGroup({ session, onSelectLog }) {
                             <th>Time</th>
                             <th>Query</th>
                             <th>Latency</th>
+                            <th>Stages</th>
+                            <th>Path</th>
                             <th>Top Chunk</th>
                             <th>RRF Score</th>
                         </tr>
@@ -77,6 +134,12 @@ function SessionGroup({ session, onSelectLog }) {
                                 <td data-label="Latency" className={`latency-cell ${log.latency_ms > 2000 ? "slow" : "fast"}`}>
                                     {Math.round(log.latency_ms)}ms
                                 </td>
+                                <td data-label="Stages" className="stage-cell">
+                                    <StageBar stages={log.stages} />
+                                </td>
+                                <td data-label="Path">
+                                    <PathBadge retrieval={log.retrieval} />
+                                </td>
                                 <td data-label="Top Chunk" className="chunk-cell">
                                     {log.retrieved_chunks?.[0]?.title || "N/A"}
                                 </td>
@@ -126,28 +189,120 @@ function UserGroup({ user, onSelectLog }) {
     );
 }
 
+function MetricsBar({ metrics }) {
+    const window5m = metrics?.windows?.["5m"];
+    if (!window5m) return null;
+
+    const cards = [
+        { label: "p50 (5m)", value: `${Math.round(window5m.latency_ms.p50)}ms`, slow: window5m.latency_ms.p50 > 2000 },
+        { label: "p95 (5m)", value: `${Math.round(window5m.latency_ms.p95)}ms`, slow: window5m.latency_ms.p95 > 2000 },
+        { label: "p99 (5m)", value: `${Math.round(window5m.latency_ms.p99)}ms`, slow: window5m.latency_ms.p99 > 2000 },
+        { label: "Queries / min", value: window5m.queries_per_minute.toFixed(1) },
+        { label: "No-answer rate", value: `${(window5m.no_answer_rate * 100).toFixed(1)}%` },
+        { label: "Total queries", value: metrics.totals.requests },
+        { label: "History tokens saved", value: metrics.totals.history_tokens_saved ?? 0 },
+    ];
+    const stages = Object.entries(window5m.stages_ms || {});
+    const paths = Object.entries(window5m.retrieval_paths || {});
+
+    return (
+        <div className="metrics-bar">
+            {cards.map(card => (
+                <div key={card.label} className="metric-card">
+                    <span className="metric-label">{card.label}</span>
+                    <span className={`metric-value ${card.slow === undefined ? "" : card.slow ? "slow" : "fast"}`}>
+                        {card.value}
+                    </span>
+                </div>
+            ))}
+            {stages.length > 0 && (
+                <div className="metric-card stage-legend">
+                    <span className="metric-label">Stage p50 / p95 (5m)</span>
+                    {stages.map(([name, q]) => (
+                        <span key={name} className="stage-legend-item">
+                            <span className="stage-swatch" style={{ background: STAGE_COLORS[name] || "#636366" }} />
+                            {name} {Math.round(q.p50)} / {Math.round(q.p95)}ms
+                        </span>
+                    ))}
+                </div>
+            )}
+            {paths.length > 0 && (
+                <div className="metric-card stage-legend">
+                    <span className="metric-label">Retrieval paths (5m): share · retrieval p50 · no-answer</span>
+                    {paths.map(([path, p]) => (
+                        <span key={path} className="stage-legend-item">
+                            <span className="stage-swatch" style={{ background: PATH_COLORS[path] || "#636366" }} />
+                            {path} {(p.share * 100).toFixed(0)}% · {Math.round(p.retrieval_ms_p50)}ms · {(p.no_answer_rate * 100).toFixed(1)}%
+                        </span>
+                    ))}
+                </div>
+            )}
+        </div>
+    );
+}
+
 function Dashboard({ onClose }) {
     const [logs, setLogs] = useState([]);
+    const [metrics, setMetrics] = useState(null);
     const [loading, setLoading] = useState(true);
     const [selectedLog, setSelectedLog] = useState(null);
 
+    const latestIdRef = useRef(null);
+    const inFlightRef = useRef(false);
+
+    const authHeaders = async () => {
+        const { data: { session } } = await supabase.auth.getSession();
+        return { "Authorization": `Bearer ${session?.access_token}` };
+    };
+
     const fetchLogs = async () => {
+        if (inFlightRef.current) return;
+        inFlightRef.current = true;
         try {
-            const { data: { session } } = await supabase.auth.getSession();
-            const token = session?.access_token;
+            const headers = await authHeaders();
+            // First load fetches the window; later polls only fetch entries newer than the last seen id
+            const params = new URLSearchParams({ fields: LIST_FIELDS, limit: String(MAX_LOGS) });
+            if (latestIdRef.current !== null) {
+                params.set("since", String(latestIdRef.current));
+            }
 
-            const response = await fetch("http://localhost:8000/logs", {
-                headers: { "Authorization": `Bearer ${token}` }
-            });
+            const [response, metricsResponse] = await Promise.all([
+                fetch(`http://localhost:8000/logs?${params}`, { headers }),
+                fetch("http://localhost:8000/metrics?top=0", { headers }),
+            ]);
+            if (metricsResponse.ok) {
+                setMetrics(await metricsResponse.json());
+            }
             const data = await response.json();
-            setLogs(data);
+            if (!Array.isArray(data.entries)) return;
+
+            if (data.entries.length > 0) {
+                latestIdRef.current = Math.max(latestIdRef.current ?? 0, data.entries[0].id);
+                setLogs(prev => [...data.entries, ...prev].slice(0, MAX_LOGS));
+            } else if (latestIdRef.current === null) {
+                latestIdRef.current = data.latest_id ?? 0;
+            }
         } catch (error) {
             console.error("Failed to fetch logs:", error);
         } finally {
+            inFlightRef.current = false;
             setLoading(false);
         }
     };
 
+    const openLog = async (log) => {
+        setSelectedLog(log);
+        try {
+            const headers = await authHeaders();
+            const response = await fetch(`http://localhost:8000/logs/${log.id}`, { headers });
+            if (response.ok) {
+                setSelectedLog(await response.json());
+            }
+        } catch (error) {
+            console.error("Failed to fetch log entry:", error);
+        }
+    };
+
     useEffect(() => {
         fetchLogs();
         const interval = setInterval(fetchLogs, 2000);
@@ -172,6 +327,7 @@ function Dashboard({ onClose }) {
                 </header>
 
                 <div className="dashboard-content">
+                    <MetricsBar metrics={metrics} />
                     {loading && logs.length === 0 ? (
                         <div className="dashboard-empty">
                             <div className="loading-spinner"></div>
@@ -187,7 +343,7 @@ function Dashboard({ onClose }) {
                                 <UserGroup
                                     key={idx}
                                     user={user}
-                                    onSelectLog={setSelectedLog}
+                                    onSelectLog={openLog}
                                 />
                             ))}
                         </div>
@@ -2,6 +2,13 @@ import { useState, useRef, useEffect } from "react";
 import "./FullChat.css";
 import { supabase } from "./supabaseClient";
 
+// 429/503 from the API (LLM queue full or too long a wait), as a message for the chat
+function busyError(retryAfter) {
+    const error = new Error(`The assistant is busy right now. Please try again in ${retryAfter || "a few"} seconds.`);
+    error.busy = true;
+    return error;
+}
+
 function FullChat({ onClose, sessionStart }) {
     const [messages, setMessages] = useState([]);
     const [question, setQuestion] = useState("");
@@ -50,6 +57,9 @@ function FullChat({ onClose, sessionStart }) {
                 body: JSON.stringify({ question: userMessage.content, session_start: sessionStart })
             });
 
+            if (response.status === 429 || response.status === 503) {
+                throw busyError(response.headers.get("Retry-After"));
+            }
             if (!response.ok) throw new Error(`HTTP error: ${response.status}`);
 
             const reader = response.body.getReader();
@@ -81,6 +91,19 @@ function FullChat({ onClose, sessionStart }) {
                         if (payload.startsWith("[ERROR]")) {
                             throw new Error(payload.slice(8));
                         }
+                        if (payload.startsWith("[QUEUED]")) {
+                            // Waiting for a free LLM slot; replaced by the first token
+                            const { position } = JSON.parse(payload.slice(8));
+                            setMessages((prev) => {
+                                const updated = [...prev];
+                                updated[updated.length - 1] = { ...updated[updated.length - 1], content: `Waiting for a free slot (position ${position})...` };
+                                return updated;
+                            });
+                            continue;
+                        }
+                        if (payload.startsWith("[BUSY]")) {
+                            throw busyError(JSON.parse(payload.slice(6)).retry_after);
+                        }
                         if (payload.startsWith("[SOURCES]")) {
                             try {
                                 const sources = JSON.parse(payload.slice(9));
@@ -106,7 +129,7 @@ function FullChat({ onClose, sessionStart }) {
         } catch (error) {
             setMessages((prev) => {
                 const updated = [...prev];
-                updated[updated.length - 1] = { role: "assistant", content: "Sorry, I'm having trouble connecting to the server. Please check if the backend is running." };
+                updated[updated.length - 1] = { role: "assistant", content: error.busy ? error.message : "Sorry, I'm having trouble connecting to the server. Please check if the backend is running." };
                 return updated;
             });
         } finally {